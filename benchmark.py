@@ -0,0 +1,822 @@
+"""Offline benchmarks for TownyBot. Nothing here talks to Discord.
+
+    python benchmark.py storage --towns 10000
+    python benchmark.py commands --towns 100,10000,100000
+    python benchmark.py backup --towns 100000
+    python benchmark.py codec --towns 1000,10000,100000
+    python benchmark.py rest --dms 500 --role-edits 200
+
+Results are printed as JSON so runs from different commits can be diffed.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import discord
+
+import towny_bot
+
+
+def generate_world(n_towns, members_per_town=5, towns_per_nation=10, seed=1):
+    rng = random.Random(seed)
+    towns = {}
+    nations = {}
+    next_user = 10_000
+    for i in range(n_towns):
+        members = list(range(next_user, next_user + rng.randint(1, members_per_town * 2 - 1)))
+        next_user += len(members)
+        towns[f"Town {i}"] = {
+            "role_id": 1_000_000 + i,
+            "owner_id": members[0],
+            "members": members,
+            "pending": [],
+            "awaiting_confirmation": False,
+            "guild_id": 1,
+        }
+    names = list(towns)
+    for n, start in enumerate(range(0, n_towns, towns_per_nation)):
+        member_towns = names[start:start + towns_per_nation]
+        nations[f"Nation {n}"] = {
+            "leader_id": towns[member_towns[0]]["owner_id"],
+            "capital_town": member_towns[0],
+            "member_towns": member_towns,
+            "role_id": 2_000_000 + n,
+        }
+    return towns, nations
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def pick(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+    return {
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+    }
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+async def bench_storage_mode(mode, towns, nations, rounds):
+    with open("towns.json", "w") as f:
+        json.dump(towns, f, indent=4)
+    with open("nations.json", "w") as f:
+        json.dump(nations, f, indent=4)
+    if mode == "sqlite":
+        towny_bot.import_json_to_sqlite()
+
+    state = towny_bot.WorldState(towny_bot.make_storage(mode))
+    start = time.perf_counter()
+    state.load()
+    load_time = time.perf_counter() - start
+
+    rng = random.Random(2)
+    town_names = list(state.towns)
+    nation_names = list(state.nations)
+
+    # One record changes: a player joins a town
+    single = []
+    for i in range(rounds):
+        state.add_member(rng.choice(town_names), 5_000_000 + i)
+        start = time.perf_counter()
+        await state.flush()
+        single.append(time.perf_counter() - start)
+
+    # Two records change together: a nation war declaration and its expiry timer
+    war = []
+    for _ in range(rounds):
+        a, b = rng.sample(nation_names, 2)
+        declared = state.declare_war("nation", a, b)
+        state.timers[f"war:{declared['id']}"] = {"kind": "war", "due": time.time() + 60, "data": {"war": declared["id"]}}
+        state.mark_dirty("timers", f"war:{declared['id']}")
+        start = time.perf_counter()
+        await state.flush()
+        war.append(time.perf_counter() - start)
+        state.set_war_status(declared, "ended", reason="benchmark")
+
+    await state.close()
+    return {
+        "load_ms": round(load_time * 1000, 3),
+        "single_record_flush": percentiles(single),
+        "two_record_flush": percentiles(war),
+        "bytes_on_disk": dir_size("."),
+    }
+
+
+def bench_storage(args):
+    towns, nations = generate_world(args.towns)
+    results = {"towns": len(towns), "nations": len(nations), "rounds": args.rounds, "modes": {}}
+    cwd = os.getcwd()
+    for mode in ("json", "journal", "sqlite"):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                results["modes"][mode] = asyncio.run(bench_storage_mode(mode, towns, nations, args.rounds))
+            finally:
+                os.chdir(cwd)
+    return results
+
+
+async def bench_backup_export(towns, nations, changes):
+    with open("towns.json", "w") as f:
+        json.dump(towns, f)
+    with open("nations.json", "w") as f:
+        json.dump(nations, f)
+    state = towny_bot.WorldState(towny_bot.make_storage("json"))
+    state.load()
+
+    # How long the event loop goes without a turn while a backup runs
+    gaps = []
+    async def ticker():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+    task = asyncio.create_task(ticker())
+    full = await towny_bot.export_ndjson(state, os.path.abspath("full.ndjson"))
+    task.cancel()
+
+    rng = random.Random(3)
+    names = list(state.towns)
+    for i in range(changes):
+        state.add_member(rng.choice(names), 7_000_000 + i)
+    incremental = await towny_bot.export_ndjson(state, os.path.abspath("incremental.ndjson"), full["checkpoint"])
+    expected = {name: town["members"] for name, town in state.towns.items()}
+    await state.close()
+    return full, incremental, max(gaps, default=0.0), expected
+
+
+def bench_backup(args):
+    towns, nations = generate_world(args.towns)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            full, incremental, max_gap, expected = asyncio.run(bench_backup_export(towns, nations, args.changes))
+            start = time.perf_counter()
+            towny_bot.verify_ndjson(full["path"])
+            verify_time = time.perf_counter() - start
+
+            os.mkdir("restore")
+            os.chdir("restore")
+            # Leftovers from the state being replaced, which a full restore must drop
+            for name, records in (("timers", {"war:1": {"kind": "war", "due": 0, "data": {"war": "1"}}}),
+                                  ("outbox", {"1-1": {"pending": [1]}})):
+                with open(f"{name}.json", "w") as f:
+                    json.dump(records, f)
+            start = time.perf_counter()
+            towny_bot.import_ndjson([full["path"], incremental["path"]])
+            import_time = time.perf_counter() - start
+            restored = towny_bot.load_towns()
+            leftovers = towny_bot.load_json_file("timers.json") or towny_bot.load_json_file("outbox.json")
+        finally:
+            os.chdir(cwd)
+    return {
+        "towns": len(towns),
+        "full": {"records": full["records"], "bytes": full["bytes"], "ms": round(full["seconds"] * 1000, 1)},
+        "max_loop_stall_ms": round(max_gap * 1000, 3),
+        "incremental": {"changes": args.changes, "records": incremental["records"], "bytes": incremental["bytes"],
+                        "ms": round(incremental["seconds"] * 1000, 1)},
+        "verify_ms": round(verify_time * 1000, 1),
+        "import_ms": round(import_time * 1000, 1),
+        "restored_matches": {name: town["members"] for name, town in restored.items()} == expected,
+        "stale_timers_cleared": not leftovers,
+    }
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1000, 3)
+
+
+async def bench_codec_flush(codec, towns, nations, rounds):
+    # The bot's real save path: one town changes, only it is re-encoded
+    storage = towny_bot.JsonStorage(codec)
+    for name, records in (("towns", towns), ("nations", nations)):
+        with open(f"{name}.json", "wb") as f:
+            f.write(codec.encode(records))
+    state = towny_bot.WorldState(storage)
+    start = time.perf_counter()
+    state.load()
+    load_time = time.perf_counter() - start
+    rng = random.Random(2)
+    names = list(state.towns)
+    samples = []
+    for i in range(rounds):
+        state.add_member(rng.choice(names), 5_000_000 + i)
+        start = time.perf_counter()
+        await state.flush()
+        samples.append(time.perf_counter() - start)
+    await state.close()
+    return load_time, samples
+
+
+def bench_codec(args):
+    results = {"repeat": args.repeat, "worlds": {}}
+    cwd = os.getcwd()
+    for size in args.towns:
+        towns, nations = generate_world(size)
+        # What JSON mode wrote before codecs: one indented dump per save
+        old = json.dumps(towns, indent=4).encode()
+        world = {"json_indent4_old": {
+            "dump_ms": best_time(lambda: json.dumps(towns, indent=4).encode(), args.repeat),
+            "parse_ms": best_time(lambda: json.loads(old), args.repeat),
+            "bytes": len(old),
+        }}
+        for name in ("json", "orjson", "msgpack"):
+            codec = towny_bot.make_codec(name)
+            if codec.name != name:
+                world[name] = "not installed"
+                continue
+            def dump():
+                return codec.document([(codec.dumps(key), codec.dumps(town)) for key, town in towns.items()])
+            data = dump()
+            assert towny_bot.decode_state(data) == towns
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                try:
+                    load_time, flushes = asyncio.run(bench_codec_flush(codec, towns, nations, args.rounds))
+                finally:
+                    os.chdir(cwd)
+            world[name] = {
+                "dump_ms": best_time(dump, args.repeat),
+                "parse_ms": best_time(lambda: towny_bot.decode_state(data), args.repeat),
+                "bytes": len(data),
+                "load_ms": round(load_time * 1000, 3),
+                "single_record_flush": percentiles(flushes),
+            }
+        results["worlds"][str(size)] = world
+    return results
+
+
+class FakeHTTP:
+    # Stands in for discord.py's HTTPClient: every call waits its turn for
+    # the global rate limit, first come first served, then takes `latency`
+    def __init__(self, latency, global_rate):
+        self.latency = latency
+        self.interval = 1 / global_rate
+        self.next_slot = 0.0
+
+    async def request(self, route, **kwargs):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now + self.latency)
+
+
+async def bench_rest_burst(scheduled, args):
+    Route = discord.http.Route
+    http = FakeHTTP(args.latency / 1000, args.global_rate)
+    if scheduled:
+        towny_bot.RestScheduler(type("FakeBot", (), {"http": http})()).install()
+    done = collections.defaultdict(list)
+    start = time.perf_counter()
+
+    async def call(kind, route):
+        began = time.perf_counter()
+        await http.request(route)
+        done[kind].append(time.perf_counter() - began)
+
+    async def dm(user_id):
+        towny_bot.rest_guild.set(1)
+        await call("dm", Route("POST", "/channels/{channel_id}/messages", channel_id=user_id))
+
+    async def interaction_call(guild_id, user_id):
+        # A button that edits roles before it answers, like Enter Server
+        towny_bot.current_interaction.set(FakeInteraction(None, FakeGuild(guild_id, [], [])))
+        await call("interaction", Route("DELETE", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}",
+                                        guild_id=guild_id, user_id=user_id, role_id=1))
+
+    # An announcement and a big guild's role sync land at once, a small guild
+    # edits a few roles, and members keep clicking buttons throughout
+    tasks = [asyncio.create_task(dm(10_000 + i)) for i in range(args.dms)]
+    tasks += [asyncio.create_task(call("big_guild_role", Route("PUT", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}",
+                                                               guild_id=1, user_id=20_000 + i, role_id=2)))
+              for i in range(args.role_edits)]
+    tasks += [asyncio.create_task(call("small_guild_role", Route("PUT", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}",
+                                                                 guild_id=2, user_id=30_000 + i, role_id=3)))
+              for i in range(10)]
+    for i in range(args.interactions):
+        await asyncio.sleep(0.05)
+        tasks.append(asyncio.create_task(interaction_call(3, 40_000 + i)))
+    await asyncio.gather(*tasks)
+    result = {kind: percentiles(samples) for kind, samples in sorted(done.items())}
+    result["total_s"] = round(time.perf_counter() - start, 2)
+    return result
+
+
+def bench_rest(args):
+    return {
+        "dms": args.dms,
+        "role_edits": args.role_edits,
+        "interactions": args.interactions,
+        "direct": asyncio.run(bench_rest_burst(False, args)),
+        "scheduled": asyncio.run(bench_rest_burst(True, args)),
+    }
+
+
+# --- Fake Discord ---
+# Just enough of Interaction, Guild, Member and Role for the command
+# callbacks to run in-process. Every method that would be a REST call
+# counts itself in rest_calls instead.
+rest_calls = collections.Counter()
+
+async def rest(route):
+    rest_calls[route] += 1
+    await asyncio.sleep(0)
+
+
+class FakeRole:
+    def __init__(self, guild, role_id, name):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.mention = f"<@&{role_id}>"
+
+    async def delete(self, reason=None):
+        await rest("DELETE /guilds/roles")
+        self.guild._roles.pop(self.id, None)
+
+    async def edit(self, **fields):
+        await rest("PATCH /guilds/roles")
+
+
+message_ids = itertools.count(1)
+
+class FakeMessage:
+    components = []
+
+    def __init__(self):
+        self.id = next(message_ids)
+        self.channel = FakeChannel()
+
+    async def edit(self, **fields):
+        await rest("PATCH /channels/messages")
+
+
+class FakeMember:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.id = user_id
+        self.name = self.display_name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.roles = []
+
+    async def add_roles(self, *roles, reason=None):
+        await rest("PUT /guilds/members/roles")
+        self.roles.extend(roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await rest("DELETE /guilds/members/roles")
+        self.roles = [role for role in self.roles if role not in roles]
+
+    async def send(self, content=None, **fields):
+        await rest("POST /channels/messages (DM)")
+        return FakeMessage()
+
+
+class FakeGuild:
+    def __init__(self, guild_id, member_ids, role_ids):
+        self.id = guild_id
+        self.name = "Benchmark"
+        self._member_ids = member_ids  # anything supporting "in", e.g. a range
+        self._members = {}
+        self._roles = {role_id: FakeRole(self, role_id, f"role{role_id}") for role_id in role_ids}
+        self._next_role = 9_000_000
+
+    @property
+    def roles(self):
+        return list(self._roles.values())
+
+    def add_member(self, user_id):
+        return self._members.setdefault(user_id, FakeMember(self, user_id))
+
+    def get_member(self, user_id):
+        member = self._members.get(user_id)
+        if member is None and user_id in self._member_ids:
+            member = self.add_member(user_id)
+        return member
+
+    async def fetch_member(self, user_id):
+        await rest("GET /guilds/members")
+        member = self.get_member(user_id)
+        if member is None:
+            raise discord.NotFound(FakeHTTPResponse(404), "Unknown Member")
+        return member
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    async def create_role(self, name=None, **fields):
+        await rest("POST /guilds/roles")
+        self._next_role += 1
+        role = self._roles[self._next_role] = FakeRole(self, self._next_role, name)
+        return role
+
+
+class FakeHTTPResponse:
+    def __init__(self, status):
+        self.status = status
+        self.reason = "benchmark"
+
+
+class FakeResponse:
+    def __init__(self):
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **fields):
+        await rest("POST /interactions/callback")
+        self._done = True
+
+    async def defer(self, **fields):
+        await rest("POST /interactions/callback")
+        self._done = True
+
+    async def edit_message(self, **fields):
+        await rest("POST /interactions/callback")
+        self._done = True
+
+
+class FakeFollowup:
+    async def send(self, content=None, **fields):
+        await rest("POST /webhooks (followup)")
+
+
+class FakeChannel:
+    id = 1
+
+    async def send(self, content=None, **fields):
+        await rest("POST /channels/messages")
+
+    def get_partial_message(self, message_id):
+        return FakeMessage()
+
+
+class FakeInteraction:
+    def __init__(self, user, guild, message=None):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id if guild is not None else None
+        self.message = message
+        self.channel = FakeChannel()
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.extras = {}
+
+    def is_expired(self):
+        return False
+
+
+def proc_io():
+    # Bytes this process read/wrote through syscalls (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except OSError:
+        return None
+
+
+def io_delta(before, after):
+    if before is None or after is None:
+        return None, None
+    return after[0] - before[0], after[1] - before[1]
+
+
+# --- Command benchmark ---
+class CommandWorld:
+    """A generated world loaded into the real bot, plus the fake guild around it."""
+
+    def __init__(self, towns, nations, rounds, seed=3):
+        self.bot = towny_bot.bot
+        self.rng = random.Random(seed)
+        self.rounds = rounds
+        self.town_names = list(towns)
+        self.nation_names = list(nations)
+        last_user = max(max(town["members"]) for town in towns.values()) if towns else 10_000
+        role_ids = [town["role_id"] for town in towns.values()] + [nation["role_id"] for nation in nations.values()]
+        self.guild = FakeGuild(1, range(10_000, last_user + 1), role_ids)
+        self.next_user = 50_000_000
+        self.joined = []  # (user, town name) accepted by the join button
+
+    def new_member(self):
+        self.next_user += 1
+        return self.guild.add_member(self.next_user)
+
+    def member(self, user_id):
+        return self.guild.get_member(user_id)
+
+    def slash(self, user):
+        return FakeInteraction(user, self.guild)
+
+    def dm_click(self, user):
+        # Button clicks in DMs have no guild
+        return FakeInteraction(user, None, FakeMessage())
+
+    async def settle(self):
+        # Let background jobs and announcements finish, then write state out
+        await self.bot.jobs._queue.join()
+        await asyncio.gather(*list(self.bot.announcer._tasks.values()))
+        await self.bot.state.flush()
+
+
+def scenario_townjoin(world):
+    world.pending = []
+    for _ in range(world.rounds):
+        user = world.new_member()
+        town_name = world.rng.choice(world.town_names)
+        world.pending.append((user, town_name))
+        yield towny_bot.join.callback(world.slash(user), town_name)
+
+def scenario_join_accept_button(world):
+    for user, town_name in world.pending:
+        town = world.bot.state.towns[town_name]
+        owner = world.member(town["owner_id"])
+        button = towny_bot.TownyButton("ta", town["role_id"], user.id)
+        world.joined.append(user)
+        yield button.callback(world.dm_click(owner))
+
+def scenario_townjoin_autocomplete(world):
+    for _ in range(world.rounds):
+        name = world.rng.choice(world.town_names)
+        yield towny_bot.join_town_autocomplete(world.slash(world.new_member()), name[:world.rng.randint(1, len(name))])
+
+def scenario_join_request_expiry(world):
+    # Requests nobody answered, expired one scheduler batch at a time
+    state, scheduler = world.bot.state, world.bot.scheduler
+    due = []
+    for _ in range(world.rounds):
+        user = world.new_member()
+        town_name = world.rng.choice(world.town_names)
+        town = state.towns[town_name]
+        state.add_pending(town_name, user.id)
+        timer_id = towny_bot.join_timer(town, user.id)
+        scheduler.schedule(timer_id, 0, "join", {"town": town["role_id"], "user": user.id, **towny_bot.message_ref(FakeMessage())})
+        due.append(timer_id)
+    for start in range(0, len(due), towny_bot.TIMER_BATCH):
+        batch = []
+        for timer_id in due[start:start + towny_bot.TIMER_BATCH]:
+            batch.append(state.timers[timer_id]["data"])
+            scheduler.cancel(timer_id)
+        yield towny_bot.expire_join_requests(batch)
+
+def scenario_townleave(world):
+    for user in world.joined:
+        yield towny_bot.leave.callback(world.slash(user))
+
+def scenario_towncreate(world):
+    world.founders = []
+    for i in range(world.rounds * 2):
+        user = world.new_member()
+        world.founders.append((user, f"Bench Town {i}"))
+        yield towny_bot.create.callback(world.slash(user), f"Bench Town {i}", "#ff5733")
+
+def scenario_nationcreate(world):
+    # The first half of the new towns found nations; the second half get invited
+    for i, (user, _) in enumerate(world.founders[:world.rounds]):
+        yield towny_bot.nationcreate.callback(world.slash(user), f"Bench Nation {i}", "#3366ff")
+
+def scenario_nationinvite(world):
+    for (leader, _), (_, town_name) in zip(world.founders[:world.rounds], world.founders[world.rounds:]):
+        yield towny_bot.nationinvite.callback(world.slash(leader), town_name)
+
+def scenario_nation_invite_accept_button(world):
+    state = world.bot.state
+    for i, ((leader, _), (owner, town_name)) in enumerate(zip(world.founders[:world.rounds], world.founders[world.rounds:])):
+        nation = state.nations[f"Bench Nation {i}"]
+        button = towny_bot.TownyButton("na", nation["role_id"], state.towns[town_name]["role_id"])
+        yield button.callback(world.dm_click(owner))
+
+def scenario_townannounce(world):
+    for _ in range(world.rounds):
+        town = world.bot.state.towns[world.rng.choice(world.town_names)]
+        yield towny_bot.announce.callback(world.slash(world.member(town["owner_id"])), "Benchmark announcement")
+
+def war_pairs(world):
+    pairs = len(world.nation_names) // 2
+    return [(world.nation_names[2 * i], world.nation_names[2 * i + 1]) for i in range(min(world.rounds, pairs))]
+
+def scenario_nationdeclarewar(world):
+    for attacker, defender in war_pairs(world):
+        leader = world.member(world.bot.state.nations[attacker]["leader_id"])
+        yield towny_bot.nationdeclarewar.callback(world.slash(leader), defender)
+
+def scenario_nationwaraccept(world):
+    for _, defender in war_pairs(world):
+        leader = world.member(world.bot.state.nations[defender]["leader_id"])
+        yield towny_bot.nationwaraccept.callback(world.slash(leader))
+
+def scenario_nationactivewars(world):
+    for _ in range(world.rounds):
+        yield towny_bot.nationactivewars.callback(world.slash(world.new_member()))
+
+def scenario_leaderboard(world):
+    boards = list(towny_bot.LEADERBOARDS)
+    for i in range(world.rounds):
+        if i % 2:
+            # Change a ranking between reads so the cache has to rebuild sometimes
+            world.bot.state.add_member(world.rng.choice(world.town_names), world.new_member().id)
+        yield towny_bot.leaderboard.callback(world.slash(world.new_member()), boards[i % len(boards)])
+
+def scenario_towninfo(world):
+    for _ in range(world.rounds):
+        yield towny_bot.towninfo.callback(world.slash(world.new_member()), world.rng.choice(world.town_names))
+
+def scenario_nationinfo(world):
+    for _ in range(world.rounds):
+        yield towny_bot.nationinfo.callback(world.slash(world.new_member()), world.rng.choice(world.nation_names))
+
+def scenario_townlist(world):
+    pages = len(world.town_names) // towny_bot.LIST_PAGE_SIZE + 1
+    for i in range(world.rounds):
+        if i % 2:
+            # Change a town between views so some pages have to be rendered again
+            world.bot.state.add_member(world.rng.choice(world.town_names), world.new_member().id)
+        yield towny_bot.townlist.callback(world.slash(world.new_member()), world.rng.randint(1, pages))
+
+def scenario_townlist_page_button(world):
+    # Someone paging through from the start, one click at a time
+    user = world.new_member()
+    for page in range(1, world.rounds + 1):
+        button = towny_bot.TownyButton("tl", page, 0)
+        yield button.callback(world.slash(user))
+
+def scenario_nationlist(world):
+    pages = len(world.nation_names) // towny_bot.LIST_PAGE_SIZE + 1
+    for _ in range(world.rounds):
+        yield towny_bot.nationlist.callback(world.slash(world.new_member()), world.rng.randint(1, pages))
+
+# Run in this order; later scenarios use what earlier ones set up
+COMMAND_SCENARIOS = [
+    ("townjoin", scenario_townjoin),
+    ("join_accept_button", scenario_join_accept_button),
+    ("townjoin_autocomplete", scenario_townjoin_autocomplete),
+    ("join_request_expiry", scenario_join_request_expiry),
+    ("townleave", scenario_townleave),
+    ("towncreate", scenario_towncreate),
+    ("nationcreate", scenario_nationcreate),
+    ("nationinvite", scenario_nationinvite),
+    ("nation_invite_accept_button", scenario_nation_invite_accept_button),
+    ("townannounce", scenario_townannounce),
+    ("nationdeclarewar", scenario_nationdeclarewar),
+    ("nationwaraccept", scenario_nationwaraccept),
+    ("nationactivewars", scenario_nationactivewars),
+    ("leaderboard", scenario_leaderboard),
+    ("towninfo", scenario_towninfo),
+    ("nationinfo", scenario_nationinfo),
+    ("townlist", scenario_townlist),
+    ("townlist_page_button", scenario_townlist_page_button),
+    ("nationlist", scenario_nationlist),
+]
+
+
+async def bench_commands_world(mode, towns, nations, rounds):
+    with open("towns.json", "w") as f:
+        json.dump(towns, f, indent=4)
+    with open("nations.json", "w") as f:
+        json.dump(nations, f, indent=4)
+    if mode in ("sqlite", "shared"):
+        towny_bot.import_json_to_sqlite()
+
+    world = CommandWorld(towns, nations, rounds)
+    bot = world.bot
+    bot.get_guild = lambda guild_id: world.guild if guild_id == world.guild.id else None
+    bot.get_user = world.member
+    bot.get_partial_messageable = lambda channel_id: FakeChannel()
+
+    async def fetch_user(user_id):
+        await rest("GET /users")
+        member = world.member(user_id)
+        if member is None:
+            raise discord.NotFound(FakeHTTPResponse(404), "Unknown User")
+        return member
+    bot.fetch_user = fetch_user
+
+    # Fresh services around a freshly loaded state for every world
+    bot.state = towny_bot.WorldState(towny_bot.make_storage(mode))
+    bot.locks = towny_bot.LockManager(bot.state.transaction if bot.state.shared else None)
+    bot.jobs = towny_bot.JobQueue()
+    bot.announcer = towny_bot.AnnouncementDispatcher(bot)
+    bot.directory = towny_bot.MemberDirectory(bot)
+    bot.user_cache = towny_bot.UserCache(bot)
+    bot.scheduler = towny_bot.Scheduler(bot)
+
+    before = proc_io()
+    start = time.perf_counter()
+    bot.state.load()
+    load_time = time.perf_counter() - start
+    load_read, _ = io_delta(before, proc_io())
+    bot.jobs.start()
+
+    results = {"load_ms": round(load_time * 1000, 3), "load_bytes_read": load_read, "commands": {}}
+    for name, scenario in COMMAND_SCENARIOS:
+        rest_calls.clear()
+        before = proc_io()
+        samples = []
+        for call in scenario(world):
+            start = time.perf_counter()
+            await call
+            samples.append(time.perf_counter() - start)
+        await world.settle()
+        read, written = io_delta(before, proc_io())
+        if not samples:
+            continue
+        results["commands"][name] = {
+            "calls": len(samples),
+            **percentiles(samples),
+            "bytes_read": read,
+            "bytes_written": written,
+            "rest_calls": sum(rest_calls.values()),
+            "rest_calls_by_route": dict(sorted(rest_calls.items())),
+        }
+
+    await bot.jobs.close()
+    await bot.state.close()
+    return results
+
+
+def bench_commands(args):
+    # No rate limits to respect against fake Discord
+    towny_bot.ANNOUNCE_SEND_INTERVAL = 0
+    towny_bot.JOB_RETRY_DELAY = 0
+    results = {"storage": args.storage, "rounds": args.rounds, "worlds": {}}
+    cwd = os.getcwd()
+    for size in args.towns:
+        towns, nations = generate_world(size, members_per_town=args.members_per_town)
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                world = asyncio.run(bench_commands_world(args.storage, towns, nations, args.rounds))
+            finally:
+                os.chdir(cwd)
+        world["towns"] = len(towns)
+        world["nations"] = len(nations)
+        world["members"] = sum(len(town["members"]) for town in towns.values())
+        results["worlds"][str(size)] = world
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="suite", required=True)
+
+    storage = sub.add_parser("storage", help="compare the storage backends")
+    storage.add_argument("--towns", type=int, default=10_000)
+    storage.add_argument("--rounds", type=int, default=50)
+    storage.set_defaults(run=bench_storage)
+
+    commands = sub.add_parser("commands", help="run the command callbacks against fake Discord objects")
+    commands.add_argument("--towns", type=lambda text: [int(n) for n in text.split(",")], default=[100, 1_000, 10_000],
+                          help="comma separated world sizes, e.g. 100,10000,100000")
+    commands.add_argument("--members-per-town", type=int, default=5, help="average members per town")
+    commands.add_argument("--rounds", type=int, default=200, help="calls per command")
+    commands.add_argument("--storage", choices=("json", "journal", "sqlite", "shared"), default="json")
+    commands.set_defaults(run=bench_commands)
+
+    backup = sub.add_parser("backup", help="stream a live backup out and restore it")
+    backup.add_argument("--towns", type=int, default=10_000)
+    backup.add_argument("--changes", type=int, default=100, help="town changes between the full and the incremental backup")
+    backup.set_defaults(run=bench_backup)
+
+    codec = sub.add_parser("codec", help="dump and parse the towns file with each state codec")
+    codec.add_argument("--towns", type=lambda text: [int(n) for n in text.split(",")], default=[1_000, 10_000, 100_000],
+                       help="comma separated world sizes")
+    codec.add_argument("--repeat", type=int, default=5, help="timings are the best of this many runs")
+    codec.add_argument("--rounds", type=int, default=50, help="single record flushes per codec")
+    codec.set_defaults(run=bench_codec)
+
+    rest = sub.add_parser("rest", help="interaction latency during a REST burst, with and without the scheduler")
+    rest.add_argument("--dms", type=int, default=500)
+    rest.add_argument("--role-edits", type=int, default=200, help="role edits in one guild")
+    rest.add_argument("--interactions", type=int, default=20, help="interaction-bound calls made during the burst")
+    rest.add_argument("--latency", type=float, default=50.0, help="ms per simulated REST call")
+    rest.add_argument("--global-rate", type=float, default=50.0, help="simulated global limit, calls per second")
+    rest.set_defaults(run=bench_rest)
+
+    args = parser.parse_args()
+    print(json.dumps(args.run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,49 @@
 import discord
 from discord import app_commands
-from discord.ui import Button, View
+from discord.ui import View
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import math
 import os
+import random
+import sqlite3
+import struct
+import threading
+import time
+
+# Optional faster state file codecs, see TOWNY_CODEC
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 intents = discord.Intents.default()
 intents.members = True  # Required to track member changes
 intents.message_content = True
 
+# Sharding. Unset: one connection. "auto": every shard in this process.
+# "0,1/4": shards 0 and 1 of 4 in this process; run the others in more
+# processes with TOWNY_STORAGE=shared so they all use one database.
+SHARDS = os.getenv("TOWNY_SHARDS", "")
+
+def shard_options(spec):
+    if spec in ("", "auto"):
+        return {}
+    shard_ids, shard_count = spec.split("/")
+    return {"shard_ids": [int(shard_id) for shard_id in shard_ids.split(",")], "shard_count": int(shard_count)}
+
 class WelcomeView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None) # persistent button
@@ -15,32 +51,96 @@ class WelcomeView(discord.ui.View):
     @discord.ui.button(label="Enter Server", style=discord.ButtonStyle.green, custom_id="enter_server_btn")
     # Added 'button: discord.ui.Button' below to fix the TypeError
     async def enter_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        role = discord.utils.get(interaction.guild.roles, name="Newcomer")
+        current_interaction.set(interaction)
+        with bot.metrics.timer("button", "enter_server"):
+            # Still waiting for the Newcomer role: drop them from the queue and let them in
+            if bot.joins.discard(interaction.user):
+                return await interaction.response.send_message("✅ Welcome to Broken Crown! You now have access to the rest of the server.", ephemeral=True)
+
+            role = bot.special_roles.get(interaction.guild, "Newcomer")
         
-        if role:
-            if role in interaction.user.roles:
-                try:
-                    await interaction.user.remove_roles(role)
-                    await interaction.response.send_message("✅ Welcome to Broken Crown! You now have access to the rest of the server.", ephemeral=True)
-                except discord.Forbidden:
-                    await interaction.response.send_message("❌ I don't have permission to remove your role! Tell an Admin to move my bot role higher.", ephemeral=True)
+            if role:
+                if role in interaction.user.roles:
+                    try:
+                        await interaction.user.remove_roles(role)
+                        await interaction.response.send_message("✅ Welcome to Broken Crown! You now have access to the rest of the server.", ephemeral=True)
+                    except discord.Forbidden:
+                        await interaction.response.send_message("❌ I don't have permission to remove your role! Tell an Admin to move my bot role higher.", ephemeral=True)
+                else:
+                    await interaction.response.send_message("You have already entered!", ephemeral=True)
             else:
-                await interaction.response.send_message("You have already entered!", ephemeral=True)
-        else:
-            await interaction.response.send_message("❌ The 'Newcomer' role was not found. Please contact staff.", ephemeral=True)
+                await interaction.response.send_message("❌ The 'Newcomer' role was not found. Please contact staff.", ephemeral=True)
 
-class TownyBot(discord.Client):
+class TownyBot(discord.AutoShardedClient if SHARDS else discord.Client):
     def __init__(self):
-        super().__init__(intents=intents)
-        self.tree = app_commands.CommandTree(self)
+        super().__init__(intents=intents, **shard_options(SHARDS))
+        if "/" in SHARDS and STORAGE_MODE != "shared":
+            print("⚠️ Running some of several shards with local storage; set TOWNY_STORAGE=shared so they see each other's changes.")
+        self.tree = TownyTree(self)
+        self.state = WorldState(make_storage(STORAGE_MODE))
+        self.locks = LockManager(self.state.transaction if self.state.shared else None)
+        self.announcer = AnnouncementDispatcher(self)
+        self.jobs = JobQueue()
+        self.special_roles = SpecialRoles()
+        self.joins = JoinQueue(self)
+        self.directory = MemberDirectory(self)
+        self.user_cache = UserCache(self)
+        self.metrics = Metrics(self)
+        self.rest = RestScheduler(self)
+        self.reconciler = Reconciler(self)
+        self.scheduler = Scheduler(self)
+        self.backups = Backups(self)
 
     async def setup_hook(self):
+        # Load towns/nations once; commands work on the in-memory copy
+        # and the flusher writes changes back in the background.
+        self.state.load()
+        self.state.start()
+        self.jobs.start()
+        self.joins.start()
+        self.metrics.install()
+        self.rest.install()
+        self.metrics.start()
+        self.reconciler.start()
+        self.scheduler.start()
+        schedule_missing_timers()
+
         # This tells the bot to remember the "Enter Server" button
         # even if the bot restarts!
         self.add_view(WelcomeView()) 
-        await self.tree.sync()
-
-bot = TownyBot()
+        # Accept/Deny buttons in DMs, matched by their custom_id pattern
+        self.add_dynamic_items(TownyButton, LegacyJoinRequestButton, LegacyNationInviteButton)
+        await self.sync_commands()
+
+    async def sync_commands(self, force=False):
+        # Only talk to Discord when the command list actually changed since
+        # the last sync. Dev guilds get a guild sync, which shows up instantly.
+        hashes = load_json_file(COMMAND_HASH_FILE)
+        scopes = [discord.Object(id=guild_id) for guild_id in DEV_GUILD_IDS] or [None]
+        synced = []
+        for guild in scopes:
+            if guild is not None:
+                self.tree.copy_global_to(guild=guild)
+            key = f"{self.application_id}:{guild.id if guild else 'global'}"
+            fingerprint = command_fingerprint(self.tree, guild)
+            if not force and hashes.get(key) == fingerprint:
+                continue
+            await self.tree.sync(guild=guild)
+            hashes[key] = fingerprint
+            synced.append(key)
+        if synced:
+            write_file_atomic(COMMAND_HASH_FILE, json.dumps(hashes, indent=4).encode())
+        return synced
+
+    async def close(self):
+        # Finish queued role work, then write out anything still pending
+        await self.metrics.close()
+        await self.reconciler.close()
+        await self.scheduler.close()
+        await self.joins.close()
+        await self.jobs.close()
+        await self.state.close()
+        await super().close()
 
 # --- Data Management ---
 def load_towns():
@@ -52,19 +152,16 @@ def load_towns():
     
     # Try to read the file
     try:
-        with open("towns.json", "r") as f:
-            return json.load(f)
+        with open("towns.json", "rb") as f:
+            return decode_state(f.read())
     except (json.JSONDecodeError, ValueError):
-        # If the file is blank or corrupted, fix it automatically
-        print("⚠️ towns.json was empty or corrupted. Resetting to {}")
+        # If the file is blank or corrupted, keep a copy and start fresh
+        print("⚠️ towns.json was empty or corrupted. Saved it as towns.json.corrupt and reset to {}")
+        os.replace("towns.json", "towns.json.corrupt")
         with open("towns.json", "w") as f:
             json.dump({}, f)
         return {}
 
-def save_towns(towns):
-    with open("towns.json", "w") as f:
-        json.dump(towns, f, indent=4)
-
 def load_nations():
     if not os.path.exists("nations.json"):
         with open("nations.json", "w") as f:
@@ -72,27 +169,2768 @@ def load_nations():
         return {}
     
     try:
-        with open("nations.json", "r") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        # If the file is empty or broken, reset it
-        print("⚠️ nations.json was empty or corrupted. Resetting to {}")
+        with open("nations.json", "rb") as f:
+            return decode_state(f.read())
+    except (json.JSONDecodeError, ValueError):
+        # If the file is empty or broken, keep a copy and reset it
+        print("⚠️ nations.json was empty or corrupted. Saved it as nations.json.corrupt and reset to {}")
+        os.replace("nations.json", "nations.json.corrupt")
         with open("nations.json", "w") as f:
             json.dump({}, f)
         return {}
 
-def save_nations(nations):
-    with open("nations.json", "w") as f:
-        json.dump(nations, f, indent=4)
+def load_json_file(path):
+    # For the smaller state files: missing or unreadable just means empty
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            return decode_state(f.read())
+    except (json.JSONDecodeError, ValueError):
+        print(f"⚠️ {path} was empty or corrupted. Ignoring it.")
+        return {}
+
+def write_file_atomic(path, data):
+    # Write to a temp file and rename it over the real one, so a crash
+    # mid-write leaves either the old file or the new one, never half of each.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# --- Command Sync ---
+COMMAND_HASH_FILE = "command_sync.json"
+# Comma separated guild ids to sync to directly while developing
+DEV_GUILD_IDS = [int(guild_id) for guild_id in os.getenv("TOWNY_DEV_GUILDS", "").split(",") if guild_id.strip()]
+
+def command_fingerprint(tree, guild=None):
+    # Hash of exactly what tree.sync would upload: names, descriptions,
+    # options, default permissions and so on
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)), key=lambda c: (c["type"], c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+# --- State ---
+STORAGE_MODE = os.getenv("TOWNY_STORAGE", "json")  # "json", "journal", "sqlite" or "shared" (several shard processes)
+SQLITE_PATH = os.getenv("TOWNY_DB", "towny.db")
+SHARED_POLL_INTERVAL = 0.5  # seconds between checks for other processes' changes
+SHARED_CHANGES_KEPT = 100_000  # change log rows kept for processes that fall behind
+STATE_FLUSH_INTERVAL = 5.0  # seconds between background saves
+STATE_FLUSH_BATCH = 25      # save early once this many records have changed
+JOURNAL_COMPACT_BYTES = 1_000_000  # fold the journal into the snapshot past this size
+STATE_CODEC = os.getenv("TOWNY_CODEC", "json")  # state file format: "json", "orjson" or "msgpack" (the last two need the package)
+# State kept alongside towns and nations, as "<name>.json" in JSON mode
+EXTRA_COLLECTIONS = ("outbox", "wars", "timers")
+# War lifecycle: pending -> active (-> ceasefire_requested) -> ended.
+# A pending declaration ends when it is denied or nobody answers in time.
+WAR_TRANSITIONS = {
+    "pending": ("active", "ended"),
+    "active": ("ceasefire_requested", "ended"),
+    "ceasefire_requested": ("ended",),
+}
+# Seconds before an unanswered request expires and its DM buttons are disabled
+WAR_DECLARATION_TTL = float(os.getenv("TOWNY_WAR_TTL", 24 * 60 * 60))
+JOIN_REQUEST_TTL = float(os.getenv("TOWNY_JOIN_TTL", 3 * 24 * 60 * 60))
+NATION_INVITE_TTL = float(os.getenv("TOWNY_INVITE_TTL", 3 * 24 * 60 * 60))
+
+# --- Codecs ---
+# 0xc1 is unused in msgpack and can't start a JSON document, so a file
+# starting with this is msgpack and anything else is JSON.
+MSGPACK_MAGIC = b"\xc1TOWNY1"
+
+# A codec has three methods:
+#   dumps(value)    -> bytes for one key or record
+#   document(items) -> a whole file from already encoded (key, value) pairs,
+#                      so a save only re-encodes the records that changed
+#   encode(value)   -> a whole file from a plain dict
+# Reading never needs to know which codec wrote a file: see decode_state.
+
+class JsonCodec:
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    def document(self, items):
+        return b"{" + b",".join(key + b":" + value for key, value in items) + b"}"
+
+    def encode(self, value):
+        return self.dumps(value)
+
+class OrjsonCodec(JsonCodec):
+    # The same compact JSON, written several times faster
+    name = "orjson"
+
+    def dumps(self, value):
+        return orjson.dumps(value)
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value)
+
+    def document(self, items):
+        count = len(items)
+        if count < 16:
+            header = bytes((0x80 | count,))
+        elif count < 1 << 16:
+            header = struct.pack(">BH", 0xde, count)
+        else:
+            header = struct.pack(">BI", 0xdf, count)
+        return MSGPACK_MAGIC + header + b"".join(itertools.chain.from_iterable(items))
+
+    def encode(self, value):
+        return MSGPACK_MAGIC + self.dumps(value)
+
+def make_codec(name):
+    if name == "orjson" and orjson is not None:
+        return OrjsonCodec()
+    if name == "msgpack" and msgpack is not None:
+        return MsgpackCodec()
+    if name != "json":
+        print(f"⚠️ TOWNY_CODEC={name!r} isn't available here; writing JSON instead.")
+    return JsonCodec()
+
+def decode_state(data):
+    # Reads anything any codec wrote
+    if data.startswith(MSGPACK_MAGIC):
+        if msgpack is None:
+            # Not ValueError: the file is fine, so it mustn't be moved aside as corrupt
+            raise RuntimeError("This state file is in msgpack format; pip install msgpack to read it.")
+        return msgpack.unpackb(data[len(MSGPACK_MAGIC):], strict_map_key=False)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Every storage backend has the same four methods:
+#   load()                 -> {"towns": {...}, "nations": {...}, ...}, called once at startup;
+#                             sets loaded_bytes to how much it read
+#   encode(state, changes) -> payload, on the event loop; changes maps a
+#                             collection name to the keys changed since the last flush
+#   write(payload)         -> bytes written, in a worker thread; must apply the whole payload or nothing
+#   close()                -> in a worker thread at shutdown
+
+def load_state_files():
+    # Every collection from its own "<name>.json", as JSON mode keeps them
+    data = {"towns": load_towns(), "nations": load_nations()}
+    for name in EXTRA_COLLECTIONS:
+        data[name] = load_json_file(f"{name}.json")
+    return data
+
+def files_size(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+class JsonStorage:
+    # Whole-file storage: towns.json, nations.json and one file per extra
+    # collection. The names stay the same whatever the codec.
+    loaded_bytes = 0
+
+    def __init__(self, codec=None):
+        self.codec = codec or JsonCodec()
+        # collection -> {key: (encoded key, encoded record)}
+        self._encoded = {}
+
+    def load(self):
+        data = load_state_files()
+        self.loaded_bytes = files_size(*(f"{name}.json" for name in data))
+        dumps = self.codec.dumps
+        for collection, records in data.items():
+            self._encoded[collection] = {key: (dumps(key), dumps(record)) for key, record in records.items()}
+        return data
+
+    def encode(self, state, changes):
+        # Runs on the event loop so it sees a consistent snapshot, but only
+        # the changed records are encoded here. Encoding a whole collection
+        # in a worker thread wouldn't help: it holds the GIL all the same.
+        # Only files that actually changed get rewritten.
+        payload = {}
+        dumps = self.codec.dumps
+        for collection, keys in changes.items():
+            records = getattr(state, collection)
+            encoded = self._encoded.setdefault(collection, {})
+            for key in keys:
+                record = records.get(key)
+                if record is None:
+                    encoded.pop(key, None)
+                else:
+                    encoded[key] = (dumps(key), dumps(record))
+            payload[f"{collection}.json"] = list(encoded.values())
+        return payload
+
+    def write(self, payload):
+        # Runs in a worker thread, off the event loop: joining the encoded
+        # records up into a file is just copying bytes.
+        written = 0
+        for path, items in payload.items():
+            data = self.codec.document(items)
+            write_file_atomic(path, data)
+            written += len(data)
+        return written
+
+    def close(self):
+        pass
+
+class JournalStorage:
+    """Snapshot + append-only journal.
+
+    Each flush appends one JSON line per changed record to the journal and
+    fsyncs once, so a save costs the size of the change rather than the whole
+    world. When the journal grows past JOURNAL_COMPACT_BYTES it is rotated to
+    ``<journal>.old`` and a background thread folds it into a fresh snapshot,
+    which replaces the old one with an atomic rename. On startup the snapshot
+    is loaded and any journal records newer than it are replayed.
+    """
+
+    def __init__(self, snapshot_path="world.snapshot.json", journal_path="world.journal", codec=None):
+        self.codec = codec or JsonCodec()  # for the snapshot; journal lines are always JSON
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.old_journal_path = f"{journal_path}.old"
+        self.seq = 0  # sequence number of the last record written
+        self._journal_bytes = 0
+        self._compactor = None
+        self.loaded_bytes = 0
+
+    def _read_snapshot(self):
+        data, seq = {}, 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = decode_state(f.read())
+            data, seq = snapshot["data"], snapshot["seq"]
+        for name in ("towns", "nations") + EXTRA_COLLECTIONS:
+            data.setdefault(name, {})
+        return data, seq
+
+    @staticmethod
+    def _parse_line(line):
+        # A record, or None. A torn record with no newline runs into the next
+        # one; keep that next record if it is whole.
+        if not line.endswith(b"\n"):
+            return None
+        try:
+            return json.loads(line)
+        except ValueError:
+            start = line.rfind(b'{"seq":', 1)
+            if start == -1:
+                return None
+            try:
+                return json.loads(line[start:])
+            except ValueError:
+                return None
+
+    def _replay(self, path, data, seq, repair=False):
+        # Apply every record newer than seq. A torn final line (the process
+        # died mid-append) is cut off if repair is set. Unreadable lines with
+        # good records after them are skipped, never cut off.
+        if not os.path.exists(path):
+            return seq
+        offset = good_bytes = 0
+        skipped = unreadable = 0
+        with open(path, "rb") as f:
+            for line in f:
+                offset += len(line)
+                record = self._parse_line(line)
+                if record is None:
+                    unreadable += 1
+                    continue
+                skipped += unreadable
+                unreadable = 0
+                good_bytes = offset
+                if record["seq"] > seq:
+                    seq = record["seq"]
+                    records = data.setdefault(record["c"], {})
+                    if record["v"] is None:
+                        records.pop(record["k"], None)
+                    else:
+                        records[record["k"]] = record["v"]
+        if skipped:
+            print(f"⚠️ {path} has {skipped} unreadable record(s) before good ones; skipped them and kept the rest.")
+        if repair and good_bytes < os.path.getsize(path):
+            print(f"⚠️ {path} had a partial record at the end; dropping it.")
+            with open(path, "r+b") as f:
+                f.truncate(good_bytes)
+        return seq
+
+    def load(self):
+        if not any(os.path.exists(p) for p in (self.snapshot_path, self.journal_path, self.old_journal_path)):
+            # First run in journal mode: start from the existing JSON files
+            data = load_state_files()
+            self.loaded_bytes = files_size(*(f"{name}.json" for name in data))
+            write_file_atomic(self.snapshot_path, self.codec.encode({"seq": 0, "data": data}))
+            return data
+
+        self.loaded_bytes = files_size(self.snapshot_path, self.old_journal_path, self.journal_path)
+        data, seq = self._read_snapshot()
+        seq = self._replay(self.old_journal_path, data, seq)
+        seq = self._replay(self.journal_path, data, seq, repair=True)
+        self.seq = seq
+        if os.path.exists(self.journal_path):
+            self._journal_bytes = os.path.getsize(self.journal_path)
+        if os.path.exists(self.old_journal_path):
+            # A compaction was interrupted; finish it
+            self._start_compaction()
+        return data
+
+    def encode(self, state, changes):
+        lines = []
+        for collection, keys in changes.items():
+            records = getattr(state, collection)
+            for key in keys:
+                self.seq += 1
+                record = {"seq": self.seq, "c": collection, "k": key, "v": records.get(key)}
+                lines.append(json.dumps(record, separators=(",", ":")))
+        return ("\n".join(lines) + "\n").encode()
+
+    def write(self, payload):
+        with open(self.journal_path, "ab") as f:
+            start = f.tell()
+            try:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                # Don't leave half a record for the retry to be appended after
+                f.truncate(start)
+                raise
+        self._journal_bytes += len(payload)
+        if self._journal_bytes >= JOURNAL_COMPACT_BYTES:
+            self._start_compaction()
+        return len(payload)
+
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        if not os.path.exists(self.old_journal_path):
+            if not os.path.exists(self.journal_path):
+                return
+            os.replace(self.journal_path, self.old_journal_path)
+            self._journal_bytes = 0
+        self._compactor = threading.Thread(target=self._compact, name="journal-compactor", daemon=True)
+        self._compactor.start()
+
+    def _compact(self):
+        # Only touches the snapshot and the rotated journal, so appends to the
+        # live journal can carry on while this runs.
+        try:
+            data, seq = self._read_snapshot()
+            seq = self._replay(self.old_journal_path, data, seq)
+            write_file_atomic(self.snapshot_path, self.codec.encode({"seq": seq, "data": data}))
+            os.remove(self.old_journal_path)
+        except Exception as e:
+            print(f"⚠️ Journal compaction failed: {e}")
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+
+class SqliteStorage:
+    """SQLite database in WAL mode.
+
+    Towns and nations are stored as JSON blobs next to indexed owner, leader
+    and membership columns. A flush is applied in one transaction, so
+    changes that touch several records (both sides of a war, a town joining
+    a nation) are saved together or not at all. The SQL below is constant
+    text, so sqlite3's statement cache prepares each query only once.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS towns (
+            name TEXT PRIMARY KEY,
+            owner_id INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS towns_owner ON towns (owner_id);
+        CREATE TABLE IF NOT EXISTS town_members (
+            town TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (town, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS town_members_user ON town_members (user_id);
+        CREATE TABLE IF NOT EXISTS nations (
+            name TEXT PRIMARY KEY,
+            leader_id INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS nations_leader ON nations (leader_id);
+        CREATE TABLE IF NOT EXISTS nation_towns (
+            nation TEXT NOT NULL,
+            town TEXT NOT NULL,
+            PRIMARY KEY (nation, town)
+        );
+        CREATE INDEX IF NOT EXISTS nation_towns_town ON nation_towns (town);
+        CREATE TABLE IF NOT EXISTS records (
+            collection TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (collection, key)
+        );
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        # Writes happen in worker threads, one flush at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.loaded_bytes = 0
+
+    def load(self):
+        loaded = 0
+        result = {"towns": {}, "nations": {}}
+        for table in ("towns", "nations"):
+            for name, data in self.conn.execute(f"SELECT name, data FROM {table}"):
+                result[table][name] = json.loads(data)
+                loaded += len(data)
+        for name in EXTRA_COLLECTIONS:
+            result[name] = {}
+        for collection, key, data in self.conn.execute("SELECT collection, key, data FROM records"):
+            result.setdefault(collection, {})[key] = json.loads(data)
+            loaded += len(data)
+        self.loaded_bytes = loaded
+        return result
+
+    def encode(self, state, changes):
+        payload = {"towns": [], "nations": [], "records": []}
+        for name in changes.get("towns", ()):
+            town = state.towns.get(name)
+            if town is None:
+                payload["towns"].append((name, None))
+            else:
+                payload["towns"].append((name, (town["owner_id"], json.dumps(town), list(town["members"]))))
+        for name in changes.get("nations", ()):
+            nation = state.nations.get(name)
+            if nation is None:
+                payload["nations"].append((name, None))
+            else:
+                payload["nations"].append((name, (nation["leader_id"], json.dumps(nation), list(nation["member_towns"]))))
+        for collection, keys in changes.items():
+            if collection in ("towns", "nations"):
+                continue
+            records = getattr(state, collection)
+            for key in keys:
+                record = records.get(key)
+                payload["records"].append((collection, key, None if record is None else json.dumps(record)))
+        return payload
+
+    def write(self, payload):
+        town_names = [(name,) for name, _ in payload["towns"]]
+        town_rows = [(name, row[0], row[1]) for name, row in payload["towns"] if row is not None]
+        member_rows = [(name, user_id) for name, row in payload["towns"] if row is not None for user_id in row[2]]
+        nation_names = [(name,) for name, _ in payload["nations"]]
+        nation_rows = [(name, row[0], row[1]) for name, row in payload["nations"] if row is not None]
+        nation_town_rows = [(name, town) for name, row in payload["nations"] if row is not None for town in row[2]]
+        record_keys = [(collection, key) for collection, key, _ in payload["records"]]
+        record_rows = [row for row in payload["records"] if row[2] is not None]
+
+        with self.conn:  # one transaction for the whole flush
+            self.conn.executemany("DELETE FROM towns WHERE name = ?", town_names)
+            self.conn.executemany("DELETE FROM town_members WHERE town = ?", town_names)
+            self.conn.executemany("INSERT INTO towns (name, owner_id, data) VALUES (?, ?, ?)", town_rows)
+            self.conn.executemany("INSERT OR IGNORE INTO town_members (town, user_id) VALUES (?, ?)", member_rows)
+            self.conn.executemany("DELETE FROM nations WHERE name = ?", nation_names)
+            self.conn.executemany("DELETE FROM nation_towns WHERE nation = ?", nation_names)
+            self.conn.executemany("INSERT INTO nations (name, leader_id, data) VALUES (?, ?, ?)", nation_rows)
+            self.conn.executemany("INSERT OR IGNORE INTO nation_towns (nation, town) VALUES (?, ?)", nation_town_rows)
+            self.conn.executemany("DELETE FROM records WHERE collection = ? AND key = ?", record_keys)
+            self.conn.executemany("INSERT INTO records (collection, key, data) VALUES (?, ?, ?)", record_rows)
+            self._written(payload)
+        # Record bytes only; SQLite's own page and WAL writes aren't visible from here
+        return sum(len(row[2]) for row in town_rows + nation_rows + record_rows)
+
+    def _written(self, payload):
+        # Hook for SharedSqliteStorage, inside the write transaction
+        pass
+
+    def close(self):
+        self.conn.close()
+
+class SharedSqliteStorage(SqliteStorage):
+    """The SQLite store shared by several shard processes.
+
+    Every write also appends the changed keys to a ``changes`` table, in
+    the same transaction. Each process polls that table for changes made
+    by the others and reloads those records into its in-memory copy. A
+    locked command section runs inside BEGIN IMMEDIATE (see
+    WorldState.transaction), which makes the sections of all processes
+    take turns and lets each one catch up before it checks anything.
+    """
+
+    CHANGES_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            collection TEXT NOT NULL,
+            key TEXT NOT NULL,
+            origin TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        super().__init__(path)
+        self.conn.executescript(self.CHANGES_SCHEMA)
+        self.origin = os.urandom(8).hex()  # tells our own changes apart from other processes'
+        self.seq = 0  # last change this process has seen
+
+    def load(self):
+        # Read the position first: anything committed after it gets replayed
+        self.seq = self._last_seq()
+        return super().load()
+
+    def _last_seq(self):
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def begin(self):
+        # Waits (up to the connection timeout) for other processes' sections
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self.conn.commit()
+
+    def _written(self, payload):
+        keys = [("towns", name) for name, _ in payload["towns"]]
+        keys += [("nations", name) for name, _ in payload["nations"]]
+        keys += [(collection, key) for collection, key, _ in payload["records"]]
+        self.conn.executemany(
+            "INSERT INTO changes (collection, key, origin) VALUES (?, ?, ?)",
+            [(collection, key, self.origin) for collection, key in keys],
+        )
+        self.conn.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (SHARED_CHANGES_KEPT,))
+
+    def changes(self):
+        # Records other processes changed since we last looked, as
+        # (collection, key, value or None if deleted). None means we fell
+        # further behind than the change log goes back; reload everything.
+        rows = self.conn.execute(
+            "SELECT seq, collection, key, origin FROM changes WHERE seq > ? ORDER BY seq", (self.seq,)
+        ).fetchall()
+        if not rows:
+            return []
+        oldest = self.conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        if oldest > self.seq + 1 and self.seq != 0:
+            self.seq = rows[-1][0]
+            return None
+        self.seq = rows[-1][0]
+        changed = dict.fromkeys((collection, key) for _, collection, key, origin in rows if origin != self.origin)
+        result = []
+        for collection, key in changed:
+            if collection in ("towns", "nations"):
+                row = self.conn.execute(f"SELECT data FROM {collection} WHERE name = ?", (key,)).fetchone()
+            else:
+                row = self.conn.execute("SELECT data FROM records WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+            result.append((collection, key, json.loads(row[0]) if row else None))
+        return result
+
+def make_storage(mode):
+    if mode == "json":
+        return JsonStorage(make_codec(STATE_CODEC))
+    if mode == "journal":
+        return JournalStorage(codec=make_codec(STATE_CODEC))
+    if mode == "sqlite":
+        return SqliteStorage()
+    if mode == "shared":
+        return SharedSqliteStorage()
+    raise ValueError(f"Unknown storage mode {mode!r}")
+
+def import_json_to_sqlite(path=SQLITE_PATH):
+    # One-shot migration: copy the JSON state files (towns, nations and every
+    # EXTRA_COLLECTIONS file) into the SQLite database in one transaction.
+    # Existing rows with the same names are replaced.
+    data = load_state_files()
+    storage = SqliteStorage(path)
+    state = WorldState(storage)
+    for collection, records in data.items():
+        setattr(state, collection, records)
+    payload = storage.encode(state, {collection: set(records) for collection, records in data.items()})
+    storage.write(payload)
+    storage.close()
+    return len(data["towns"]), len(data["nations"])
+
+class NameIndex:
+    """Case-insensitive index over town or nation names for autocomplete.
+
+    Names are kept sorted (casefolded) for prefix lookups by binary search,
+    plus a trigram map so a typo'd middle-of-name fragment still finds
+    candidates without scanning every name.
+    """
+
+    def __init__(self, names=()):
+        self._sorted = sorted((name.casefold(), name) for name in names)
+        self._trigrams = collections.defaultdict(set)
+        for folded, name in self._sorted:
+            for gram in self._grams(folded):
+                self._trigrams[gram].add(name)
+
+    @staticmethod
+    def _grams(folded):
+        return {folded[i:i + 3] for i in range(len(folded) - 2)}
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def __iter__(self):
+        return (name for _, name in self._sorted)
+
+    def add(self, name):
+        folded = name.casefold()
+        bisect.insort(self._sorted, (folded, name))
+        for gram in self._grams(folded):
+            self._trigrams[gram].add(name)
+
+    def remove(self, name):
+        folded = name.casefold()
+        i = bisect.bisect_left(self._sorted, (folded, name))
+        if i < len(self._sorted) and self._sorted[i][1] == name:
+            del self._sorted[i]
+        for gram in self._grams(folded):
+            names = self._trigrams.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._trigrams[gram]
+
+    def page(self, start, count):
+        # Names start..start+count in alphabetical order, without walking the rest
+        return [name for _, name in self._sorted[start:start + count]]
+
+    def search(self, text, limit=25, allow=None):
+        # Prefix matches first, then names containing the text anywhere.
+        # allow is an optional predicate for names the caller may pick.
+        folded = text.casefold()
+        results = []
+        i = bisect.bisect_left(self._sorted, (folded, ""))
+        while i < len(self._sorted) and len(results) < limit:
+            key, name = self._sorted[i]
+            if not key.startswith(folded):
+                break
+            if allow is None or allow(name):
+                results.append(name)
+            i += 1
+
+        grams = self._grams(folded)
+        if len(results) < limit and grams:
+            # Any match has to contain every trigram, so the rarest one is
+            # enough to get the candidates; the substring test does the rest
+            candidates = min((self._trigrams.get(gram, ()) for gram in grams), key=len)
+            seen = set(results)
+            matches = (
+                name for name in candidates
+                if name not in seen and folded in name.casefold() and (allow is None or allow(name))
+            )
+            results.extend(heapq.nsmallest(limit - len(results), matches, key=str.casefold))
+        return results
+
+class Ranking:
+    """Names ordered by a numeric score, highest first (ties by name).
+
+    A sorted list kept up to date with bisect, so the top k is a slice and
+    a single rank is a binary search. ``version`` changes whenever the
+    order or a score does (and is never reused, even by a rebuilt
+    ranking), for caching anything rendered from it.
+    """
+
+    _versions = itertools.count()
+
+    def __init__(self, scores=()):
+        self.scores = dict(scores)
+        self._order = sorted((-score, name) for name, score in self.scores.items())
+        self.version = next(self._versions)
+
+    def __len__(self):
+        return len(self._order)
+
+    def set(self, name, score):
+        old = self.scores.get(name)
+        if old == score:
+            return
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (-old, name))]
+        self.scores[name] = score
+        bisect.insort(self._order, (-score, name))
+        self.version = next(self._versions)
+
+    def remove(self, name):
+        old = self.scores.pop(name, None)
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (-old, name))]
+            self.version = next(self._versions)
+
+    def top(self, k):
+        return [(name, -score) for score, name in self._order[:k]]
+
+    def rank(self, name):
+        # 1-based position, or None if not ranked
+        score = self.scores.get(name)
+        if score is None:
+            return None
+        return bisect.bisect_left(self._order, (-score, name)) + 1
+
+class WorldState:
+    """The single in-memory copy of towns and nations.
+
+    Membership, ownership and leadership changes go through the mutation
+    methods so the lookup indexes stay correct; anything else is edited in
+    place followed by ``mark_dirty``. A background task writes the changes
+    out every STATE_FLUSH_INTERVAL seconds, sooner once STATE_FLUSH_BATCH
+    records are dirty, and once more on shutdown.
+    """
+
+    _versions = itertools.count()
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.towns = {}
+        self.nations = {}
+        self.outbox = {}  # announcement id -> DMs still to deliver
+        self.wars = {}    # war id -> town or nation war, ended ones included
+        self.timers = {}  # timer id -> timer, see Scheduler
+        # Lookup indexes, kept in sync by the mutation methods below
+        self.member_town = {}    # user id -> town they are a member of
+        self.owner_town = {}     # user id -> town they own
+        self.leader_nation = {}  # user id -> nation they lead
+        self.town_nation = {}    # town name -> nation it belongs to
+        self.town_by_role = {}   # town role id -> town name (button custom_ids use role ids)
+        self.nation_by_role = {} # nation role id -> nation name
+        self.pending_requests = {}  # (town name, user id) -> True for open join requests
+        self.town_names = NameIndex()    # for autocomplete
+        self.nation_names = NameIndex()
+        self.war_by_side = {}  # (kind, name) -> id of the war it is in, until the war ends
+        self.live_wars = {}    # (kind, status) -> {war id: war} for wars that haven't ended
+        self._war_seq = 0      # highest war id handed out
+        # Per-record versions for caching anything rendered from a town or
+        # nation; records untouched since loading share base_version
+        self.versions = {}  # (collection, name) -> version
+        self.base_version = next(self._versions)
+        self.epoch = os.urandom(4).hex()  # versions only compare within one run
+        # Leaderboards, kept up to date by the mutation methods below
+        self.town_sizes = Ranking()           # town -> members
+        self.nation_town_counts = Ranking()   # nation -> towns
+        self.nation_member_totals = Ranking() # nation -> members across its towns
+        self._dirty = {}  # collection -> set of keys changed since last flush
+        self._dirty_count = 0
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.shared = isinstance(storage, SharedSqliteStorage)
+        self._sync_task = None
+        # I/O accounting for /botstats
+        self.load_seconds = 0.0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flush_seconds = 0.0
+        self.records_written = 0
+        self.bytes_written = 0
+
+    def load(self):
+        start = time.perf_counter()
+        data = self.storage.load()
+        self.load_seconds = time.perf_counter() - start
+        self.towns = data["towns"]
+        self.nations = data["nations"]
+        for name in EXTRA_COLLECTIONS:
+            setattr(self, name, data.get(name, {}))
+        self._migrate_wars()
+        self._migrate_invites()
+        self.rebuild_indexes()
+
+    def _migrate_wars(self):
+        # Wars used to be war_* fields on both towns or nations; turn every
+        # pair that still points at each other into a registry entry
+        now = time.time()
+        self._war_seq = max(map(int, self.wars), default=0)
+        for kind, records, field in (("town", self.towns, "war_declared"), ("nation", self.nations, "war_target")):
+            legacy = {}
+            for name, record in records.items():
+                if "war_status" in record or field in record:
+                    legacy[name] = (record.pop("war_status", None), record.pop(field, None))
+                    self.mark_dirty(kind + "s", name)
+            for name, (status, target) in legacy.items():
+                if not status or target not in legacy or legacy[target][1] != name or target < name:
+                    continue
+                statuses = {name: status, target: legacy[target][0]}
+                if "pending" in statuses.values():
+                    status = "pending"
+                elif "ceasefire_requested" in statuses.values():
+                    status = "ceasefire_requested"
+                else:
+                    status = "active"
+                self._war_seq += 1
+                war = {
+                    "id": str(self._war_seq), "kind": kind, "attacker": name, "defender": target,
+                    "status": status, "history": [{"status": status, "at": now, "reason": "migrated"}],
+                }
+                if status == "ceasefire_requested":
+                    war["ceasefire_by"] = next(side for side, s in statuses.items() if s == "ceasefire_requested")
+                self.wars[war["id"]] = war
+                self.mark_dirty("wars", war["id"])
+
+    def _migrate_invites(self):
+        # Invites sent before they were recorded have no entry to claim.
+        # Remember when recording started so their buttons still work until
+        # they would have expired (see legacy_invite_open).
+        now = time.time()
+        for name, nation in self.nations.items():
+            if "invites" not in nation:
+                nation["invites"] = []
+                nation["invites_recorded_since"] = now
+                self.mark_dirty("nations", name)
+
+    # --- Indexes ---
+    def _build_indexes(self):
+        member_town, owner_town, leader_nation, town_nation = {}, {}, {}, {}
+        town_by_role, nation_by_role, pending_requests = {}, {}, {}
+        for name, town in self.towns.items():
+            owner_town[town["owner_id"]] = name
+            town_by_role[town["role_id"]] = name
+            for user_id in town["members"]:
+                member_town[user_id] = name
+            for user_id in town.get("pending", ()):
+                pending_requests[(name, user_id)] = True
+        for name, nation in self.nations.items():
+            leader_nation[nation["leader_id"]] = name
+            nation_by_role[nation["role_id"]] = name
+            for town_name in nation["member_towns"]:
+                town_nation[town_name] = name
+        war_by_side, live_wars = {}, {}
+        for war_id, war in self.wars.items():
+            if war["status"] != "ended":
+                war_by_side[(war["kind"], war["attacker"])] = war_id
+                war_by_side[(war["kind"], war["defender"])] = war_id
+                live_wars.setdefault((war["kind"], war["status"]), {})[war_id] = war
+        return {
+            "member_town": member_town,
+            "owner_town": owner_town,
+            "leader_nation": leader_nation,
+            "town_nation": town_nation,
+            "town_by_role": town_by_role,
+            "nation_by_role": nation_by_role,
+            "pending_requests": pending_requests,
+            "war_by_side": war_by_side,
+            "live_wars": live_wars,
+        }
+
+    def rebuild_indexes(self):
+        for attr, index in self._build_indexes().items():
+            setattr(self, attr, index)
+        self.town_names = NameIndex(self.towns)
+        self.nation_names = NameIndex(self.nations)
+        self._war_seq = max(self._war_seq, max(map(int, self.wars), default=0))
+        self.town_sizes, self.nation_town_counts, self.nation_member_totals = (
+            Ranking(scores) for scores in self._build_rankings()
+        )
+
+    def _build_rankings(self):
+        town_sizes = {name: len(town["members"]) for name, town in self.towns.items()}
+        town_counts = {name: len(nation["member_towns"]) for name, nation in self.nations.items()}
+        member_totals = {name: self._nation_members(nation) for name, nation in self.nations.items()}
+        return town_sizes, town_counts, member_totals
+
+    def _nation_members(self, nation):
+        # Towns that were deleted stay listed in member_towns; they count as empty
+        return sum(len(self.towns[town_name]["members"]) for town_name in nation["member_towns"] if town_name in self.towns)
+
+    def _rank_town(self, name):
+        # A town's size changed (or it came or went): update it and its nation
+        town = self.towns.get(name)
+        if town is None:
+            self.town_sizes.remove(name)
+        else:
+            self.town_sizes.set(name, len(town["members"]))
+        nation_name = self.town_nation.get(name)
+        if nation_name is not None:
+            self._rank_nation(nation_name)
+
+    def _rank_nation(self, name):
+        nation = self.nations.get(name)
+        if nation is None:
+            self.nation_town_counts.remove(name)
+            self.nation_member_totals.remove(name)
+        else:
+            self.nation_town_counts.set(name, len(nation["member_towns"]))
+            self.nation_member_totals.set(name, self._nation_members(nation))
+
+    def check_indexes(self, repair=False):
+        # Compare the live indexes against ones rebuilt from the raw data.
+        # Returns a list of human readable problems (empty means consistent).
+        problems = []
+        for attr, expected in self._build_indexes().items():
+            actual = getattr(self, attr)
+            for key in expected.keys() | actual.keys():
+                if expected.get(key) != actual.get(key):
+                    problems.append(f"{attr}[{key!r}]: have {actual.get(key)!r}, expected {expected.get(key)!r}")
+        for attr, records in (("town_names", self.towns), ("nation_names", self.nations)):
+            indexed = set(getattr(self, attr))
+            for name in indexed.symmetric_difference(records):
+                problems.append(f"{attr}: {name!r} is {'indexed but missing' if name in indexed else 'not indexed'}")
+        rankings = (self.town_sizes, self.nation_town_counts, self.nation_member_totals)
+        for label, ranking, expected in zip(("town_sizes", "nation_town_counts", "nation_member_totals"), rankings, self._build_rankings()):
+            for name in expected.keys() | ranking.scores.keys():
+                if expected.get(name) != ranking.scores.get(name):
+                    problems.append(f"{label}[{name!r}]: have {ranking.scores.get(name)!r}, expected {expected.get(name)!r}")
+        if problems and repair:
+            self.rebuild_indexes()
+        return problems
+
+    # --- Town mutations ---
+    def create_town(self, name, town):
+        if name not in self.towns:
+            self.town_names.add(name)
+        self.towns[name] = town
+        self.owner_town[town["owner_id"]] = name
+        self.town_by_role[town["role_id"]] = name
+        for user_id in town["members"]:
+            self.member_town[user_id] = name
+        for user_id in town.get("pending", ()):
+            self.pending_requests[(name, user_id)] = True
+        self._rank_town(name)
+        self.mark_dirty("towns", name)
+
+    def delete_town(self, name):
+        town = self.towns.pop(name)
+        self.town_names.remove(name)
+        if self.owner_town.get(town["owner_id"]) == name:
+            del self.owner_town[town["owner_id"]]
+        if self.town_by_role.get(town["role_id"]) == name:
+            del self.town_by_role[town["role_id"]]
+        for user_id in town["members"]:
+            if self.member_town.get(user_id) == name:
+                del self.member_town[user_id]
+        for user_id in town.get("pending", ()):
+            self.pending_requests.pop((name, user_id), None)
+        self._rank_town(name)
+        self.mark_dirty("towns", name)
+        return town
+
+    def add_member(self, town_name, user_id):
+        members = self.towns[town_name]["members"]
+        if user_id not in members:
+            members.append(user_id)
+        self.member_town[user_id] = town_name
+        self._rank_town(town_name)
+        self.mark_dirty("towns", town_name)
+
+    def remove_member(self, town_name, user_id):
+        self.towns[town_name]["members"].remove(user_id)
+        if self.member_town.get(user_id) == town_name:
+            del self.member_town[user_id]
+        self._rank_town(town_name)
+        self.mark_dirty("towns", town_name)
+
+    def add_pending(self, town_name, user_id):
+        # Returns False if the user already has a request in for this town
+        if (town_name, user_id) in self.pending_requests:
+            return False
+        self.towns[town_name]["pending"].append(user_id)
+        self.pending_requests[(town_name, user_id)] = True
+        self.mark_dirty("towns", town_name)
+        return True
+
+    def remove_pending(self, town_name, user_id):
+        # Returns False if the request was already gone (answered elsewhere)
+        if self.pending_requests.pop((town_name, user_id), None) is None:
+            return False
+        self.towns[town_name]["pending"].remove(user_id)
+        self.mark_dirty("towns", town_name)
+        return True
+
+    def set_town_owner(self, town_name, user_id):
+        town = self.towns[town_name]
+        if self.owner_town.get(town["owner_id"]) == town_name:
+            del self.owner_town[town["owner_id"]]
+        town["owner_id"] = user_id
+        self.owner_town[user_id] = town_name
+        self.mark_dirty("towns", town_name)
+
+    # --- Nation mutations ---
+    def create_nation(self, name, nation):
+        if name not in self.nations:
+            self.nation_names.add(name)
+        self.nations[name] = nation
+        self.leader_nation[nation["leader_id"]] = name
+        self.nation_by_role[nation["role_id"]] = name
+        for town_name in nation["member_towns"]:
+            self.town_nation[town_name] = name
+            self.touch("towns", town_name)
+        self._rank_nation(name)
+        self.mark_dirty("nations", name)
+
+    def disband_nation(self, name):
+        nation = self.nations.pop(name)
+        self.nation_names.remove(name)
+        if self.leader_nation.get(nation["leader_id"]) == name:
+            del self.leader_nation[nation["leader_id"]]
+        if self.nation_by_role.get(nation["role_id"]) == name:
+            del self.nation_by_role[nation["role_id"]]
+        for town_name in nation["member_towns"]:
+            if self.town_nation.get(town_name) == name:
+                del self.town_nation[town_name]
+                self.touch("towns", town_name)
+        self._rank_nation(name)
+        self.mark_dirty("nations", name)
+        return nation
+
+    def add_nation_town(self, nation_name, town_name):
+        member_towns = self.nations[nation_name]["member_towns"]
+        if town_name not in member_towns:
+            member_towns.append(town_name)
+        self.town_nation[town_name] = nation_name
+        self.touch("towns", town_name)
+        self._rank_nation(nation_name)
+        self.mark_dirty("nations", nation_name)
+
+    def remove_nation_town(self, nation_name, town_name):
+        self.nations[nation_name]["member_towns"].remove(town_name)
+        if self.town_nation.get(town_name) == nation_name:
+            del self.town_nation[town_name]
+        self.touch("towns", town_name)
+        self._rank_nation(nation_name)
+        self.mark_dirty("nations", nation_name)
+
+    def add_invite(self, nation_name, town_role_id):
+        # Open invitations are kept by town role id, like the buttons that answer them
+        invites = self.nations[nation_name].setdefault("invites", [])
+        if town_role_id not in invites:
+            invites.append(town_role_id)
+        self.mark_dirty("nations", nation_name)
+
+    def remove_invite(self, nation_name, town_role_id):
+        # Returns False if the invitation was already gone (answered or expired)
+        nation = self.nations.get(nation_name)
+        if nation is None or town_role_id not in nation.get("invites", ()):
+            return False
+        nation["invites"].remove(town_role_id)
+        self.mark_dirty("nations", nation_name)
+        return True
+
+    def set_nation_leader(self, nation_name, user_id):
+        nation = self.nations[nation_name]
+        if self.leader_nation.get(nation["leader_id"]) == nation_name:
+            del self.leader_nation[nation["leader_id"]]
+        nation["leader_id"] = user_id
+        self.leader_nation[user_id] = nation_name
+        self.mark_dirty("nations", nation_name)
+
+    def set_nation_capital(self, nation_name, town_name):
+        self.nations[nation_name]["capital_town"] = town_name
+        self.mark_dirty("nations", nation_name)
+
+    # --- Wars ---
+    def _index_war(self, war):
+        if war["status"] == "ended":
+            return
+        for side in (war["attacker"], war["defender"]):
+            self.war_by_side[(war["kind"], side)] = war["id"]
+        self.live_wars.setdefault((war["kind"], war["status"]), {})[war["id"]] = war
+
+    def _unindex_war(self, war):
+        for side in (war["attacker"], war["defender"]):
+            if self.war_by_side.get((war["kind"], side)) == war["id"]:
+                del self.war_by_side[(war["kind"], side)]
+        key = (war["kind"], war["status"])
+        wars = self.live_wars.get(key)
+        if wars is not None:
+            wars.pop(war["id"], None)
+            if not wars:
+                del self.live_wars[key]
+
+    def war_of(self, kind, name):
+        # The war a town or nation is in right now, or None
+        war_id = self.war_by_side.get((kind, name))
+        return self.wars[war_id] if war_id is not None else None
+
+    def wars_in(self, kind, *statuses):
+        # Wars of one kind in the given states, without looking at any others
+        for status in statuses:
+            yield from self.live_wars.get((kind, status), {}).values()
+
+    def declare_war(self, kind, attacker, defender):
+        # Caller checks neither side is already at war
+        self._war_seq += 1
+        war = {
+            "id": str(self._war_seq), "kind": kind, "attacker": attacker, "defender": defender,
+            "status": "pending", "history": [{"status": "pending", "at": time.time(), "by": attacker}],
+        }
+        self.wars[war["id"]] = war
+        self._index_war(war)
+        self.mark_dirty("wars", war["id"])
+        return war
+
+    def set_war_status(self, war, status, by=None, reason=None):
+        if status not in WAR_TRANSITIONS.get(war["status"], ()):
+            raise ValueError(f"war {war['id']} can't go from {war['status']} to {status}")
+        self._unindex_war(war)
+        war["status"] = status
+        entry = {"status": status, "at": time.time()}
+        if by is not None:
+            entry["by"] = by
+        if reason is not None:
+            entry["reason"] = reason
+        war["history"].append(entry)
+        self._index_war(war)
+        self.mark_dirty("wars", war["id"])
+
+    # --- Persistence ---
+
+    def touch(self, collection, key):
+        # Something shown for this record changed, whether or not it was the record itself
+        self.versions[(collection, key)] = next(self._versions)
+
+    def version(self, collection, key):
+        return self.versions.get((collection, key), self.base_version)
+
+    def checkpoint(self):
+        # Marks this moment: anything changed afterwards gets a higher version
+        return f"{self.epoch}:{next(self._versions)}"
+
+    def changed_since(self, checkpoint):
+        # collection -> keys of records changed (or deleted) after checkpoint;
+        # None if the checkpoint is from before the last restart
+        epoch, _, version = checkpoint.partition(":")
+        if epoch != self.epoch:
+            return None
+        changed = {}
+        for (collection, key), record_version in self.versions.items():
+            if record_version > int(version):
+                changed.setdefault(collection, []).append(key)
+        return changed
+
+    def mark_dirty(self, collection, key):
+        if collection in BACKUP_COLLECTIONS:
+            self.touch(collection, key)
+        keys = self._dirty.setdefault(collection, set())
+        if key not in keys:
+            keys.add(key)
+            self._dirty_count += 1
+        if self._dirty_count >= STATE_FLUSH_BATCH:
+            self._wake.set()
+
+    @property
+    def dirty(self):
+        return self._dirty_count > 0
+
+    async def flush(self):
+        async with self._flush_lock:
+            await self._write_locked()
+
+    async def _write_locked(self):
+        if not self._dirty:
+            if self.shared and self.storage.conn.in_transaction:
+                await asyncio.to_thread(self.storage.commit)
+            return
+        changes = self._dirty
+        self._dirty = {}
+        self._dirty_count = 0
+        start = time.perf_counter()
+        try:
+            payload = self.storage.encode(self, changes)
+            written = await asyncio.to_thread(self.storage.write, payload)
+        except Exception:
+            self.flush_errors += 1
+            # Put the keys back so the next flush retries them
+            for collection, keys in changes.items():
+                for key in keys:
+                    self.mark_dirty(collection, key)
+            raise
+        self.flushes += 1
+        self.flush_seconds += time.perf_counter() - start
+        self.records_written += sum(len(keys) for keys in changes.values())
+        self.bytes_written += written
+
+    # --- Sharing between processes ---
+    def apply_remote(self, collection, key, value):
+        # Another process changed this record; swap in its version and fix
+        # the indexes through the normal mutators
+        if collection == "towns":
+            if key in self.towns:
+                self.delete_town(key)
+            if value is not None:
+                self.create_town(key, value)
+        elif collection == "nations":
+            if key in self.nations:
+                self.disband_nation(key)
+            if value is not None:
+                self.create_nation(key, value)
+        elif collection == "wars":
+            if key in self.wars:
+                self._unindex_war(self.wars.pop(key))
+            if value is not None:
+                self.wars[key] = value
+                self._index_war(value)
+                self._war_seq = max(self._war_seq, int(key))
+            self.touch("wars", key)
+        else:
+            records = getattr(self, collection)
+            if value is None:
+                records.pop(key, None)
+            else:
+                records[key] = value
+        # That's the stored version already, nothing to write back
+        keys = self._dirty.get(collection)
+        if keys is not None and key in keys:
+            keys.discard(key)
+            self._dirty_count -= 1
+            if not keys:
+                del self._dirty[collection]
+
+    async def _catch_up(self):
+        # Caller holds _flush_lock
+        changes = await asyncio.to_thread(self.storage.changes)
+        if changes is None:
+            print("⚠️ Fell behind the shared change log; reloading all state.")
+            data = await asyncio.to_thread(self.storage.load)
+            changes = []
+            for collection in ("towns", "nations") + EXTRA_COLLECTIONS:
+                stored = data.get(collection, {})
+                changes += [(collection, key, value) for key, value in stored.items()]
+                changes += [(collection, key, None) for key in getattr(self, collection) if key not in stored]
+        for collection, key, value in changes:
+            if key not in self._dirty.get(collection, ()):  # our unsaved change wins; it gets written next
+                self.apply_remote(collection, key, value)
+
+    async def _run_sync(self):
+        while True:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            try:
+                async with self._flush_lock:
+                    await self._catch_up()
+            except Exception as e:
+                print(f"⚠️ Failed to read shared changes: {e}")
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        # Shared mode only: one locked section at a time across all
+        # processes, starting from the latest state and saved as it ends
+        async with self._flush_lock:
+            await asyncio.to_thread(self.storage.begin)
+            try:
+                await self._catch_up()
+                yield
+            finally:
+                await self._write_locked()
+
+    def stats(self):
+        return {
+            "load_ms": self.load_seconds * 1000,
+            "loaded_bytes": self.storage.loaded_bytes,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "avg_flush_ms": self.flush_seconds / self.flushes * 1000 if self.flushes else 0.0,
+            "flush_seconds": self.flush_seconds,
+            "records_written": self.records_written,
+            "bytes_written": self.bytes_written,
+            "pending_records": self._dirty_count,
+        }
+
+    async def _run_flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=STATE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Failed to save state: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_flusher())
+        if self.shared and self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._run_sync())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        await self.flush()
+        await asyncio.to_thread(self.storage.close)
+
+# --- Backups ---
+BACKUP_DIR = os.getenv("TOWNY_BACKUP_DIR", "backups")
+BACKUP_COLLECTIONS = ("towns", "nations", "wars")
+# Not backed up, and only meaningful against the state they came from: a
+# full restore empties them. setup_hook re-creates the timers from the
+# restored towns, nations and wars (schedule_missing_timers).
+BACKUP_RESET_COLLECTIONS = ("timers", "outbox")
+BACKUP_FORMAT = 1
+BACKUP_CHUNK = 500  # records serialized per turn of the event loop
+
+# A backup is NDJSON: a header line, one line per record
+#   {"type": "record", "collection": ..., "key": ..., "value": ...}
+# and a footer with the record count and the SHA-256 of every line before
+# it. An incremental backup ("since" set) only has the records changed
+# after that checkpoint, with a null value for ones that were deleted.
+
+async def export_ndjson(state, path, since=None):
+    # Streams a backup of the live state to path. Records are serialized on
+    # the event loop a chunk at a time, so each one is consistent, and the
+    # file is written from a worker thread; the loop is never held for long.
+    # Falls back to a full backup if since is from before the last restart.
+    start = time.perf_counter()
+    changed = state.changed_since(since) if since else None
+    full = changed is None
+    checkpoint = state.checkpoint()
+    digest = hashlib.sha256()
+    tmp_path = f"{path}.tmp"
+    f = await asyncio.to_thread(open, tmp_path, "wb")
+
+    def write(lines):
+        data = "".join(lines).encode()
+        digest.update(data)
+        f.write(data)
+        return len(data)
+
+    try:
+        header = {"type": "header", "format": BACKUP_FORMAT, "created_at": time.time(),
+                  "checkpoint": checkpoint, "since": None if full else since, "full": full}
+        size = await asyncio.to_thread(write, [json.dumps(header) + "\n"])
+        count = 0
+        for collection in BACKUP_COLLECTIONS:
+            records = getattr(state, collection)
+            keys = list(records) if full else changed.get(collection, [])
+            for i in range(0, len(keys), BACKUP_CHUNK):
+                lines = []
+                for key in keys[i:i + BACKUP_CHUNK]:
+                    value = records.get(key)
+                    if value is None and full:
+                        continue  # deleted since the key list was taken
+                    lines.append(json.dumps({"type": "record", "collection": collection, "key": key, "value": value}) + "\n")
+                count += len(lines)
+                size += await asyncio.to_thread(write, lines)
+        footer = {"type": "footer", "records": count, "sha256": digest.hexdigest()}
+        size += await asyncio.to_thread(write, [json.dumps(footer) + "\n"])
+
+        def finish():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.replace(tmp_path, path)
+        await asyncio.to_thread(finish)
+    except BaseException:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    return {"path": path, "checkpoint": checkpoint, "full": full, "records": count,
+            "bytes": size, "seconds": time.perf_counter() - start}
+
+def verify_ndjson(path):
+    # Reads a backup through once and returns its header; raises ValueError
+    # if it is truncated or doesn't match its checksum
+    digest = hashlib.sha256()
+    header = None
+    count = 0
+    with open(path, "rb") as f:
+        for line in f:
+            record = json.loads(line)
+            if header is None:
+                if record.get("type") != "header" or record.get("format") != BACKUP_FORMAT:
+                    raise ValueError(f"{path} is not a backup this version can read")
+                header = record
+            elif record["type"] == "footer":
+                if record["records"] != count or record["sha256"] != digest.hexdigest():
+                    raise ValueError(f"{path} is damaged: checksum or record count doesn't match")
+                return header
+            else:
+                count += 1
+            digest.update(line)
+    raise ValueError(f"{path} is incomplete: no footer")
+
+def import_ndjson(paths):
+    # Offline restore, with the bot stopped: a full backup, then any
+    # incremental ones taken after it, in order. Every file is checked
+    # before anything is changed. Returns the number of records applied.
+    headers = [verify_ndjson(path) for path in paths]
+    for path, previous, header in zip(paths[1:], headers, headers[1:]):
+        if header["full"] or header["since"] != previous["checkpoint"]:
+            raise ValueError(f"{path} doesn't follow on from the backup before it")
+    state = WorldState(make_storage(STORAGE_MODE))
+    state.load()
+    applied = 0
+    for path, header in zip(paths, headers):
+        if header["full"]:
+            for collection in BACKUP_COLLECTIONS + BACKUP_RESET_COLLECTIONS:
+                for key in getattr(state, collection):
+                    state.mark_dirty(collection, key)
+                setattr(state, collection, {})
+        with open(path, "rb") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["type"] != "record":
+                    continue
+                collection, key, value = record["collection"], record["key"], record["value"]
+                if value is None:
+                    getattr(state, collection).pop(key, None)
+                else:
+                    getattr(state, collection)[key] = value
+                state.mark_dirty(collection, key)
+                applied += 1
+    asyncio.run(state.close())
+    return applied
+
+class Backups:
+    """Live backups for /backup, one at a time.
+
+    Remembers the checkpoint of the last backup so the next one can be
+    incremental; after a restart the first backup is always full.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._lock = asyncio.Lock()
+        self.last_checkpoint = None
+
+    async def run(self, incremental=False):
+        async with self._lock:
+            await asyncio.to_thread(os.makedirs, BACKUP_DIR, exist_ok=True)
+            path = os.path.join(BACKUP_DIR, f"towny-{time.strftime('%Y%m%d-%H%M%S')}.ndjson")
+            since = self.last_checkpoint if incremental else None
+            result = await export_ndjson(self.bot.state, path, since)
+            self.last_checkpoint = result["checkpoint"]
+            return result
+
+# --- Locks ---
+class LockManager:
+    """Async locks keyed by town and nation name.
+
+    A command takes the locks for every record it is about to check and
+    change. Keys are always acquired in the same order (nations, then towns,
+    each by name) so two commands can never deadlock on each other. Locks
+    cover only the state check and update: Discord calls happen before or
+    after, never while a lock is held. With shared storage the section
+    also runs inside ``transaction`` so other shard processes stay out.
+    """
+
+    def __init__(self, transaction=None):
+        self.transaction = transaction
+        self._locks = {}  # key -> asyncio.Lock
+        self._refs = {}   # key -> number of commands holding or waiting on it
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.hot_keys = collections.Counter()
+
+    def _ref(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._refs[key] = self._refs.get(key, 0) + 1
+        return lock
+
+    def _unref(self, key):
+        self._refs[key] -= 1
+        if self._refs[key] == 0:
+            del self._refs[key]
+            del self._locks[key]
+
+    async def _acquire(self, key, lock):
+        if not lock.locked():
+            await lock.acquire()
+        else:
+            self.contended += 1
+            self.hot_keys[key] += 1
+            start = time.perf_counter()
+            await lock.acquire()
+            waited = time.perf_counter() - start
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        self.acquisitions += 1
+
+    @contextlib.asynccontextmanager
+    async def hold(self, towns=(), nations=()):
+        keys = sorted(
+            {("nation", name) for name in nations if name is not None}
+            | {("town", name) for name in towns if name is not None}
+        )
+        acquired = []
+        try:
+            for key in keys:
+                lock = self._ref(key)
+                try:
+                    await self._acquire(key, lock)
+                except BaseException:
+                    self._unref(key)
+                    raise
+                acquired.append(key)
+            if self.transaction is None:
+                yield
+            else:
+                async with self.transaction():
+                    yield
+        finally:
+            for key in reversed(acquired):
+                self._locks[key].release()
+                self._unref(key)
+
+    def stats(self):
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "contention_rate": self.contended / self.acquisitions if self.acquisitions else 0.0,
+            "avg_wait_ms": self.total_wait / self.contended * 1000 if self.contended else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "held_or_waiting": len(self._locks),
+            "hot_keys": [(f"{kind}:{name}", count) for (kind, name), count in self.hot_keys.most_common(5)],
+        }
+
+# --- Special Roles ---
+# Roles the bot looks up by name, with what to pass to create_role if missing
+SPECIAL_ROLES = {
+    "Newcomer": {"reason": "Auto-joining role"},
+    "Jail": {"colour": discord.Color.red()},
+}
+
+class SpecialRoles:
+    """Per-guild cache of the Newcomer/Jail role ids.
+
+    A name is looked up in guild.roles once; after that it is a get_role
+    by id. The guild role events keep the cache right when staff create,
+    rename or delete one of these roles by hand. ensure() creates a
+    missing role at most once even if many calls race for it.
+    """
+
+    def __init__(self):
+        self._ids = {}    # (guild_id, name) -> role id, or None if the guild has no such role
+        self._locks = {}  # (guild_id, name) -> asyncio.Lock for creation
+
+    def get(self, guild, name):
+        key = (guild.id, name)
+        if key in self._ids:
+            role_id = self._ids[key]
+            if role_id is None:
+                return None
+            role = guild.get_role(role_id)
+            if role is not None and role.name == name:
+                return role
+        role = discord.utils.get(guild.roles, name=name)
+        self._ids[key] = role.id if role else None
+        return role
+
+    async def ensure(self, guild, name):
+        role = self.get(guild, name)
+        if role is not None:
+            return role
+        key = (guild.id, name)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Someone else may have created it while we waited
+            role = self.get(guild, name)
+            if role is None:
+                role = await guild.create_role(name=name, **SPECIAL_ROLES[name])
+                self._ids[key] = role.id
+        return role
+
+    def role_created(self, role):
+        key = (role.guild.id, role.name)
+        if role.name in SPECIAL_ROLES and self._ids.get(key) is None:
+            self._ids[key] = role.id
+
+    def role_updated(self, before, after):
+        if before.name != after.name:
+            self.role_deleted(before)
+            self.role_created(after)
+
+    def role_deleted(self, role):
+        # Forget it; the next lookup rescans in case a duplicate is still around
+        key = (role.guild.id, role.name)
+        if self._ids.get(key) == role.id:
+            del self._ids[key]
+
+# --- Member Lookup ---
+MEMBER_MISS_TTL = 60.0  # seconds to remember that fetch_member found nobody
+
+class MemberDirectory:
+    """Finds the guild and member behind a DM interaction without scanning.
+
+    Keeps which guilds each user is in, from the member cache at startup
+    and the join/leave events after. fetch_member is only the last resort,
+    and a user it couldn't find is remembered for a minute so repeated
+    clicks don't each cost a REST call.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._guilds_of = {}  # user id -> set of guild ids
+        self._misses = {}     # (guild_id, user_id) -> monotonic time the miss expires
+        self.hits = 0
+        self.fetches = 0
+        self.negative_hits = 0
+
+    def add_guild(self, guild):
+        for member in guild.members:
+            self._guilds_of.setdefault(member.id, set()).add(guild.id)
+
+    def remove_guild(self, guild):
+        for member in guild.members:
+            self.member_left(guild.id, member.id)
+
+    def member_joined(self, guild_id, user_id):
+        self._guilds_of.setdefault(user_id, set()).add(guild_id)
+        self._misses.pop((guild_id, user_id), None)
+
+    def member_left(self, guild_id, user_id):
+        guild_ids = self._guilds_of.get(user_id)
+        if guild_ids is not None:
+            guild_ids.discard(guild_id)
+            if not guild_ids:
+                del self._guilds_of[user_id]
+
+    def guild_for_town(self, town):
+        guild = self.bot.get_guild(town.get("guild_id") or 0)
+        if guild is None:
+            # Towns from before guild_id was saved: use a guild the owner is in
+            for guild_id in self._guilds_of.get(town["owner_id"], ()):
+                guild = self.bot.get_guild(guild_id)
+                if guild is not None:
+                    break
+        return guild
+
+    async def member(self, guild, user_id):
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.hits += 1
+            return member
+        key = (guild.id, user_id)
+        expires = self._misses.get(key)
+        if expires is not None:
+            if time.monotonic() < expires:
+                self.negative_hits += 1
+                return None
+            del self._misses[key]
+        self.fetches += 1
+        try:
+            member = await guild.fetch_member(user_id)
+        except (discord.NotFound, discord.Forbidden):
+            self._misses[key] = time.monotonic() + MEMBER_MISS_TTL
+            return None
+        self.member_joined(guild.id, user_id)
+        return member
+
+# --- User Lookup ---
+USER_CACHE_SIZE = 1000  # fetched users kept around
+USER_CACHE_TTL = 600.0  # seconds before a fetched user is fetched again
+
+class UserCache:
+    """fetch_user with a cache in front.
+
+    Tries the client's own cache, then recently fetched users, and only
+    then REST. Concurrent lookups of the same id share one request.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._users = collections.OrderedDict()  # user id -> (user, expires), least recently used first
+        self._inflight = {}  # user id -> future for the running fetch
+        self.client_hits = 0
+        self.hits = 0
+        self.shared = 0
+        self.fetches = 0
+
+    async def get(self, user_id):
+        # Returns None if Discord has no such user
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.client_hits += 1
+            return user
+
+        cached = self._users.get(user_id)
+        if cached is not None:
+            user, expires = cached
+            if time.monotonic() < expires:
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return user
+            del self._users[user_id]
+
+        future = self._inflight.get(user_id)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = self._inflight[user_id] = asyncio.get_running_loop().create_future()
+        self.fetches += 1
+        try:
+            user = await self.bot.fetch_user(user_id)
+        except discord.NotFound:
+            user = None
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # nobody may be waiting; don't warn about it
+            raise
+        else:
+            self._users[user_id] = (user, time.monotonic() + USER_CACHE_TTL)
+            while len(self._users) > USER_CACHE_SIZE:
+                self._users.popitem(last=False)
+        finally:
+            del self._inflight[user_id]
+        future.set_result(user)
+        return user
+
+    def stats(self):
+        lookups = self.client_hits + self.hits + self.shared + self.fetches
+        return {
+            "lookups": lookups,
+            "client_hits": self.client_hits,
+            "cache_hits": self.hits,
+            "shared_fetches": self.shared,
+            "rest_fetches": self.fetches,
+            "rest_saved_rate": 1 - self.fetches / lookups if lookups else 0.0,
+            "cached": len(self._users),
+        }
+
+# --- Announcements ---
+ANNOUNCE_CONCURRENCY = 5      # DMs in flight at once
+ANNOUNCE_SEND_INTERVAL = 0.2  # seconds between starting two DMs, to stay clear of the global limit
+ANNOUNCE_BATCH = 25           # recipients per saved progress step
+
+class AnnouncementDispatcher:
+    """Delivers announcement DMs in the background.
+
+    Commands defer, hand over the recipient list and return straight away.
+    Each announcement lives in ``state.outbox`` until it is done, with the
+    recipients still to be messaged, so a restart resumes it (a recipient
+    may get a repeat if the bot died mid-batch). discord.py already waits
+    out per-route rate limits; on top of that we cap how many DMs are in
+    flight and space out their start times. The author gets a summary
+    when it finishes, as a follow-up if the interaction is still valid and
+    by DM otherwise.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._tasks = {}
+        self._semaphore = None
+        self._next_slot = 0.0
+
+    def start(self, author_id, guild_id, title, text, recipient_ids, interaction=None):
+        announcement_id = f"{int(time.time() * 1000)}-{author_id}"
+        while announcement_id in self.bot.state.outbox:
+            # Same author twice in one millisecond (a double click)
+            announcement_id += "+"
+        self.bot.state.outbox[announcement_id] = {
+            "author_id": author_id,
+            "guild_id": guild_id,
+            "title": title,
+            "text": text,
+            "pending": list(dict.fromkeys(recipient_ids)),
+            "results": {"sent": 0, "forbidden": 0, "not_found": 0, "failed": 0},
+            "created_at": time.time(),
+            "shards": SHARDS,  # which process sends it, when several share the outbox
+        }
+        self.bot.state.mark_dirty("outbox", announcement_id)
+        self._spawn(announcement_id, interaction)
+        return announcement_id
+
+    def resume(self):
+        # Pick up announcements that were still going when the bot stopped
+        for announcement_id, entry in list(self.bot.state.outbox.items()):
+            if announcement_id not in self._tasks and entry.get("shards", "") == SHARDS:
+                self._spawn(announcement_id, None)
+
+    def _spawn(self, announcement_id, interaction):
+        task = asyncio.create_task(self._run(announcement_id, interaction))
+        self._tasks[announcement_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(announcement_id, None))
+
+    async def _pace(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + ANNOUNCE_SEND_INTERVAL
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _deliver(self, guild, text, user_id):
+        member = guild.get_member(user_id) if guild else None
+        if member is None:
+            return "not_found"
+        async with self._semaphore:
+            await self._pace()
+            try:
+                await member.send(text)
+            except discord.Forbidden:
+                return "forbidden"
+            except discord.NotFound:
+                return "not_found"
+            except discord.HTTPException:
+                return "failed"
+        return "sent"
+
+    async def _run(self, announcement_id, interaction):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(ANNOUNCE_CONCURRENCY)
+        entry = self.bot.state.outbox[announcement_id]
+        guild = self.bot.get_guild(entry["guild_id"])
+        rest_guild.set(entry["guild_id"])  # DM routes don't carry the guild
+
+        while entry["pending"]:
+            batch = entry["pending"][:ANNOUNCE_BATCH]
+            outcomes = await asyncio.gather(*(self._deliver(guild, entry["text"], user_id) for user_id in batch))
+            for outcome in outcomes:
+                entry["results"][outcome] += 1
+            del entry["pending"][:len(batch)]
+            self.bot.state.mark_dirty("outbox", announcement_id)
+
+        del self.bot.state.outbox[announcement_id]
+        self.bot.state.mark_dirty("outbox", announcement_id)
+        await self._report(entry, interaction)
+
+    async def _report(self, entry, interaction):
+        results = entry["results"]
+        summary = f"📬 **{entry['title']}** delivered to {results['sent']} member(s)."
+        if results["forbidden"]:
+            summary += f"\n🔒 {results['forbidden']} have their DMs closed."
+        if results["not_found"]:
+            summary += f"\n👻 {results['not_found']} are no longer in the server."
+        if results["failed"]:
+            summary += f"\n⚠️ {results['failed']} could not be reached because of a Discord error."
+
+        if interaction is not None and not interaction.is_expired():
+            try:
+                return await interaction.followup.send(summary, ephemeral=True)
+            except discord.HTTPException:
+                pass
+        try:
+            author = await self.bot.user_cache.get(entry["author_id"])
+            if author:
+                await author.send(summary)
+        except discord.HTTPException:
+            pass
+
+# --- Jobs ---
+JOB_WORKERS = 3
+JOB_MAX_ATTEMPTS = 4   # tries per Discord call before the job fails
+JOB_RETRY_DELAY = 1.0  # seconds before the first retry, doubled each time
+JOB_HISTORY = 200      # finished jobs kept around for /jobstatus
+
+class Job:
+    def __init__(self, job_id, name, user_id, work, interaction):
+        self.id = job_id
+        self.name = name
+        self.user_id = user_id
+        self.work = work
+        self.interaction = interaction
+        self.status = "queued"  # queued -> running (-> retrying) -> done / failed
+        self.detail = ""
+        self.retries = 0
+        self.created_at = time.time()
+        self.finished_at = None
+
+    async def call(self, func, *args, **kwargs):
+        # Run one Discord call, retrying temporary failures with backoff.
+        # Forbidden and NotFound won't fix themselves, so they fail at once.
+        for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+            try:
+                return await func(*args, **kwargs)
+            except (discord.Forbidden, discord.NotFound):
+                raise
+            except discord.HTTPException as e:
+                if attempt == JOB_MAX_ATTEMPTS:
+                    raise
+                self.retries += 1
+                self.status = "retrying"
+                self.detail = f"{e.status} {e.text or e}".strip()
+                delay = JOB_RETRY_DELAY * 2 ** (attempt - 1)
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+                self.status = "running"
+
+class JobQueue:
+    """Background workers for slow Discord work (roles, mostly).
+
+    A command checks its inputs, defers the interaction and submits a job;
+    the job does the REST calls and returns the message to send as the
+    follow-up. Response time no longer depends on how slow Discord is.
+    """
+
+    def __init__(self):
+        self.jobs = collections.OrderedDict()  # job id -> Job, oldest first
+        self._queue = None
+        self._workers = []
+        self._next_id = 1
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(JOB_WORKERS)]
+
+    def submit(self, name, work, interaction=None):
+        # work is an async function taking the Job and returning the follow-up text
+        job = Job(self._next_id, name, interaction.user.id if interaction else None, work, interaction)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                message = await job.work(job)
+                job.status = "done"
+            except discord.Forbidden:
+                job.status = "failed"
+                message = "❌ I don't have permission to do that. Make sure my bot role is high enough!"
+            except Exception as e:
+                job.status = "failed"
+                message = f"❌ Something went wrong: {e}"
+            job.detail = message or ""
+            job.finished_at = time.time()
+            self._trim()
+
+            try:
+                if job.interaction is not None and message:
+                    await job.interaction.followup.send(message)
+            except discord.HTTPException:
+                pass
+            finally:
+                self._queue.task_done()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    async def close(self):
+        if self._queue is None:
+            return
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+# --- Timers ---
+TIMER_TICK = 1.0    # seconds per slot of the timer wheel
+TIMER_SLOTS = 3600  # slots per turn; timers further out stay put until their turn comes round
+TIMER_BATCH = 100   # due timers of one kind handed to their handler at a time
+
+class Scheduler:
+    """Timers that survive restarts, kept in a hashed timer wheel.
+
+    Timers are saved in the ``timers`` state collection (id -> kind, due
+    time and data), so they persist and reload with everything else. The
+    wheel is an in-memory index over them: one slot per TIMER_TICK,
+    wrapping every TIMER_SLOTS ticks, so scheduling and cancelling are
+    O(1) however many timers there are. Each tick checks one slot and
+    hands the due timers' data to TIMER_HANDLERS[kind] in batches.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._slots = [set() for _ in range(TIMER_SLOTS)]
+        self._slot_of = {}  # timer id -> index of the slot it sits in
+        self._tick = None   # last tick checked
+        self._task = None
+        self.fired = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def _place(self, timer_id, due):
+        # Into the slot of the first tick boundary at or after the due time,
+        # so the timer is due by the time its slot is checked. Overdue
+        # timers go in the next slot up.
+        slot = math.ceil(max(due, time.time()) / TIMER_TICK) % TIMER_SLOTS
+        self._slots[slot].add(timer_id)
+        self._slot_of[timer_id] = slot
+
+    def _unplace(self, timer_id):
+        slot = self._slot_of.pop(timer_id, None)
+        if slot is not None:
+            self._slots[slot].discard(timer_id)
+
+    def schedule(self, timer_id, delay, kind, data):
+        # Replaces any timer with the same id; data must be JSON-friendly
+        due = time.time() + delay
+        self._unplace(timer_id)
+        self.bot.state.timers[timer_id] = {"kind": kind, "due": due, "data": data}
+        self.bot.state.mark_dirty("timers", timer_id)
+        self._place(timer_id, due)
+
+    def cancel(self, timer_id):
+        self._unplace(timer_id)
+        if self.bot.state.timers.pop(timer_id, None) is None:
+            return False
+        self.bot.state.mark_dirty("timers", timer_id)
+        return True
+
+    def start(self):
+        for timer_id, timer in self.bot.state.timers.items():
+            self._place(timer_id, timer["due"])
+        self._tick = int(time.time() // TIMER_TICK) - 1
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TIMER_TICK - time.time() % TIMER_TICK)
+            try:
+                await self._fire_due()
+            except Exception as e:
+                print(f"⚠️ Timer tick failed: {e}")
+
+    async def _fire_due(self):
+        now = time.time()
+        current = int(now // TIMER_TICK)
+        due = collections.defaultdict(list)  # kind -> data of its due timers
+        # After a stall of a whole turn or more, every slot is up once
+        for tick in range(max(self._tick + 1, current - TIMER_SLOTS + 1), current + 1):
+            slot = self._slots[tick % TIMER_SLOTS]
+            for timer_id in list(slot):
+                timer = self.bot.state.timers.get(timer_id)
+                if timer is None:  # cancelled by another shard process
+                    self._unplace(timer_id)
+                elif timer["due"] <= now:
+                    self.cancel(timer_id)
+                    due[timer["kind"]].append(timer["data"])
+        self._tick = current
+        for kind, batch in due.items():
+            handler = TIMER_HANDLERS.get(kind)
+            for start in range(0, len(batch), TIMER_BATCH):
+                chunk = batch[start:start + TIMER_BATCH]
+                try:
+                    await handler(chunk)
+                    self.fired += len(chunk)
+                except Exception as e:
+                    self.failed += len(chunk)
+                    print(f"⚠️ {len(chunk)} {kind} timers failed: {e}")
+
+    def stats(self):
+        return {
+            "timers": len(self),
+            "by_kind": collections.Counter(timer["kind"] for timer in self.bot.state.timers.values()),
+            "fired": self.fired,
+            "failed": self.failed,
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# --- Join Queue ---
+JOIN_ROLE_INTERVAL = 0.25     # seconds between Newcomer role adds when Discord is happy
+JOIN_ROLE_MAX_INTERVAL = 5.0  # slowest we back off to
+JOIN_SLOW_CALL = 1.0          # an add_roles this slow means the library sat out a 429
+JOIN_RATE_WINDOW = 60.0       # seconds of history behind drain_rate
+
+class JoinQueue:
+    """Hands out the Newcomer role to new members one at a time.
+
+    on_member_join only queues the member. A single drainer adds the role
+    at a steady pace and slows down when calls start coming back slowly
+    (discord.py waits out 429s inside the call), then speeds up again.
+    Members who left or already have the role by their turn are skipped.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._pending = {}  # (guild_id, member_id) -> queued at, in join order
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.interval = JOIN_ROLE_INTERVAL
+        self.added = 0
+        self.skipped = 0
+        self.failed = 0
+        self._recent = collections.deque()  # finish times of recent role adds
+
+    def start(self):
+        self._task = asyncio.create_task(self._drain())
+
+    def put(self, member):
+        self._pending.setdefault((member.guild.id, member.id), time.monotonic())
+        self._wakeup.set()
+
+    def discard(self, member):
+        # The member got in some other way (Enter Server button); don't tag them afterwards
+        return self._pending.pop((member.guild.id, member.id), None) is not None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def _drain(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            key = next(iter(self._pending))
+            del self._pending[key]
+            if await self._assign(*key):
+                await asyncio.sleep(self.interval)
+
+    async def _assign(self, guild_id, member_id):
+        # Returns whether a REST call was made
+        guild = self.bot.get_guild(guild_id)
+        member = guild.get_member(member_id) if guild else None
+        if member is None:
+            self.skipped += 1
+            return False
+        try:
+            role = await self.bot.special_roles.ensure(guild, "Newcomer")
+            if role in member.roles:
+                self.skipped += 1
+                return False
+            start = time.monotonic()
+            await member.add_roles(role)
+        except discord.NotFound:
+            self.skipped += 1  # left between the cache check and the call
+            return True
+        except discord.HTTPException:
+            self.failed += 1
+            self.interval = min(JOIN_ROLE_MAX_INTERVAL, self.interval * 2)
+            return True
+        now = time.monotonic()
+        if now - start > JOIN_SLOW_CALL:
+            self.interval = min(JOIN_ROLE_MAX_INTERVAL, self.interval * 2)
+        else:
+            self.interval = max(JOIN_ROLE_INTERVAL, self.interval * 0.9)
+        self.added += 1
+        self._recent.append(now)
+        return True
+
+    def stats(self):
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > JOIN_RATE_WINDOW:
+            self._recent.popleft()
+        oldest = next(iter(self._pending.values()), None)
+        return {
+            "depth": len(self._pending),
+            "oldest_wait_s": now - oldest if oldest is not None else 0.0,
+            "drain_rate_per_min": len(self._recent) * 60 / JOIN_RATE_WINDOW,
+            "interval_s": self.interval,
+            "added": self.added,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# --- Metrics ---
+METRICS_FILE = os.getenv("TOWNY_METRICS_FILE", "metrics.prom")  # Prometheus text format, for node_exporter's textfile collector
+METRICS_INTERVAL = 30.0  # seconds between writes of METRICS_FILE
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th sample; None past the last bucket
+        target = p * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+# Route of the REST call running in the current task, so the 429 log hook knows what was limited
+current_route = contextvars.ContextVar("current_route", default=None)
+
+class RateLimitLogHook(logging.Handler):
+    # discord.py waits out 429s itself and only logs them; count those log lines
+    def __init__(self, metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        message = record.msg if isinstance(record.msg, str) else ""
+        if message.startswith("We are being rate limited"):
+            self.metrics.ratelimited[current_route.get() or "unknown"] += 1
+        elif message.startswith("Global rate limit"):
+            self.metrics.global_ratelimited += 1
+
+class Metrics:
+    """Latency histograms for commands and handlers, and REST call counts.
+
+    Commands are timed from the tree's interaction_check to
+    on_app_command_completion (or the tree's on_error). Buttons and events
+    use timer(). Every REST call goes through the wrapped HTTPClient.request
+    and is counted by route template. Storage numbers come from
+    WorldState.stats(). Everything is rendered for /botstats and written
+    to METRICS_FILE every METRICS_INTERVAL seconds.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.latency = collections.defaultdict(Histogram)  # (kind, name) -> Histogram
+        self.rest_calls = collections.Counter()    # "METHOD /path/{template}" -> calls
+        self.rest_seconds = collections.Counter()  # same key -> total seconds
+        self.rest_errors = collections.Counter()   # (route, status) -> calls
+        self.ratelimited = collections.Counter()   # route -> 429s waited out
+        self.global_ratelimited = 0
+        self._task = None
+
+    def observe(self, kind, name, seconds, error=False):
+        self.latency[(kind, name)].observe(seconds, error)
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(kind, name, time.perf_counter() - start, error)
+
+    def install(self):
+        # Wrap the HTTP client so every REST call is counted and timed
+        http = self.bot.http
+        original = http.request
+
+        async def request(route, **kwargs):
+            key = f"{route.method} {route.path}"
+            token = current_route.set(key)
+            start = time.perf_counter()
+            try:
+                return await original(route, **kwargs)
+            except discord.HTTPException as e:
+                self.rest_errors[(key, e.status)] += 1
+                raise
+            finally:
+                self.rest_calls[key] += 1
+                self.rest_seconds[key] += time.perf_counter() - start
+                current_route.reset(token)
+
+        http.request = request
+        logging.getLogger("discord.http").addHandler(RateLimitLogHook(self))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run_writer())
+
+    async def _run_writer(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            try:
+                await asyncio.to_thread(write_file_atomic, METRICS_FILE, self.prometheus().encode())
+            except OSError as e:
+                print(f"⚠️ Failed to write {METRICS_FILE}: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def prometheus(self):
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = [
+            "# HELP towny_handler_latency_seconds Time spent in commands, buttons and events.",
+            "# TYPE towny_handler_latency_seconds histogram",
+        ]
+        for (kind, name), histogram in sorted(self.latency.items()):
+            labels = f'kind="{kind}",name="{label(name)}"'
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                seen += count
+                lines.append(f'towny_handler_latency_seconds_bucket{{{labels},le="{bound}"}} {seen}')
+            lines.append(f'towny_handler_latency_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"towny_handler_latency_seconds_sum{{{labels}}} {histogram.total}")
+            lines.append(f"towny_handler_latency_seconds_count{{{labels}}} {histogram.count}")
+        lines.append("# TYPE towny_handler_errors_total counter")
+        for (kind, name), histogram in sorted(self.latency.items()):
+            lines.append(f'towny_handler_errors_total{{kind="{kind}",name="{label(name)}"}} {histogram.errors}')
+
+        lines.append("# TYPE towny_rest_requests_total counter")
+        for route, count in sorted(self.rest_calls.items()):
+            lines.append(f'towny_rest_requests_total{{route="{label(route)}"}} {count}')
+        lines.append("# TYPE towny_rest_seconds_total counter")
+        for route, seconds in sorted(self.rest_seconds.items()):
+            lines.append(f'towny_rest_seconds_total{{route="{label(route)}"}} {seconds}')
+        lines.append("# TYPE towny_rest_errors_total counter")
+        for (route, status), count in sorted(self.rest_errors.items()):
+            lines.append(f'towny_rest_errors_total{{route="{label(route)}",status="{status}"}} {count}')
+        lines.append("# TYPE towny_rest_ratelimited_total counter")
+        for route, count in sorted(self.ratelimited.items()):
+            lines.append(f'towny_rest_ratelimited_total{{route="{label(route)}"}} {count}')
+        lines.append("# TYPE towny_rest_global_ratelimited_total counter")
+        lines.append(f"towny_rest_global_ratelimited_total {self.global_ratelimited}")
+
+        rest = self.bot.rest
+        lines.append("# TYPE towny_rest_queue_depth gauge")
+        for lane in REST_CLASSES:
+            lines.append(f'towny_rest_queue_depth{{class="{lane}"}} {rest._waiting[lane]}')
+        lines.append("# TYPE towny_rest_in_flight gauge")
+        for lane in REST_CLASSES:
+            lines.append(f'towny_rest_in_flight{{class="{lane}"}} {rest._running[lane]}')
+        lines.append("# TYPE towny_rest_started_total counter")
+        for lane in REST_CLASSES:
+            lines.append(f'towny_rest_started_total{{class="{lane}"}} {rest.started[lane]}')
+        lines.append("# TYPE towny_rest_queue_wait_seconds histogram")
+        for lane, histogram in sorted(rest.wait.items()):
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                seen += count
+                lines.append(f'towny_rest_queue_wait_seconds_bucket{{class="{lane}",le="{bound}"}} {seen}')
+            lines.append(f'towny_rest_queue_wait_seconds_bucket{{class="{lane}",le="+Inf"}} {histogram.count}')
+            lines.append(f'towny_rest_queue_wait_seconds_sum{{class="{lane}"}} {histogram.total}')
+            lines.append(f'towny_rest_queue_wait_seconds_count{{class="{lane}"}} {histogram.count}')
+
+        storage = self.bot.state.stats()
+        lines += [
+            "# TYPE towny_storage_load_seconds gauge",
+            f"towny_storage_load_seconds {storage['load_ms'] / 1000}",
+            "# TYPE towny_storage_loaded_bytes gauge",
+            f"towny_storage_loaded_bytes {storage['loaded_bytes']}",
+            "# TYPE towny_storage_flushes_total counter",
+            f"towny_storage_flushes_total {storage['flushes']}",
+            "# TYPE towny_storage_flush_errors_total counter",
+            f"towny_storage_flush_errors_total {storage['flush_errors']}",
+            "# TYPE towny_storage_flush_seconds_total counter",
+            f"towny_storage_flush_seconds_total {storage['flush_seconds']}",
+            "# TYPE towny_storage_records_written_total counter",
+            f"towny_storage_records_written_total {storage['records_written']}",
+            "# TYPE towny_storage_bytes_written_total counter",
+            f"towny_storage_bytes_written_total {storage['bytes_written']}",
+            "# TYPE towny_storage_pending_records gauge",
+            f"towny_storage_pending_records {storage['pending_records']}",
+            "# TYPE towny_join_queue_depth gauge",
+            f"towny_join_queue_depth {len(self.bot.joins)}",
+            "# TYPE towny_locks_contended_total counter",
+            f"towny_locks_contended_total {self.bot.locks.contended}",
+        ]
+        return "\n".join(lines) + "\n"
+
+# --- REST Scheduler ---
+# Classes of queued REST calls, most urgent first. Calls made while an
+# interaction still waits for its response are "interaction" and skip the queue.
+REST_CLASSES = ("interaction", "roles", "other", "edits", "dms")
+REST_CONCURRENCY = 8  # queued calls in flight at once
+REST_CLASS_LIMITS = {"roles": 8, "other": 6, "edits": 4, "dms": 4}  # per class, so DMs never hold every slot
+REST_RATE = 40.0      # queued calls started per second; Discord's global limit is 50, the rest is left for interactions
+REST_SCAN = 8         # waiting calls looked at per guild for one whose bucket is free
+
+# The interaction being handled in the current task, set by the command tree and the button callbacks
+current_interaction = contextvars.ContextVar("current_interaction", default=None)
+# Guild a background task works for, when its REST routes don't say (DMs)
+rest_guild = contextvars.ContextVar("rest_guild", default=None)
+
+def rest_class(route):
+    interaction = current_interaction.get()
+    if interaction is not None and not interaction.response.is_done():
+        return "interaction"
+    if route.path.startswith(("/interactions/", "/webhooks/{webhook_id}/{webhook_token}")):
+        return "interaction"
+    if "/roles" in route.path or (route.method == "PATCH" and route.path == "/guilds/{guild_id}/members/{user_id}"):
+        return "roles"
+    if route.method == "PATCH" and route.path == "/channels/{channel_id}/messages/{message_id}":
+        return "edits"
+    if route.path == "/users/@me/channels" or (route.method == "POST" and route.path == "/channels/{channel_id}/messages"):
+        return "dms"
+    return "other"
+
+class RestScheduler:
+    """Sends every REST call through one queue, most urgent first.
+
+    Wraps HTTPClient.request on top of the Metrics wrapper. Interaction
+    bound calls go straight out. The rest wait by class (REST_CLASSES),
+    and within a class the guilds take turns, so one busy server can't
+    starve the others. Only one call per rate limit bucket is in flight:
+    a DM bucket that discord.py is sitting out holds a single slot, and
+    calls behind it on other buckets go ahead. Starts are spaced out to
+    REST_RATE per second, and interaction calls use up a start too, so
+    queued work makes room for them instead of racing them for the
+    global limit.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._queues = {lane: collections.OrderedDict() for lane in REST_CLASSES}  # class -> guild -> deque of (future, bucket)
+        self._waiting = collections.Counter()  # class -> calls queued
+        self._running = collections.Counter()  # class -> queued calls now in flight
+        self._busy = set()  # buckets with a queued call in flight
+        self._next_start = 0.0
+        self._wakeup = None
+        self.started = collections.Counter()  # class -> calls sent
+        self.wait = collections.defaultdict(Histogram)  # class -> time spent queued
+
+    def install(self):
+        http = self.bot.http
+        original = http.request
+
+        async def request(route, **kwargs):
+            lane = rest_class(route)
+            if lane == "interaction":
+                self.started[lane] += 1
+                self._take_start()
+                return await original(route, **kwargs)
+            interaction = current_interaction.get()
+            guild_key = route.guild_id or (interaction.guild_id if interaction else None) or rest_guild.get() or 0
+            bucket = f"{route.key}:{route.major_parameters}"
+            await self._acquire(lane, guild_key, bucket)
+            try:
+                return await original(route, **kwargs)
+            finally:
+                self._release(lane, bucket)
+
+        http.request = request
+
+    def _take_start(self):
+        now = asyncio.get_running_loop().time()
+        self._next_start = max(now, self._next_start) + 1 / REST_RATE
+
+    async def _acquire(self, lane, guild_key, bucket):
+        future = asyncio.get_running_loop().create_future()
+        queued_at = time.perf_counter()
+        self._queues[lane].setdefault(guild_key, collections.deque()).append((future, bucket))
+        self._waiting[lane] += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiting[lane] -= 1  # left in the queue; _pick drops it
+            else:
+                self._release(lane, bucket)  # given a slot just as the caller gave up
+            raise
+        self.wait[lane].observe(time.perf_counter() - queued_at)
+
+    def _release(self, lane, bucket):
+        self._busy.discard(bucket)
+        self._running[lane] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # Hand out free slots; called whenever a call is queued or finishes
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        loop = asyncio.get_running_loop()
+        while sum(self._running.values()) < REST_CONCURRENCY and sum(self._waiting.values()):
+            now = loop.time()
+            if self._next_start > now:
+                self._wakeup = loop.call_at(self._next_start, self._dispatch)
+                return
+            picked = self._pick()
+            if picked is None:
+                return  # everything waiting is behind a busy bucket or a full class; a release calls again
+            lane, future, bucket = picked
+            self._take_start()
+            self._busy.add(bucket)
+            self._waiting[lane] -= 1
+            self._running[lane] += 1
+            self.started[lane] += 1
+            future.set_result(None)
+
+    def _pick(self):
+        for lane in REST_CLASSES[1:]:
+            if not self._waiting[lane] or self._running[lane] >= REST_CLASS_LIMITS[lane]:
+                continue
+            guilds = self._queues[lane]
+            for guild_key in list(guilds):
+                calls = guilds[guild_key]
+                while calls and calls[0][0].done():
+                    calls.popleft()  # the caller gave up waiting
+                for index, (future, bucket) in enumerate(itertools.islice(calls, REST_SCAN)):
+                    if not future.done() and bucket not in self._busy:
+                        del calls[index]
+                        if calls:
+                            guilds.move_to_end(guild_key)  # next guild's turn
+                        else:
+                            del guilds[guild_key]
+                        return lane, future, bucket
+                if not calls:
+                    del guilds[guild_key]
+        return None
+
+    def stats(self):
+        return {
+            lane: {
+                "queued": self._waiting[lane],
+                "running": self._running[lane],
+                "guilds": len(self._queues[lane]),
+                "started": self.started[lane],
+                "wait_p95": self.wait[lane].percentile(0.95) if self.wait[lane].count else 0.0,
+            }
+            for lane in REST_CLASSES
+        }
+
+# --- Reconciler ---
+# "dry-run" (report only, see /reconcile), "apply" (fix drift; opt in once the reports look right) or "off"
+RECONCILE_MODE = os.getenv("TOWNY_RECONCILE", "dry-run")
+RECONCILE_INTERVAL = 6 * 3600  # seconds between full passes over every guild
+RECONCILE_CHUNK = 500          # members checked between yields to the event loop
+RECONCILE_GRACE = 30.0         # seconds a fix waits before it is re-checked and applied
+RECONCILE_EDIT_INTERVAL = 1.0  # seconds between role edits, well under Discord's limits
+RECONCILE_SAMPLES = 20         # example diffs kept in a report
+
+class Reconciler:
+    """Keeps town roles and town member lists agreeing with each other.
+
+    The member lists in state are the source of truth. Drift shows up as
+    one of:
+      missing_role  a town member without the town role: add it
+      extra_role    a town role on someone who isn't in that town: remove it
+      left_guild    a town member who left the server: drop them from the town
+      owner_left    a town owner who left the server: reported only
+    A full pass walks every member in chunks; member update and leave
+    events check just that member. Fixes wait RECONCILE_GRACE seconds (so
+    a command halfway through its own role change isn't "corrected"),
+    are checked again, then applied one at a time under a rate budget.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._fixes = collections.OrderedDict()  # (kind, guild id, user id, role id) -> (due, town name)
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.reports = {}  # guild id -> report of the last full pass
+        self.applied = collections.Counter()
+        self.skipped = 0  # fixes no longer needed by the time they were due
+
+    def start(self):
+        if RECONCILE_MODE == "off":
+            return
+        self._tasks = [asyncio.create_task(self._run_fixes()), asyncio.create_task(self._run_passes())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    # --- Finding drift ---
+    def town_in_guild(self, town, guild):
+        # Towns from before guild_id was saved belong wherever the directory
+        # places them; never assume the guild being reconciled
+        if "guild_id" in town:
+            return town["guild_id"] == guild.id
+        found = self.bot.directory.guild_for_town(town)
+        return found is not None and found.id == guild.id
+
+    def member_drift(self, guild, member):
+        state = self.bot.state
+        town_name = state.member_town.get(member.id)
+        town = state.towns.get(town_name) if town_name else None
+        if town is not None and not self.town_in_guild(town, guild):
+            town = None  # their town lives in another server
+        wanted = town["role_id"] if town else None
+
+        drift = []
+        for role in member.roles:
+            role_town = state.town_by_role.get(role.id)
+            if role_town is not None and role.id != wanted:
+                drift.append(("extra_role", guild.id, member.id, role.id, role_town))
+        if wanted is not None and member.get_role(wanted) is None and guild.get_role(wanted) is not None:
+            drift.append(("missing_role", guild.id, member.id, wanted, town_name))
+        return drift
+
+    def town_drift(self, guild, town_name, town):
+        drift = []
+        for user_id in town["members"]:
+            if guild.get_member(user_id) is None:
+                kind = "owner_left" if user_id == town["owner_id"] else "left_guild"
+                drift.append((kind, guild.id, user_id, town["role_id"], town_name))
+        return drift
+
+    async def scan(self, guild):
+        # Full pass over one guild; yields between chunks so commands aren't held up
+        started = time.time()
+        drift = []
+        for i, member in enumerate(guild.members, 1):
+            drift += self.member_drift(guild, member)
+            if i % RECONCILE_CHUNK == 0:
+                await asyncio.sleep(0)
+        towns = [(name, town) for name, town in self.bot.state.towns.items() if self.town_in_guild(town, guild)]
+        for i, (town_name, town) in enumerate(towns, 1):
+            drift += self.town_drift(guild, town_name, town)
+            if i % RECONCILE_CHUNK == 0:
+                await asyncio.sleep(0)
+        report = {
+            "started": started,
+            "seconds": time.time() - started,
+            "members": guild.member_count or len(guild.members),
+            "towns": len(towns),
+            "counts": collections.Counter(kind for kind, *_ in drift),
+            "samples": drift[:RECONCILE_SAMPLES],
+        }
+        return drift, report
+
+    async def full_pass(self, guild, dry_run=False):
+        if not guild.chunked:
+            return None  # an incomplete member list would look like everyone left
+        drift, report = await self.scan(guild)
+        report["dry_run"] = dry_run
+        self.reports[guild.id] = report
+        if not dry_run:
+            self.enqueue(drift)
+        return report
+
+    async def _run_passes(self):
+        await self.bot.wait_until_ready()
+        while True:
+            for guild in list(self.bot.guilds):
+                try:
+                    report = await self.full_pass(guild, dry_run=RECONCILE_MODE == "dry-run")
+                    if report and report["counts"]:
+                        found = ", ".join(f"{kind} {count}" for kind, count in sorted(report["counts"].items()))
+                        action = "reported only (TOWNY_RECONCILE=dry-run)" if report["dry_run"] else "fixing"
+                        print(f"🧭 Role drift in guild {guild.id}: {found}; {action}")
+                except Exception as e:
+                    print(f"⚠️ Reconcile pass for {guild.id} failed: {e}")
+            await asyncio.sleep(RECONCILE_INTERVAL)
+
+    # --- Incremental checks ---
+    def member_updated(self, before, after):
+        if RECONCILE_MODE == "apply" and before.roles != after.roles:
+            self.enqueue(self.member_drift(after.guild, after))
+
+    def member_left(self, guild, user_id):
+        if RECONCILE_MODE != "apply":
+            return
+        town_name = self.bot.state.member_town.get(user_id)
+        town = self.bot.state.towns.get(town_name) if town_name else None
+        if town is not None and self.town_in_guild(town, guild) and user_id != town["owner_id"]:
+            self.enqueue([("left_guild", guild.id, user_id, town["role_id"], town_name)])
+
+    # --- Applying fixes ---
+    def enqueue(self, drift):
+        due = time.monotonic() + RECONCILE_GRACE
+        for kind, guild_id, user_id, role_id, town_name in drift:
+            if kind != "owner_left":
+                self._fixes.setdefault((kind, guild_id, user_id, role_id), (due, town_name))
+        if self._fixes:
+            self._wakeup.set()
+
+    def __len__(self):
+        return len(self._fixes)
+
+    async def _run_fixes(self):
+        while True:
+            if not self._fixes:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            key, (due, town_name) = next(iter(self._fixes.items()))
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            del self._fixes[key]
+            try:
+                edited = await self._apply(*key, town_name)
+            except discord.HTTPException as e:
+                print(f"⚠️ Reconcile fix {key} failed: {e}")
+                edited = True
+            if edited:
+                await asyncio.sleep(RECONCILE_EDIT_INTERVAL)
+
+    async def _apply(self, kind, guild_id, user_id, role_id, town_name):
+        # Check again against the current state; returns whether a REST call was made
+        state = self.bot.state
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            self.skipped += 1
+            return False
+        member = guild.get_member(user_id)
+
+        if kind == "left_guild":
+            async with self.bot.locks.hold(towns=[town_name]):
+                still_drifted = member is None and state.member_town.get(user_id) == town_name and state.towns[town_name]["owner_id"] != user_id
+                if still_drifted:
+                    state.remove_member(town_name, user_id)
+            self._count(kind, still_drifted)
+            return False
+
+        role = guild.get_role(role_id)
+        if member is None or role is None:
+            self.skipped += 1
+            return False
+        if kind == "missing_role":
+            if state.member_town.get(user_id) == town_name and member.get_role(role_id) is None:
+                await member.add_roles(role, reason="Reconcile: town member without the town role")
+                return self._count(kind, True)
+        elif kind == "extra_role":
+            if state.member_town.get(user_id) != state.town_by_role.get(role_id) and member.get_role(role_id) is not None:
+                await member.remove_roles(role, reason="Reconcile: town role on a non-member")
+                return self._count(kind, True)
+        return self._count(kind, False)
+
+    def _count(self, kind, applied):
+        if applied:
+            self.applied[kind] += 1
+        else:
+            self.skipped += 1
+        return applied
+
+class TownyTree(app_commands.CommandTree):
+    # Stamps every command so on_app_command_completion / on_error can time it
+    async def interaction_check(self, interaction):
+        interaction.extras["started"] = time.perf_counter()
+        current_interaction.set(interaction)
+        return True
+
+    async def on_error(self, interaction, error):
+        started = interaction.extras.get("started")
+        if started is not None and interaction.command is not None:
+            self.client.metrics.observe("command", interaction.command.qualified_name, time.perf_counter() - started, error=True)
+        await super().on_error(interaction, error)
+
+bot = TownyBot()
+
 # --- Events ---
 @bot.event
 async def on_member_join(member):
-    # Create the Newcomer role if it doesn't exist
-    role = discord.utils.get(member.guild.roles, name="Newcomer")
-    if not role:
-        role = await member.guild.create_role(name="Newcomer", reason="Auto-joining role")
-    
-    await member.add_roles(role)
+    with bot.metrics.timer("event", "on_member_join"):
+        bot.directory.member_joined(member.guild.id, member.id)
+        # The Newcomer role is added by the join queue so raids don't pile into 429s
+        bot.joins.put(member)
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    started = interaction.extras.get("started")
+    if started is not None:
+        bot.metrics.observe("command", command.qualified_name, time.perf_counter() - started)
+
+@bot.event
+async def on_member_remove(member):
+    bot.directory.member_left(member.guild.id, member.id)
+    bot.reconciler.member_left(member.guild, member.id)
+
+@bot.event
+async def on_member_update(before, after):
+    bot.reconciler.member_updated(before, after)
+
+@bot.event
+async def on_guild_join(guild):
+    bot.directory.add_guild(guild)
+
+@bot.event
+async def on_guild_available(guild):
+    bot.directory.add_guild(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    bot.directory.remove_guild(guild)
+
+@bot.event
+async def on_guild_role_create(role):
+    bot.special_roles.role_created(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    bot.special_roles.role_updated(before, after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    bot.special_roles.role_deleted(role)
 
 @bot.event
 async def on_ready():
@@ -101,8 +2939,16 @@ async def on_ready():
         status=discord.Status.dnd
     )
     print(f'Logged in as {bot.user}!')
+    # Member lists are chunked by now
+    for guild in bot.guilds:
+        bot.directory.add_guild(guild)
+    bot.announcer.resume()
 
 # --- Commands ---
+def name_choices(names):
+    # Autocomplete choices; Discord caps both name and value at 100 characters
+    return [app_commands.Choice(name=name[:100], value=name) for name in names if len(name) <= 100]
+
 @bot.tree.command(name="setup_welcome", description="Send the welcome button to this channel")
 @app_commands.checks.has_permissions(administrator=True)
 async def setup_welcome(interaction: discord.Interaction):
@@ -114,45 +2960,242 @@ async def setup_welcome(interaction: discord.Interaction):
     await interaction.channel.send(embed=embed, view=WelcomeView())
     await interaction.response.send_message("Welcome message sent!", ephemeral=True)
     
+@bot.tree.command(name="checkindexes", description="Check the town/nation lookup indexes against the saved data")
+@app_commands.describe(repair="Rebuild the indexes if anything is out of sync")
+@app_commands.checks.has_permissions(administrator=True)
+async def checkindexes(interaction: discord.Interaction, repair: bool = False):
+    problems = bot.state.check_indexes(repair=repair)
+    if not problems:
+        return await interaction.response.send_message("✅ All indexes are consistent.", ephemeral=True)
+
+    summary = "\n".join(problems[:15])
+    if len(problems) > 15:
+        summary += f"\n...and {len(problems) - 15} more"
+    status = "Rebuilt the indexes." if repair else "Run again with `repair` to rebuild them."
+    await interaction.response.send_message(f"⚠️ Found {len(problems)} index problem(s). {status}\n```{summary}```", ephemeral=True)
+
+@bot.tree.command(name="lockstats", description="Show town/nation lock contention")
+@app_commands.checks.has_permissions(administrator=True)
+async def lockstats(interaction: discord.Interaction):
+    stats = bot.locks.stats()
+    embed = discord.Embed(title="🔒 Lock Contention", color=discord.Color.blurple())
+    embed.add_field(name="Acquisitions", value=str(stats["acquisitions"]))
+    embed.add_field(name="Contended", value=f"{stats['contended']} ({stats['contention_rate']:.1%})")
+    embed.add_field(name="Held / waiting now", value=str(stats["held_or_waiting"]))
+    embed.add_field(name="Average wait", value=f"{stats['avg_wait_ms']:.2f} ms")
+    embed.add_field(name="Longest wait", value=f"{stats['max_wait_ms']:.2f} ms")
+    hot = "\n".join(f"{key}: {count}" for key, count in stats["hot_keys"]) or "None"
+    embed.add_field(name="Most contended", value=hot, inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="synccommands", description="Push the slash command list to Discord")
+@app_commands.describe(force="Sync even if nothing changed since the last sync")
+@app_commands.checks.has_permissions(administrator=True)
+async def synccommands(interaction: discord.Interaction, force: bool = False):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    synced = await bot.sync_commands(force=force)
+    if synced:
+        await interaction.followup.send(f"✅ Synced commands: {', '.join(synced)}")
+    else:
+        await interaction.followup.send("Commands are already up to date. Use `force` to sync anyway.")
+
+@bot.tree.command(name="botstats", description="Show command latency, storage I/O and Discord API usage")
+@app_commands.checks.has_permissions(administrator=True)
+async def botstats(interaction: discord.Interaction):
+    metrics = bot.metrics
+    embed = discord.Embed(title="📊 Bot Stats", color=discord.Color.blurple())
+
+    def ms(seconds):
+        return f"{seconds * 1000:.0f}" if seconds is not None else "10000+"
+
+    busiest = sorted(metrics.latency.items(), key=lambda item: item[1].count, reverse=True)[:10]
+    lines = [
+        f"`{name}` ({kind}) ×{h.count}: p50 ≤{ms(h.percentile(0.5))} ms, p95 ≤{ms(h.percentile(0.95))} ms"
+        + (f", {h.errors} errors" if h.errors else "")
+        for (kind, name), h in busiest
+    ]
+    embed.add_field(name="Busiest handlers", value="\n".join(lines) or "Nothing yet", inline=False)
+
+    storage = bot.state.stats()
+    embed.add_field(name="Storage", value=(
+        f"Loaded {storage['loaded_bytes']:,} bytes in {storage['load_ms']:.0f} ms\n"
+        f"{storage['flushes']} flushes, avg {storage['avg_flush_ms']:.1f} ms, {storage['flush_errors']} failed\n"
+        f"{storage['records_written']:,} records / {storage['bytes_written']:,} bytes written, {storage['pending_records']} pending"
+    ), inline=False)
+
+    timers = bot.scheduler.stats()
+    embed.add_field(name="Timers", value=(
+        f"{timers['timers']:,} scheduled ({', '.join(f'{kind} {count:,}' for kind, count in timers['by_kind'].items()) or 'none'}), "
+        f"{timers['fired']:,} fired, {timers['failed']} failed"
+    ), inline=False)
+
+    routes = "\n".join(
+        f"`{route}` ×{count}, avg {metrics.rest_seconds[route] / count * 1000:.0f} ms"
+        for route, count in metrics.rest_calls.most_common(5)
+    )
+    ratelimited = sum(metrics.ratelimited.values())
+    embed.add_field(name="Discord API", value=(
+        f"{sum(metrics.rest_calls.values())} calls, {sum(metrics.rest_errors.values())} errors, "
+        f"{ratelimited} rate limited ({metrics.global_ratelimited} global)\n{routes}"
+    ), inline=False)
+
+    queue = bot.rest.stats()
+    embed.add_field(name="REST queue", value="\n".join(
+        f"`{lane}`: {lane_stats['started']:,} sent, {lane_stats['queued']} waiting ({lane_stats['guilds']} servers), "
+        f"{lane_stats['running']} in flight, p95 wait ≤{ms(lane_stats['wait_p95'])} ms"
+        for lane, lane_stats in queue.items()
+    ), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+DRIFT_LABELS = {
+    "missing_role": "is in **{town}** but lacks its role",
+    "extra_role": "has the **{town}** role but isn't a member",
+    "left_guild": "left the server but is still in **{town}**",
+    "owner_left": "owns **{town}** but left the server",
+}
+
+@bot.tree.command(name="reconcile", description="Compare town roles with town member lists")
+@app_commands.describe(dry_run="Only list the differences, don't fix anything")
+@app_commands.checks.has_permissions(administrator=True)
+async def reconcile(interaction: discord.Interaction, dry_run: bool = True):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    report = await bot.reconciler.full_pass(interaction.guild, dry_run=dry_run)
+    if report is None:
+        return await interaction.followup.send("❌ The member list for this server isn't loaded yet. Try again in a minute.")
+
+    embed = discord.Embed(title="🧭 Role Drift Report" + (" (dry run)" if dry_run else ""), color=discord.Color.blurple())
+    embed.add_field(name="Checked", value=f"{report['members']} members, {report['towns']} towns in {report['seconds']:.1f} s", inline=False)
+    counts = report["counts"]
+    embed.add_field(name="Found", value="\n".join(f"{kind}: {counts[kind]}" for kind in DRIFT_LABELS if counts[kind]) or "No drift 🎉", inline=False)
+    if report["samples"]:
+        lines = [f"<@{user_id}> " + DRIFT_LABELS[kind].format(town=town_name) for kind, _, user_id, _, town_name in report["samples"]]
+        embed.add_field(name="Examples", value="\n".join(lines)[:1024], inline=False)
+    if not dry_run:
+        applied = sum(bot.reconciler.applied.values())
+        embed.add_field(name="Fixes", value=f"{len(bot.reconciler)} queued, {applied} applied so far (owners who left are not changed)", inline=False)
+    await interaction.followup.send(embed=embed)
+
+@bot.tree.command(name="backup", description="Write a backup of towns, nations and wars")
+@app_commands.describe(incremental="Only what changed since the last backup")
+@app_commands.checks.has_permissions(administrator=True)
+async def backup(interaction: discord.Interaction, incremental: bool = False):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        result = await bot.backups.run(incremental)
+    except OSError as e:
+        return await interaction.followup.send(f"❌ Backup failed: {e}")
+    kind = "Full" if result["full"] else "Incremental"
+    note = " (no earlier backup since the bot started)" if incremental and result["full"] else ""
+    await interaction.followup.send(
+        f"💾 {kind} backup{note}: `{result['path']}`, {result['records']:,} records, "
+        f"{result['bytes']:,} bytes in {result['seconds']:.1f} s."
+    )
+
+@bot.tree.command(name="cachestats", description="Show how many Discord lookups the caches saved")
+@app_commands.checks.has_permissions(administrator=True)
+async def cachestats(interaction: discord.Interaction):
+    users = bot.user_cache.stats()
+    directory = bot.directory
+    embed = discord.Embed(title="🗃️ Lookup Caches", color=discord.Color.blurple())
+    embed.add_field(name="User lookups", value=str(users["lookups"]))
+    embed.add_field(name="Client cache / our cache", value=f"{users['client_hits']} / {users['cache_hits']}")
+    embed.add_field(name="Shared / REST fetches", value=f"{users['shared_fetches']} / {users['rest_fetches']}")
+    embed.add_field(name="REST calls saved", value=f"{users['rest_saved_rate']:.1%}")
+    embed.add_field(name="Member lookups (cache / miss cache / REST)", value=f"{directory.hits} / {directory.negative_hits} / {directory.fetches}", inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="joinqueue", description="Show the new member role queue")
+@app_commands.checks.has_permissions(administrator=True)
+async def joinqueue(interaction: discord.Interaction):
+    stats = bot.joins.stats()
+    embed = discord.Embed(title="🚪 Join Queue", color=discord.Color.blurple())
+    embed.add_field(name="Waiting", value=str(stats["depth"]))
+    embed.add_field(name="Oldest wait", value=f"{stats['oldest_wait_s']:.1f} s")
+    embed.add_field(name="Drain rate", value=f"{stats['drain_rate_per_min']:.0f} / min")
+    embed.add_field(name="Pace", value=f"1 every {stats['interval_s']:.2f} s")
+    embed.add_field(name="Roles added", value=str(stats["added"]))
+    embed.add_field(name="Skipped / failed", value=f"{stats['skipped']} / {stats['failed']}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="jobstatus", description="Check on your recent town/nation setup jobs")
+@app_commands.describe(job_id="A specific job number (defaults to your latest jobs)")
+async def jobstatus(interaction: discord.Interaction, job_id: int = None):
+    if job_id is not None:
+        job = bot.jobs.jobs.get(job_id)
+        jobs = [job] if job and job.user_id == interaction.user.id else []
+    else:
+        jobs = [job for job in reversed(bot.jobs.jobs.values()) if job.user_id == interaction.user.id][:5]
+
+    if not jobs:
+        return await interaction.response.send_message("You have no recent jobs.", ephemeral=True)
+
+    icons = {"queued": "⏳", "running": "⚙️", "retrying": "🔁", "done": "✅", "failed": "❌"}
+    lines = []
+    for job in jobs:
+        line = f"{icons[job.status]} **#{job.id}** `/{job.name}` — {job.status}"
+        if job.retries:
+            line += f" ({job.retries} retries)"
+        if job.status == "retrying" and job.detail:
+            line += f": {job.detail}"
+        lines.append(line)
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 @bot.tree.command(name="towncreate", description="Create a new town role")
 @app_commands.describe(name="Town name", colour="Role colour (hex, e.g. #ff5733)")
 async def create(interaction: discord.Interaction, name: str, colour: str):
     guild = interaction.guild
     user = interaction.user
-    towns = load_towns()
+    towns = bot.state.towns
 
     if name in towns:
         return await interaction.response.send_message("That town already exists!", ephemeral=True)
 
-    role = await guild.create_role(
-        name=name,
-        colour=discord.Colour.from_str(colour),
-        reason="Town created"
-    )
-
-    await interaction.user.add_roles(role)
+    try:
+        role_colour = discord.Colour.from_str(colour)
+    except ValueError:
+        return await interaction.response.send_message("❌ Invalid hex color! Use something like #ff5733", ephemeral=True)
 
-    towns[name] = {
-        "role_id": role.id,
-        "owner_id": user.id,
-        "members": [user.id],
-        "pending": [],
-        "awaiting_confirmation": False,
-        "guild_id": guild.id  # Crucial for DM interactions
-    }
+    # Role creation can be slow under rate limits, so it runs as a job
+    await interaction.response.defer(ephemeral=True, thinking=True)
 
-    save_towns(towns)
-    await interaction.response.send_message(f"🏘️ Town **{name}** created!", ephemeral=True)
+    async def work(job):
+        role = await job.call(guild.create_role, name=name, colour=role_colour, reason="Town created")
+        try:
+            await job.call(user.add_roles, role)
+
+            # Someone else may have taken the name while we were creating the role
+            async with bot.locks.hold(towns=[name]):
+                created = name not in towns
+                if created:
+                    bot.state.create_town(name, {
+                        "role_id": role.id,
+                        "owner_id": user.id,
+                        "members": [user.id],
+                        "pending": [],
+                        "awaiting_confirmation": False,
+                        "guild_id": guild.id  # Crucial for DM interactions
+                    })
+        except Exception:
+            # Don't leave an orphaned role behind
+            with contextlib.suppress(discord.HTTPException):
+                await role.delete(reason="Town creation failed")
+            raise
+
+        if not created:
+            await job.call(role.delete, reason="Town name was taken while creating")
+            return "That town already exists!"
+        return f"🏘️ Town **{name}** created!"
+
+    bot.jobs.submit("towncreate", work, interaction)
 
 @bot.tree.command(name="townjoin", description="Request to join a town")
 async def join(interaction: discord.Interaction, town_name: str):
     guild = interaction.guild
     user = interaction.user
-    towns = load_towns()
+    towns = bot.state.towns
    
     # CHECK: Is the user already in ANY town?
-    already_in_town = any(user.id in t["members"] for t in towns.values())
+    already_in_town = user.id in bot.state.member_town
     if already_in_town:
         return await interaction.response.send_message("❌ You are already a member of a town! You must `/leave` your current town first.", ephemeral=True)
     
@@ -160,158 +3203,313 @@ async def join(interaction: discord.Interaction, town_name: str):
         return await interaction.response.send_message("Town not found!", ephemeral=True)
 
     town = towns[town_name]
-    if user.id in town["members"]:
-        return await interaction.response.send_message("You're already in that town!", ephemeral=True)
-    if user.id in town["pending"]:
+    async with bot.locks.hold(towns=[town_name]):
+        exists = town_name in towns
+        requested = exists and bot.state.add_pending(town_name, user.id)
+    if not exists:
+        return await interaction.response.send_message("Town not found!", ephemeral=True)
+    if not requested:
         return await interaction.response.send_message("You already requested to join!", ephemeral=True)
 
-    town["pending"].append(user.id)
-    save_towns(towns)
-
     # Create buttons
-    accept_button = Button(label="Accept", style=discord.ButtonStyle.green, custom_id=f"accept_{town_name}_{user.id}")
-    deny_button = Button(label="Deny", style=discord.ButtonStyle.red, custom_id=f"deny_{town_name}_{user.id}")
-    view = View()
-    view.add_item(accept_button)
-    view.add_item(deny_button)
+    view = View(timeout=None)
+    view.add_item(TownyButton("ta", town["role_id"], user.id, label="Accept", style=discord.ButtonStyle.green))
+    view.add_item(TownyButton("td", town["role_id"], user.id, label="Deny", style=discord.ButtonStyle.red))
 
     owner = guild.get_member(town["owner_id"])
+    message = None
     if owner:
-        await owner.send(f"📩 {user.mention} wants to join **{town_name}**. Click a button to respond.", view=view)
+        message = await owner.send(f"📩 {user.mention} wants to join **{town_name}**. Click a button to respond.", view=view)
         await interaction.response.send_message("Join request sent!", ephemeral=True)
     else:
         await interaction.response.send_message("The town owner is not available.", ephemeral=True)
+    # The request lapses if nobody answers it in time
+    bot.scheduler.schedule(join_timer(town, user.id), JOIN_REQUEST_TTL, "join", {"town": town["role_id"], "user": user.id, **message_ref(message)})
+
+@join.autocomplete("town_name")
+async def join_town_autocomplete(interaction: discord.Interaction, current: str):
+    return name_choices(bot.state.town_names.search(current))
 
 # --- Button Interaction Handler ---
+async def disable_buttons(interaction):
+    for item in interaction.message.components:
+        for b in item.children:
+            b.disabled = True
+    await interaction.message.edit(view=discord.ui.View.from_message(interaction.message))
 
-@bot.event
-async def on_interaction(interaction: discord.Interaction):
-    if interaction.type != discord.InteractionType.component:
-        return
+# Join requests and nation invites expire through the scheduler. Each timer
+# remembers which DM carries the buttons, so they can be disabled without
+# fetching the message first.
+def join_timer(town, user_id):
+    return f"join:{town['role_id']}:{user_id}"
 
-    custom_id = interaction.data.get("custom_id", "")
-    
-    # Updated check to include nation prefixes (naccept_ and ndeny_)
-    valid_prefixes = ("accept_", "deny_", "naccept_", "ndeny_")
-    if not custom_id.startswith(valid_prefixes):
-        return
+def invite_timer(nation_role_id, town_role_id):
+    return f"invite:{nation_role_id}:{town_role_id}"
 
-    # --- NATION INTERACTION LOGIC ---
-    if custom_id.startswith(("naccept_", "ndeny_")):
-        try:
-            parts = custom_id.split('_')
-            action = parts[0]  # naccept or ndeny
-            nation_name = parts[1]
-            town_name = parts[2]
-        except (IndexError, ValueError):
-            return
+def message_ref(message):
+    return {"channel": message.channel.id, "message": message.id} if message else {}
 
-        nations = load_nations()
-        if nation_name not in nations:
-            return await interaction.response.send_message("❌ This nation no longer exists.", ephemeral=True)
-
-        if action == "naccept":
-            # Check if the town joined another nation while this invite was pending
-            if any(town_name in n["member_towns"] for n in nations.values()):
-                 return await interaction.response.send_message("❌ This town is already part of a nation!", ephemeral=True)
-
-            if town_name not in nations[nation_name]["member_towns"]:
-                nations[nation_name]["member_towns"].append(town_name)
-                save_nations(nations)
-            
-            await interaction.response.send_message(f"✅ Your town **{town_name}** has joined the nation of **{nation_name}**!", ephemeral=True)
-            
-            # Notify the Nation Leader
-            leader = bot.get_user(nations[nation_name]["leader_id"])
-            if leader:
-                try:
-                    await leader.send(f"🎉 **{town_name}** has accepted the invitation and joined **{nation_name}**!")
-                except: pass
+async def notify_user(user_id, text):
+    try:
+        user = await bot.user_cache.get(user_id)
+        if user:
+            await user.send(text)
+    except discord.HTTPException:
+        pass
+
+async def disable_expired_buttons(timers):
+    # One edit per DM, in order; discord.py spaces them out under the rate limits
+    view = View(timeout=None)
+    view.add_item(discord.ui.Button(label="Expired", disabled=True))
+    for data in timers:
+        if "message" in data:
+            message = bot.get_partial_messageable(data["channel"]).get_partial_message(data["message"])
+            try:
+                await message.edit(view=view)
+            except discord.HTTPException:
+                pass  # deleted, or the DM channel is gone
+
+async def expire_join_requests(timers):
+    # The whole batch is checked and cleared under one set of locks
+    towns = [bot.state.town_by_role.get(data["town"]) for data in timers]
+    expired = []
+    async with bot.locks.hold(towns=towns):
+        for data in timers:
+            town_name = bot.state.town_by_role.get(data["town"])
+            if town_name is not None and bot.state.remove_pending(town_name, data["user"]):
+                expired.append((data["user"], town_name))
+    await disable_expired_buttons(timers)
+    for user_id, town_name in expired:
+        await notify_user(user_id, f"⌛ Your request to join **{town_name}** expired without an answer.")
+
+async def expire_nation_invites(timers):
+    nations = [bot.state.nation_by_role.get(data["nation"]) for data in timers]
+    expired = []
+    async with bot.locks.hold(nations=nations):
+        for data in timers:
+            nation_name = bot.state.nation_by_role.get(data["nation"])
+            if nation_name is not None and bot.state.remove_invite(nation_name, data["town"]):
+                expired.append((nation_name, bot.state.town_by_role.get(data["town"])))
+    await disable_expired_buttons(timers)
+    for nation_name, town_name in expired:
+        nation = bot.state.nations.get(nation_name)
+        if nation and town_name:
+            await notify_user(nation["leader_id"], f"⌛ **{town_name}** didn't answer your invitation to join **{nation_name}** in time.")
+
+def legacy_invite_open(nation, message):
+    # An invite DM'd before invites were recorded: good for NATION_INVITE_TTL from when it was sent
+    if message is None:
+        return False
+    sent_at = message.created_at.timestamp()
+    return sent_at < nation.get("invites_recorded_since", 0) and time.time() - sent_at < NATION_INVITE_TTL
+
+async def answer_nation_invite(interaction, action, nation_name, town_name):
+    nations = bot.state.nations
+    if nation_name not in nations:
+        return await interaction.response.send_message("❌ This nation no longer exists.", ephemeral=True)
+
+    nation, town = nations[nation_name], bot.state.towns[town_name]
+    async with bot.locks.hold(towns=[town_name], nations=[nation_name]):
+        # Claim the invitation so it can only be answered once, and not after it expired
+        claimed = bot.state.remove_invite(nation_name, town["role_id"]) or legacy_invite_open(nation, interaction.message)
+        # Check if the town joined another nation while this invite was pending
+        joined = claimed and action == "naccept" and town_name in bot.state.towns and town_name not in bot.state.town_nation
+        if joined:
+            bot.state.add_nation_town(nation_name, town_name)
+    if claimed:
+        bot.scheduler.cancel(invite_timer(nation["role_id"], town["role_id"]))
+    else:
+        await interaction.response.send_message("⌛ This invitation has expired or was already answered.", ephemeral=True)
+        return await disable_buttons(interaction)
 
-        elif action == "ndeny":
-            await interaction.response.send_message(f"❌ You declined the invitation to join **{nation_name}**.", ephemeral=True)
+    if action == "naccept":
+        if not joined:
+             return await interaction.response.send_message("❌ This town is already part of a nation!", ephemeral=True)
+        
+        await interaction.response.send_message(f"✅ Your town **{town_name}** has joined the nation of **{nation_name}**!", ephemeral=True)
+        
+        # Notify the Nation Leader
+        try:
+            leader = await bot.user_cache.get(nations[nation_name]["leader_id"])
+        except discord.HTTPException:
+            leader = None
+        if leader:
+            try:
+                await leader.send(f"🎉 **{town_name}** has accepted the invitation and joined **{nation_name}**!")
+            except: pass
 
-        # Disable Buttons
-        for item in interaction.message.components:
-            for b in item.children:
-                b.disabled = True
-        await interaction.message.edit(view=discord.ui.View.from_message(interaction.message))
-        return # Exit here so it doesn't run the Town logic below
+    elif action == "ndeny":
+        await interaction.response.send_message(f"❌ You declined the invitation to join **{nation_name}**.", ephemeral=True)
 
+    await disable_buttons(interaction)
 
-    # --- TOWN INTERACTION LOGIC (Your Original Code) ---
-    try:
-        parts = custom_id.split('_')
-        action = parts[0]
-        town_name = parts[1]
-        target_user_id = int(parts[2])
-    except (IndexError, ValueError):
-        return
-
-    towns = load_towns()
+async def answer_join_request(interaction, action, town_name, target_user_id):
+    towns = bot.state.towns
     town = towns.get(town_name)
 
     if not town:
         return await interaction.response.send_message("Town not found in database.", ephemeral=True)
 
-    guild_id = town.get("guild_id")
-    target_guild = None
-    if guild_id:
-        target_guild = bot.get_guild(guild_id)
-    
-    if not target_guild:
-        for g in bot.guilds:
-            if g.get_member(town["owner_id"]):
-                target_guild = g
-                break
-
+    target_guild = bot.directory.guild_for_town(town)
     if not target_guild:
         return await interaction.response.send_message("Could not locate the Minecraft Discord server.", ephemeral=True)
 
-    target_member = target_guild.get_member(target_user_id)
+    try:
+        target_member = await bot.directory.member(target_guild, target_user_id)
+    except discord.HTTPException:
+        target_member = None
     if not target_member:
-        try:
-            target_member = await target_guild.fetch_member(target_user_id)
-        except:
-            return await interaction.response.send_message("The player is no longer in the server.", ephemeral=True)
+        return await interaction.response.send_message("The player is no longer in the server.", ephemeral=True)
 
     if action == "accept":
         role = target_guild.get_role(town["role_id"])
         if role:
+            # Claim the request first so a second click or a deny can't also answer it
+            async with bot.locks.hold(towns=[town_name]):
+                claimed = bot.state.remove_pending(town_name, target_user_id)
+            if not claimed:
+                return await interaction.response.send_message("This request has already been answered or has expired.", ephemeral=True)
+
             try:
                 await target_member.add_roles(role)
-                if target_user_id not in town["members"]:
-                    town["members"].append(target_user_id)
-                if target_user_id in town["pending"]:
-                    town["pending"].remove(target_user_id)
-                
-                save_towns(towns)
-                await interaction.response.send_message(f"✅ Success! {target_member.display_name} is now a member of {town_name}.", ephemeral=True)
-                await target_member.send(f"🎉 You've been accepted into **{town_name}**!")
             except discord.Forbidden:
+                async with bot.locks.hold(towns=[town_name]):
+                    if town_name in bot.state.towns:
+                        bot.state.add_pending(town_name, target_user_id)  # let the owner retry
                 await interaction.response.send_message("❌ Role hierarchy error! Move bot role higher.", ephemeral=True)
+            else:
+                bot.scheduler.cancel(join_timer(town, target_user_id))
+                async with bot.locks.hold(towns=[town_name]):
+                    # The town may have been deleted, or the player accepted elsewhere, meanwhile
+                    other_town = bot.state.member_town.get(target_user_id)
+                    joined = town_name in bot.state.towns and other_town is None
+                    if joined:
+                        bot.state.add_member(town_name, target_user_id)
+
+                if joined:
+                    await interaction.response.send_message(f"✅ Success! {target_member.display_name} is now a member of {town_name}.", ephemeral=True)
+                    await target_member.send(f"🎉 You've been accepted into **{town_name}**!")
+                else:
+                    await target_member.remove_roles(role)
+                    await interaction.response.send_message(f"❌ {target_member.display_name} could not join {town_name}; they are already in {other_town or 'another town'} or the town is gone.", ephemeral=True)
         else:
             await interaction.response.send_message("❌ Town role not found.", ephemeral=True)
 
     elif action == "deny":
-        if target_user_id in town["pending"]:
-            town["pending"].remove(target_user_id)
-        save_towns(towns)
+        async with bot.locks.hold(towns=[town_name]):
+            bot.state.remove_pending(town_name, target_user_id)
+        bot.scheduler.cancel(join_timer(town, target_user_id))
         await interaction.response.send_message(f"❌ Denied the request for {town_name}.", ephemeral=True)
         await target_member.send(f"❌ Your request to join **{town_name}** was denied.")
 
-    for item in interaction.message.components:
-        for b in item.children:
-            b.disabled = True
-    await interaction.message.edit(view=discord.ui.View.from_message(interaction.message))
+    await disable_buttons(interaction)
+
+# Buttons in DMs carry a short versioned custom_id, "tb1:<action>:<id>:<id>",
+# with role and user ids instead of names, so they survive any characters in
+# a name. discord.py matches the pattern and calls the handler for the action
+# code straight from this table; the buttons are registered as dynamic items,
+# so they keep working after a restart.
+CUSTOM_ID_VERSION = 1
+
+def encode_custom_id(action, first_id, second_id):
+    return f"tb{CUSTOM_ID_VERSION}:{action}:{first_id}:{second_id}"
+
+async def on_join_request_button(interaction, action, town_role_id, user_id):
+    town_name = bot.state.town_by_role.get(town_role_id)
+    if town_name is None:
+        return await interaction.response.send_message("Town not found in database.", ephemeral=True)
+    await answer_join_request(interaction, action, town_name, user_id)
+
+async def on_nation_invite_button(interaction, action, nation_role_id, town_role_id):
+    nation_name = bot.state.nation_by_role.get(nation_role_id)
+    town_name = bot.state.town_by_role.get(town_role_id)
+    if nation_name is None:
+        return await interaction.response.send_message("❌ This nation no longer exists.", ephemeral=True)
+    if town_name is None:
+        return await interaction.response.send_message("❌ Your town no longer exists.", ephemeral=True)
+    await answer_nation_invite(interaction, action, nation_name, town_name)
+
+async def on_list_page_button(interaction, list_name, page, _):
+    embed, view = list_page(list_name, page)
+    await interaction.response.edit_message(embed=embed, view=view)
+
+# action code -> (handler, action name passed on)
+COMPONENT_HANDLERS = {
+    "ta": (on_join_request_button, "accept"),       # town join request: accept (town role id, user id)
+    "td": (on_join_request_button, "deny"),
+    "na": (on_nation_invite_button, "naccept"),     # nation invite: accept (nation role id, town role id)
+    "nd": (on_nation_invite_button, "ndeny"),
+    "tl": (on_list_page_button, "townlist"),        # /townlist page turn (page number, unused)
+    "nl": (on_list_page_button, "nationlist"),
+}
+
+class TownyButton(discord.ui.DynamicItem[discord.ui.Button], template=rf"tb{CUSTOM_ID_VERSION}:(?P<action>[a-z]{{2}}):(?P<first>[0-9]+):(?P<second>[0-9]+)"):
+    def __init__(self, action, first_id, second_id, label=None, style=discord.ButtonStyle.secondary, disabled=False):
+        super().__init__(discord.ui.Button(label=label, style=style, disabled=disabled, custom_id=encode_custom_id(action, first_id, second_id)))
+        self.action = action
+        self.first_id = first_id
+        self.second_id = second_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], int(match["first"]), int(match["second"]))
+
+    async def callback(self, interaction):
+        entry = COMPONENT_HANDLERS.get(self.action)
+        if entry is None:
+            return await interaction.response.send_message("❌ This button is no longer supported.", ephemeral=True)
+        handler, action = entry
+        current_interaction.set(interaction)
+        with bot.metrics.timer("button", action):
+            await handler(interaction, action, self.first_id, self.second_id)
+
+# Buttons sent before the custom_id format above used names joined with "_".
+# These keep the ones still sitting in DMs clickable.
+class LegacyJoinRequestButton(discord.ui.DynamicItem[discord.ui.Button], template=r"(?P<action>accept|deny)_(?P<town>.+)_(?P<user>[0-9]+)"):
+    def __init__(self, action, town_name, user_id):
+        super().__init__(discord.ui.Button(custom_id=f"{action}_{town_name}_{user_id}"))
+        self.action = action
+        self.town_name = town_name
+        self.user_id = user_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], match["town"], int(match["user"]))
+
+    async def callback(self, interaction):
+        current_interaction.set(interaction)
+        with bot.metrics.timer("button", self.action):
+            await answer_join_request(interaction, self.action, self.town_name, self.user_id)
+
+class LegacyNationInviteButton(discord.ui.DynamicItem[discord.ui.Button], template=r"(?P<action>naccept|ndeny)_(?P<names>.+)"):
+    def __init__(self, action, names):
+        super().__init__(discord.ui.Button(custom_id=f"{action}_{names}"))
+        self.action = action
+        self.names = names
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], match["names"])
+
+    async def callback(self, interaction):
+        current_interaction.set(interaction)
+        # "<nation>_<town>" is ambiguous when a name has "_" in it, so try
+        # every split and take the one where both names exist
+        parts = self.names.split("_")
+        for i in range(1, len(parts)):
+            nation_name, town_name = "_".join(parts[:i]), "_".join(parts[i:])
+            if nation_name in bot.state.nations and town_name in bot.state.towns:
+                with bot.metrics.timer("button", self.action):
+                    return await answer_nation_invite(interaction, self.action, nation_name, town_name)
+        await interaction.response.send_message("❌ This nation no longer exists.", ephemeral=True)
 
 # (Rest of your original /jail, /announce, /war commands go here)
 # Make sure to re-paste your War and Jail commands back in!
 @bot.tree.command(name="townleave", description="Leave your current town")
 async def leave(interaction: discord.Interaction):
     user = interaction.user
-    towns = load_towns()
-    town_name = next((name for name, town in towns.items() if user.id in town["members"]), None)
+    towns = bot.state.towns
+    town_name = bot.state.member_town.get(user.id)
 
     if town_name is None:
         return await interaction.response.send_message("You are not in any town!", ephemeral=True)
@@ -320,18 +3518,23 @@ async def leave(interaction: discord.Interaction):
     if user.id == town["owner_id"]:
         return await interaction.response.send_message("You cannot leave your town without transferring ownership!", ephemeral=True)
 
+    async with bot.locks.hold(towns=[town_name]):
+        left = bot.state.member_town.get(user.id) == town_name
+        if left:
+            bot.state.remove_member(town_name, user.id)
+    if not left:
+        return await interaction.response.send_message("You are not in any town!", ephemeral=True)
+
     role = interaction.guild.get_role(town["role_id"])
     if role:
         await user.remove_roles(role)
 
-    town["members"].remove(user.id)
-    save_towns(towns)
     await interaction.response.send_message(f"You have left **{town_name}**.", ephemeral=True)
 
 @bot.tree.command(name="townexile", description="Force a player to leave your town")
 async def forceleave(interaction: discord.Interaction, user: discord.User):
-    towns = load_towns()
-    town_name = next((name for name, town in towns.items() if user.id in town["members"]), None)
+    towns = bot.state.towns
+    town_name = bot.state.member_town.get(user.id)
 
     if town_name is None:
         return await interaction.response.send_message("That player isn't in any town!", ephemeral=True)
@@ -340,22 +3543,25 @@ async def forceleave(interaction: discord.Interaction, user: discord.User):
     if interaction.user.id != town["owner_id"]:
         return await interaction.response.send_message("You are not the town owner!", ephemeral=True)
 
+    async with bot.locks.hold(towns=[town_name]):
+        removed = bot.state.member_town.get(user.id) == town_name
+        if removed:
+            bot.state.remove_member(town_name, user.id)
+    if not removed:
+        return await interaction.response.send_message("That player isn't in any town!", ephemeral=True)
+
     role = interaction.guild.get_role(town["role_id"])
     if role:
         member = interaction.guild.get_member(user.id)
         if member:
             await member.remove_roles(role)
 
-    town["members"].remove(user.id)
-    save_towns(towns)
     await interaction.response.send_message(f"🚪 {user.mention} was removed from **{town_name}**.")
 
 @bot.tree.command(name="townjail", description="Give a player a jail role")
 async def jail(interaction: discord.Interaction, user: discord.User):
     guild = interaction.guild
-    jail_role = discord.utils.get(guild.roles, name="Jail")
-    if not jail_role:
-        jail_role = await guild.create_role(name="Jail", colour=discord.Color.red())
+    jail_role = await bot.special_roles.ensure(guild, "Jail")
 
     member = guild.get_member(user.id)
     if member:
@@ -364,30 +3570,97 @@ async def jail(interaction: discord.Interaction, user: discord.User):
 
 @bot.tree.command(name="townannounce", description="Send an announcement to all town members")
 async def announce(interaction: discord.Interaction, message: str):
-    towns = load_towns()
+    towns = bot.state.towns
     user = interaction.user
-    town_name = next((name for name, town in towns.items() if user.id == town["owner_id"]), None)
+    town_name = bot.state.owner_town.get(user.id)
 
     if town_name is None:
         return await interaction.response.send_message("You are not a town owner!", ephemeral=True)
 
-    town = towns[town_name]
-    for member_id in town["members"]:
-        member = interaction.guild.get_member(member_id)
-        if member:
-            try:
-                await member.send(f"📣 **{town_name}** Announcement: {message}")
-            except discord.Forbidden:
-                continue
-
-    await interaction.response.send_message(f"Announcement sent!", ephemeral=True)
+    # Reply right away; the DMs go out in the background
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    bot.announcer.start(
+        user.id, interaction.guild.id, f"{town_name} announcement",
+        f"📣 **{town_name}** Announcement: {message}",
+        towns[town_name]["members"], interaction,
+    )
 
 ###
+# --- Wars ---
+def war_timer(war):
+    return f"war:{war['id']}"
+
+def war_opponent(war, name):
+    return war["defender"] if war["attacker"] == name else war["attacker"]
+
+def declared_by(war):
+    # None for wars carried over from the old war_* fields, which either side may answer
+    return war["history"][0].get("by")
+
+def end_war(war, by=None, reason=None):
+    bot.state.set_war_status(war, "ended", by=by, reason=reason)
+    bot.scheduler.cancel(war_timer(war))
+
+async def notify_war_side(kind, name, message):
+    # DM the town owner or nation leader answering for one side
+    records = bot.state.towns if kind == "town" else bot.state.nations
+    record = records.get(name)
+    if record is not None:
+        await notify_user(record["owner_id"] if kind == "town" else record["leader_id"], message)
+
+@contextlib.asynccontextmanager
+async def hold_war(kind, name):
+    # Lock both sides of the war `name` is in and yield it; None if there is
+    # no war, or it was a different one by the time the locks were held
+    war = bot.state.war_of(kind, name)
+    sides = (war["attacker"], war["defender"]) if war else (name,)
+    async with bot.locks.hold(**{kind + "s": sides}):
+        current = bot.state.war_of(kind, name)
+        yield current if war and current and current["id"] == war["id"] else None
+
+async def expire_war_declarations(timers):
+    # Declarations nobody answered within WAR_DECLARATION_TTL
+    for data in timers:
+        war = bot.state.wars.get(data["war"])
+        if war is None:
+            continue
+        async with hold_war(war["kind"], war["attacker"]) as current:
+            expired = current is not None and current["id"] == data["war"] and current["status"] == "pending"
+            if expired:
+                end_war(current, reason="expired")
+        if expired:
+            await notify_war_side(war["kind"], war["attacker"], f"⌛ Your war declaration on **{war['defender']}** expired without an answer.")
+
+# Scheduler timer kind -> async handler taking a batch of timer data
+TIMER_HANDLERS = {
+    "war": expire_war_declarations,
+    "join": expire_join_requests,
+    "invite": expire_nation_invites,
+}
+
+def schedule_missing_timers():
+    # Requests and declarations made before they had timers (or restored
+    # from a backup, which has no timers) would never expire otherwise
+    timers = bot.state.timers
+    for town in bot.state.towns.values():
+        for user_id in town["pending"]:
+            if join_timer(town, user_id) not in timers:
+                bot.scheduler.schedule(join_timer(town, user_id), JOIN_REQUEST_TTL, "join", {"town": town["role_id"], "user": user_id})
+    for nation in bot.state.nations.values():
+        for town_role_id in nation.get("invites", ()):
+            timer_id = invite_timer(nation["role_id"], town_role_id)
+            if timer_id not in timers:
+                bot.scheduler.schedule(timer_id, NATION_INVITE_TTL, "invite", {"nation": nation["role_id"], "town": town_role_id})
+    for kind in ("town", "nation"):
+        for war in bot.state.wars_in(kind, "pending"):
+            if war_timer(war) not in timers:
+                bot.scheduler.schedule(war_timer(war), WAR_DECLARATION_TTL, "war", {"war": war["id"]})
+
 @bot.tree.command(name="towndeclarewar", description="Declare war on another town")
 async def declarewar(interaction: discord.Interaction, target_town: str):
-    towns = load_towns()
+    towns = bot.state.towns
     user = interaction.user
-    town_name = next((name for name, town in towns.items() if user.id == town["owner_id"]), None)
+    town_name = bot.state.owner_town.get(user.id)
 
     if town_name is None:
         return await interaction.response.send_message("You are not a town owner!", ephemeral=True)
@@ -398,12 +3671,20 @@ async def declarewar(interaction: discord.Interaction, target_town: str):
     if target_town == town_name:
         return await interaction.response.send_message("You cannot declare war on yourself!", ephemeral=True)
 
-    towns[town_name]["war_declared"] = target_town
-    towns[town_name]["war_status"] = "pending" # Status is pending until accepted
-    towns[target_town]["war_declared"] = town_name
-    towns[target_town]["war_status"] = "pending"
-    
-    save_towns(towns)
+    async with bot.locks.hold(towns=[town_name, target_town]):
+        # A town fights one war at a time; a second declaration would overwrite the first
+        busy = next((name for name in (town_name, target_town) if bot.state.war_of("town", name)), None)
+        declared = busy is None and target_town in towns
+        if declared:
+            war = bot.state.declare_war("town", town_name, target_town) # Pending until accepted
+            bot.scheduler.schedule(war_timer(war), WAR_DECLARATION_TTL, "war", {"war": war["id"]})
+
+    if busy == town_name:
+        return await interaction.response.send_message("Your town is already at war!", ephemeral=True)
+    if busy:
+        return await interaction.response.send_message(f"**{target_town}** is already at war!", ephemeral=True)
+    if not declared:
+        return await interaction.response.send_message("Target town not found!", ephemeral=True)
 
     target_data = towns[target_town]
     target_owner = interaction.guild.get_member(target_data["owner_id"])
@@ -412,57 +3693,64 @@ async def declarewar(interaction: discord.Interaction, target_town: str):
     
     await interaction.response.send_message(f"War declaration sent to **{target_town}**!", ephemeral=True)
 
+@declarewar.autocomplete("target_town")
+async def declarewar_autocomplete(interaction: discord.Interaction, current: str):
+    own_town = bot.state.owner_town.get(interaction.user.id)
+    return name_choices(bot.state.town_names.search(current, allow=lambda name: name != own_town))
+
 @bot.tree.command(name="townwaraccept", description="Accept a war declaration")
 async def waraccept(interaction: discord.Interaction):
-    towns = load_towns()
-    town_name = next((name for name, town in towns.items() if interaction.user.id == town["owner_id"]), None)
-
-    if town_name is None or towns[town_name].get("war_status") != "pending":
+    town_name = bot.state.owner_town.get(interaction.user.id)
+
+    accepted = False
+    if town_name is not None:
+        async with hold_war("town", town_name) as war:
+            # Only the town that was declared upon can accept
+            accepted = war is not None and war["status"] == "pending" and declared_by(war) != town_name
+            if accepted:
+                bot.state.set_war_status(war, "active", by=town_name)
+                bot.scheduler.cancel(war_timer(war))
+    if not accepted:
         return await interaction.response.send_message("No pending war declaration to accept!", ephemeral=True)
 
-    target_town = towns[town_name]["war_declared"]
-    
-    # Set both towns to active war status
-    towns[town_name]["war_status"] = "active"
-    towns[target_town]["war_status"] = "active"
-    save_towns(towns)
-
+    target_town = war_opponent(war, town_name)
     await interaction.response.send_message(f"⚔️ War between **{town_name}** and **{target_town}** has officially begun!", ephemeral=False)
 
 @bot.tree.command(name="townwardeny", description="Deny a war declaration")
 async def wardeny(interaction: discord.Interaction):
-    towns = load_towns()
-    town_name = next((name for name, town in towns.items() if interaction.user.id == town["owner_id"]), None)
-
-    if town_name and "war_declared" in towns[town_name]:
-        target = towns[town_name]["war_declared"]
-        towns[town_name].pop("war_declared", None)
-        towns[town_name].pop("war_status", None)
-        towns[target].pop("war_declared", None)
-        towns[target].pop("war_status", None)
-        save_towns(towns)
-        await interaction.response.send_message("War declaration denied.")
+    town_name = bot.state.owner_town.get(interaction.user.id)
+
+    denied = False
+    if town_name is not None:
+        async with hold_war("town", town_name) as war:
+            denied = war is not None and war["status"] == "pending" and declared_by(war) != town_name
+            if denied:
+                end_war(war, by=town_name, reason="denied")
+    if not denied:
+        return await interaction.response.send_message("No pending war declaration to deny!", ephemeral=True)
+    await interaction.response.send_message("War declaration denied.")
 
 @bot.tree.command(name="townwarceasefire", description="End the active war")
 async def warceasefire(interaction: discord.Interaction):
-    towns = load_towns()
-    town_name = next((name for name, town in towns.items() if interaction.user.id == town["owner_id"]), None)
+    town_name = bot.state.owner_town.get(interaction.user.id)
     
-    if town_name and towns[town_name].get("war_status") == "active":
-        target = towns[town_name]["war_declared"]
-        
-        towns[town_name].pop("war_declared", None)
-        towns[town_name].pop("war_status", None)
-        towns[target].pop("war_declared", None)
-        towns[target].pop("war_status", None)
-        save_towns(towns)
-        await interaction.response.send_message(f"🏳️ A ceasefire has been signed between **{town_name}** and **{target}**.")
+    ended = False
+    if town_name is not None:
+        async with hold_war("town", town_name) as war:
+            ended = war is not None and war["status"] == "active"
+            if ended:
+                end_war(war, by=town_name, reason="ceasefire")
+    if not ended:
+        return await interaction.response.send_message("Your town is not in an active war!", ephemeral=True)
+
+    target = war_opponent(war, town_name)
+    await interaction.response.send_message(f"🏳️ A ceasefire has been signed between **{town_name}** and **{target}**.")
 ###
 @bot.tree.command(name="townunjail", description="Remove the jail role from a player")
 @app_commands.checks.has_permissions(manage_roles=True) # Only staff/admins should usually do this
 async def unjail(interaction: discord.Interaction, user: discord.User):
     guild = interaction.guild
-    jail_role = discord.utils.get(guild.roles, name="Jail")
+    jail_role = bot.special_roles.get(guild, "Jail")
     
     if not jail_role:
         return await interaction.response.send_message("The Jail role doesn't exist.", ephemeral=True)
@@ -476,105 +3764,125 @@ async def unjail(interaction: discord.Interaction, user: discord.User):
 
 @bot.tree.command(name="towntransferownership", description="Transfer your town to another member")
 async def transferownership(interaction: discord.Interaction, new_owner: discord.Member):
-    towns = load_towns()
     user = interaction.user
     
     # Find the town the user owns
-    town_name = next((name for name, town in towns.items() if user.id == town["owner_id"]), None)
+    town_name = bot.state.owner_town.get(user.id)
 
     if town_name is None:
         return await interaction.response.send_message("❌ You do not own a town!", ephemeral=True)
 
-    town = towns[town_name]
-
     # Verify the new owner is actually in the town
-    if new_owner.id not in town["members"]:
+    if bot.state.member_town.get(new_owner.id) != town_name:
         return await interaction.response.send_message(f"❌ {new_owner.display_name} must be a member of the town before they can own it.", ephemeral=True)
 
     if new_owner.id == user.id:
         return await interaction.response.send_message("You already own this town!", ephemeral=True)
 
-    # Perform the transfer
-    town["owner_id"] = new_owner.id
-    save_towns(towns)
+    # Perform the transfer, if nothing changed while we waited for the lock
+    async with bot.locks.hold(towns=[town_name]):
+        transferred = bot.state.owner_town.get(user.id) == town_name and bot.state.member_town.get(new_owner.id) == town_name
+        if transferred:
+            bot.state.set_town_owner(town_name, new_owner.id)
+    if not transferred:
+        return await interaction.response.send_message(f"❌ **{town_name}** changed while transferring. Check the town and try again.", ephemeral=True)
 
     await interaction.response.send_message(f"👑 Ownership of **{town_name}** has been transferred to {new_owner.mention}!")
     await new_owner.send(f"🏰 You are now the owner of **{town_name}**!")
 
 @bot.tree.command(name="towndelete", description="Permanently delete your town and its role")
 async def delete(interaction: discord.Interaction):
-    towns = load_towns()
     user = interaction.user
     guild = interaction.guild
 
     # Find the town the user owns
-    town_name = next((name for name, town in towns.items() if user.id == town["owner_id"]), None)
+    town_name = bot.state.owner_town.get(user.id)
 
     if town_name is None:
         return await interaction.response.send_message("❌ You do not own a town to delete!", ephemeral=True)
 
-    town_data = towns[town_name]
+    # 1. Remove the town from the database
+    async with bot.locks.hold(towns=[town_name]):
+        town_data = None
+        if bot.state.owner_town.get(user.id) == town_name:
+            town_data = bot.state.delete_town(town_name)
+            war = bot.state.war_of("town", town_name)
+            if war is not None:
+                end_war(war, by=town_name, reason="town deleted")
+    if town_data is None:
+        return await interaction.response.send_message("❌ You do not own a town to delete!", ephemeral=True)
 
-    # 1. Delete the role from the server
-    role = guild.get_role(town_data["role_id"])
-    if role:
-        try:
-            await role.delete(reason=f"Town {town_name} deleted by owner.")
-        except discord.Forbidden:
-            await interaction.channel.send("⚠️ I couldn't delete the role. Make sure my bot role is higher than the town role!")
-        except discord.HTTPException:
-            await interaction.channel.send("⚠️ An error occurred while trying to delete the role.")
+    # 2. Delete the role from the server in the background
+    await interaction.response.defer(ephemeral=True, thinking=True)
 
-    # 2. Remove the town from the database
-    del towns[town_name]
-    save_towns(towns)
+    async def work(job):
+        role = guild.get_role(town_data["role_id"])
+        if role:
+            try:
+                await job.call(role.delete, reason=f"Town {town_name} deleted by owner.")
+            except discord.Forbidden:
+                return f"💥 **{town_name}** has been disbanded, but ⚠️ I couldn't delete the role. Make sure my bot role is higher than the town role!"
+            except discord.HTTPException:
+                return f"💥 **{town_name}** has been disbanded, but ⚠️ an error occurred while trying to delete the role."
+        return f"💥 **{town_name}** has been permanently disbanded and its role has been deleted."
 
-    await interaction.response.send_message(f"💥 **{town_name}** has been permanently disbanded and its role has been deleted.", ephemeral=True)
+    bot.jobs.submit("towndelete", work, interaction)
 
 ### NATION COMMANDS ###
 @bot.tree.command(name="nationcreate", description="Create a nation and a nation role")
 # Changed 'name' to 'nation_name' below to match the function argument
 @app_commands.describe(nation_name="Nation name", colour="Role colour (hex, e.g. #ff5733)")
 async def nationcreate(interaction: discord.Interaction, nation_name: str, colour: str):
-    towns = load_towns()
-    nations = load_nations()
     user = interaction.user
 
-    town_name = next((name for name, t in towns.items() if user.id == t["owner_id"]), None)
+    town_name = bot.state.owner_town.get(user.id)
     if not town_name:
         return await interaction.response.send_message("❌ Only town owners can create nations!", ephemeral=True)
 
-    # Create the Discord Role
     try:
-        role = await interaction.guild.create_role(
-            name=f"Nation: {nation_name}",
-            colour=discord.Colour.from_str(colour),
-            reason="Nation creation"
-        )
-    except:
+        role_colour = discord.Colour.from_str(colour)
+    except ValueError:
         return await interaction.response.send_message("❌ Invalid hex color! Use something like #ff5733", ephemeral=True)
 
-    await user.add_roles(role)
+    # Create the Discord Role in the background
+    await interaction.response.defer(thinking=True)
+    guild = interaction.guild
 
-    nations[nation_name] = {
-        "leader_id": user.id,
-        "capital_town": town_name,
-        "member_towns": [town_name],
-        "role_id": role.id,
-        "war_status": None,
-        "war_target": None
-    }
-    
-    save_nations(nations)
-    await interaction.response.send_message(f"🚩 Nation **{nation_name}** founded! Role created.")
+    async def work(job):
+        role = await job.call(guild.create_role, name=f"Nation: {nation_name}", colour=role_colour, reason="Nation creation")
+        try:
+            await job.call(user.add_roles, role)
+
+            # The name may have been taken while we were creating the role
+            async with bot.locks.hold(towns=[town_name], nations=[nation_name]):
+                created = nation_name not in bot.state.nations
+                if created:
+                    bot.state.create_nation(nation_name, {
+                        "leader_id": user.id,
+                        "capital_town": town_name,
+                        "member_towns": [town_name],
+                        "role_id": role.id,
+                        "invites": [],
+                    })
+        except Exception:
+            # Don't leave an orphaned role behind
+            with contextlib.suppress(discord.HTTPException):
+                await role.delete(reason="Nation creation failed")
+            raise
+
+        if not created:
+            await job.call(role.delete, reason="Nation name was taken while creating")
+            return "❌ That nation already exists!"
+        return f"🚩 Nation **{nation_name}** founded! Role created."
+
+    bot.jobs.submit("nationcreate", work, interaction)
 
 @bot.tree.command(name="nationinvite", description="Invite a town to join your nation")
 async def nationinvite(interaction: discord.Interaction, target_town_name: str):
-    nations = load_nations()
-    towns = load_towns()
+    towns = bot.state.towns
     
     # Check if sender leads a nation
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
     if not nation_name:
         return await interaction.response.send_message("❌ Only nation leaders can invite towns!", ephemeral=True)
 
@@ -584,45 +3892,77 @@ async def nationinvite(interaction: discord.Interaction, target_town_name: str):
     target_town = towns[target_town_name]
     
     # Check if they are already in a nation
-    if any(target_town_name in n["member_towns"] for n in nations.values()):
+    if target_town_name in bot.state.town_nation:
         return await interaction.response.send_message("❌ That town is already in a nation!", ephemeral=True)
 
     target_owner = interaction.guild.get_member(target_town["owner_id"])
     if not target_owner:
         return await interaction.response.send_message("❌ Could not find the owner of that town.", ephemeral=True)
 
-    # Create Buttons
-    # custom_id format: naccept_NATIONNAME_TOWNNAME
-    view = View()
-    view.add_item(Button(label="Accept", style=discord.ButtonStyle.green, custom_id=f"naccept_{nation_name}_{target_town_name}"))
-    view.add_item(Button(label="Deny", style=discord.ButtonStyle.red, custom_id=f"ndeny_{nation_name}_{target_town_name}"))
+    async with bot.locks.hold(towns=[target_town_name], nations=[nation_name]):
+        nation = bot.state.nations.get(nation_name)
+        invited = nation is not None and target_town["role_id"] not in nation.get("invites", ())
+        if invited:
+            bot.state.add_invite(nation_name, target_town["role_id"])
+    if not invited:
+        return await interaction.response.send_message("❌ You already invited that town! Wait for them to answer.", ephemeral=True)
+
+    # Create Buttons (see encode_custom_id for the custom_id format)
+    view = View(timeout=None)
+    view.add_item(TownyButton("na", nation["role_id"], target_town["role_id"], label="Accept", style=discord.ButtonStyle.green))
+    view.add_item(TownyButton("nd", nation["role_id"], target_town["role_id"], label="Deny", style=discord.ButtonStyle.red))
 
-    await target_owner.send(f"🏰 **{interaction.user.display_name}** has invited your town (**{target_town_name}**) to join the nation of **{nation_name}**!", view=view)
+    try:
+        message = await target_owner.send(f"🏰 **{interaction.user.display_name}** has invited your town (**{target_town_name}**) to join the nation of **{nation_name}**!", view=view)
+    except discord.HTTPException:
+        async with bot.locks.hold(nations=[nation_name]):
+            bot.state.remove_invite(nation_name, target_town["role_id"])
+        return await interaction.response.send_message("❌ Couldn't DM the owner of that town.", ephemeral=True)
+    bot.scheduler.schedule(invite_timer(nation["role_id"], target_town["role_id"]), NATION_INVITE_TTL, "invite", {"nation": nation["role_id"], "town": target_town["role_id"], **message_ref(message)})
     await interaction.response.send_message(f"📩 Invitation sent to the owner of **{target_town_name}**.", ephemeral=True)
 
+@nationinvite.autocomplete("target_town_name")
+async def nationinvite_autocomplete(interaction: discord.Interaction, current: str):
+    # Only towns that aren't already in a nation can be invited
+    town_nation = bot.state.town_nation
+    return name_choices(bot.state.town_names.search(current, allow=lambda name: name not in town_nation))
+
 @bot.tree.command(name="nationdisband", description="Disband your nation and delete its role")
 async def nationdisband(interaction: discord.Interaction):
-    nations = load_nations()
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
 
     if not nation_name:
         return await interaction.response.send_message("❌ You don't lead a nation!", ephemeral=True)
 
-    # Delete Role
-    role = interaction.guild.get_role(nations[nation_name]["role_id"])
-    if role:
-        await role.delete()
+    async with bot.locks.hold(nations=[nation_name]):
+        nation = None
+        if bot.state.leader_nation.get(interaction.user.id) == nation_name:
+            nation = bot.state.disband_nation(nation_name)
+            war = bot.state.war_of("nation", nation_name)
+            if war is not None:
+                end_war(war, by=nation_name, reason="nation disbanded")
+    if nation is None:
+        return await interaction.response.send_message("❌ You don't lead a nation!", ephemeral=True)
 
-    del nations[nation_name]
-    save_nations(nations)
-    await interaction.response.send_message(f"💥 The nation of **{nation_name}** has been disbanded.")
+    # Delete Role in the background
+    await interaction.response.defer(thinking=True)
+    role = interaction.guild.get_role(nation["role_id"])
+
+    async def work(job):
+        if role:
+            await job.call(role.delete)
+        return f"💥 The nation of **{nation_name}** has been disbanded."
+
+    bot.jobs.submit("nationdisband", work, interaction)
 
 ##NATION WAR###
+WAR_LIST_SIZE = 25  # wars shown by /nationactivewars
+
 @bot.tree.command(name="nationdeclarewar", description="Declare war on another nation")
 async def nationdeclarewar(interaction: discord.Interaction, target_nation: str):
-    nations = load_nations()
+    nations = bot.state.nations
     # Find which nation the user leads
-    sender_nation = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    sender_nation = bot.state.leader_nation.get(interaction.user.id)
 
     if not sender_nation:
         return await interaction.response.send_message("❌ Only nation leaders can declare war!", ephemeral=True)
@@ -633,144 +3973,130 @@ async def nationdeclarewar(interaction: discord.Interaction, target_nation: str)
     if target_nation == sender_nation:
         return await interaction.response.send_message("❌ You cannot declare war on yourself!", ephemeral=True)
 
-    # Set statuses to pending
-    nations[sender_nation]["war_target"] = target_nation
-    nations[sender_nation]["war_status"] = "pending"
-    nations[target_nation]["war_target"] = sender_nation
-    nations[target_nation]["war_status"] = "pending"
-    
-    save_nations(nations)
-    
-    target_leader_id = nations[target_nation]["leader_id"]
-    target_leader = await bot.fetch_user(target_leader_id)
-    
-    if target_leader:
-        await target_leader.send(f"⚔️ **{sender_nation}** has declared war on **{target_nation}**! Use `/nationwaraccept` to begin the conflict.")
+    # Register the war as pending; it expires if nobody answers
+    async with bot.locks.hold(nations=[sender_nation, target_nation]):
+        busy = next((name for name in (sender_nation, target_nation) if bot.state.war_of("nation", name)), None)
+        declared = busy is None and target_nation in nations
+        if declared:
+            war = bot.state.declare_war("nation", sender_nation, target_nation)
+            bot.scheduler.schedule(war_timer(war), WAR_DECLARATION_TTL, "war", {"war": war["id"]})
+
+    if busy == sender_nation:
+        return await interaction.response.send_message("❌ Your nation is already at war! End that war first.", ephemeral=True)
+    if busy:
+        return await interaction.response.send_message(f"❌ **{target_nation}** is already at war!", ephemeral=True)
+    if not declared:
+        return await interaction.response.send_message("❌ Target nation not found!", ephemeral=True)
+
+    await notify_war_side("nation", target_nation, f"⚔️ **{sender_nation}** has declared war on **{target_nation}**! Use `/nationwaraccept` to begin the conflict.")
 
     await interaction.response.send_message(f"📡 War declaration sent to **{target_nation}**!", ephemeral=True)
 
+@nationdeclarewar.autocomplete("target_nation")
+async def nationdeclarewar_autocomplete(interaction: discord.Interaction, current: str):
+    own_nation = bot.state.leader_nation.get(interaction.user.id)
+    return name_choices(bot.state.nation_names.search(current, allow=lambda name: name != own_nation))
+
 @bot.tree.command(name="nationwaraccept", description="Accept a war declaration against your nation")
 async def nationwaraccept(interaction: discord.Interaction):
-    nations = load_nations()
-    
-    # 1. Find the nation the user leads
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
 
     if not nation_name:
         return await interaction.response.send_message("❌ You are not a nation leader!", ephemeral=True)
 
-    # 2. Check if they have a pending war
-    if nations[nation_name].get("war_status") != "pending":
-        return await interaction.response.send_message("❌ You have no pending war declarations to accept.", ephemeral=True)
+    async with hold_war("nation", nation_name) as war:
+        pending = war is not None and war["status"] == "pending"
+        # The attacker can't accept their own declaration
+        own = pending and declared_by(war) == nation_name
+        if pending and not own:
+            bot.state.set_war_status(war, "active", by=nation_name)
+            bot.scheduler.cancel(war_timer(war))
 
-    # 3. SECURE CHECK: Did THIS nation receive the declaration?
-    # We check if the target of the war is actually the nation the sender started it with
-    target_nation_name = nations[nation_name].get("war_target")
-    
-    # In a pending state, both nations point to each other. 
-    # To prevent the 'attacker' from accepting their own war, we ensure 
-    # the person calling this is the one who WAS declared upon.
-    
-    # We look at the attacker's data to see if THEY were the ones who initiated
-    # In our logic, the attacker is nations[target_nation_name]
-    attacker_data = nations.get(target_nation_name)
-    
-    if attacker_data and attacker_data.get("leader_id") == interaction.user.id:
+    if not pending:
+        return await interaction.response.send_message("❌ You have no pending war declarations to accept.", ephemeral=True)
+    if own:
         return await interaction.response.send_message("❌ You cannot accept your own war declaration! You must wait for the other leader to respond.", ephemeral=True)
 
-    # 4. Proceed with acceptance
-    nations[nation_name]["war_status"] = "active"
-    nations[target_nation_name]["war_status"] = "active"
-    save_nations(nations)
-
+    target_nation_name = war_opponent(war, nation_name)
     await interaction.response.send_message(f"⚔️ **WAR HAS BEGUN**! **{nation_name}** has accepted the challenge from **{target_nation_name}**!", ephemeral=False)
 
 @bot.tree.command(name="nationwardeny", description="Deny a war declaration")
 async def nationwardeny(interaction: discord.Interaction):
-    nations = load_nations()
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
-
-    if not nation_name or nations[nation_name].get("war_status") != "pending":
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
+
+    pending = own = False
+    if nation_name:
+        async with hold_war("nation", nation_name) as war:
+            pending = war is not None and war["status"] == "pending"
+            # Prevent attacker from denying their own declaration
+            own = pending and declared_by(war) == nation_name
+            if pending and not own:
+                end_war(war, by=nation_name, reason="denied")
+
+    if not pending:
         return await interaction.response.send_message("❌ No pending war to deny.", ephemeral=True)
+    if own:
+        return await interaction.response.send_message("❌ You cannot deny your own declaration. It expires if they don't answer.", ephemeral=True)
 
-    target_nation_name = nations[nation_name].get("war_target")
-    attacker_data = nations.get(target_nation_name)
-
-    # SECURE CHECK: Prevent attacker from denying their own declaration
-    if attacker_data and attacker_data.get("leader_id") == interaction.user.id:
-        return await interaction.response.send_message("❌ You cannot deny your own declaration. You can only wait or use a ceasefire command if available.", ephemeral=True)
-
-    # Clean up the war data for both
-    nations[nation_name].pop("war_target", None)
-    nations[nation_name].pop("war_status", None)
-    nations[target_nation_name].pop("war_target", None)
-    nations[target_nation_name].pop("war_status", None)
-    save_nations(nations)
-
+    target_nation_name = war_opponent(war, nation_name)
     await interaction.response.send_message(f"🛡️ **{nation_name}** has declined the war declaration from **{target_nation_name}**.")
 
-# Create a temporary dictionary at the top of your script to track ceasefire requests
-# ceasefire_requests = {} 
-
 @bot.tree.command(name="nationceasefire", description="Propose or accept a ceasefire to end a nation war")
 async def nationceasefire(interaction: discord.Interaction):
-    nations = load_nations()
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
 
     if not nation_name:
         return await interaction.response.send_message("❌ Only nation leaders can call for a ceasefire!", ephemeral=True)
 
-    if nations[nation_name].get("war_status") != "active":
+    async with hold_war("nation", nation_name) as war:
+        outcome = None
+        if war is not None and war["status"] == "active":
+            # First to propose it
+            war["ceasefire_by"] = nation_name
+            bot.state.set_war_status(war, "ceasefire_requested", by=nation_name)
+            outcome = "proposed"
+        elif war is not None and war["status"] == "ceasefire_requested":
+            if war.get("ceasefire_by") == nation_name:
+                outcome = "waiting"
+            else:
+                # Both agreed! End the war.
+                end_war(war, by=nation_name, reason="ceasefire")
+                outcome = "ended"
+
+    if outcome is None:
         return await interaction.response.send_message("❌ Your nation is not currently in an active war.", ephemeral=True)
 
-    target_nation = nations[nation_name]["war_target"]
-    
-    # Check if the other nation already proposed a ceasefire
-    # We use the war_status 'ceasefire_offered' to track this in the JSON
-    if nations[target_nation].get("war_status") == "ceasefire_requested":
-        # Both agreed! End the war.
-        nations[nation_name].pop("war_target", None)
-        nations[nation_name].pop("war_status", None)
-        nations[target_nation].pop("war_target", None)
-        nations[target_nation].pop("war_status", None)
-        save_nations(nations)
-        
+    target_nation = war_opponent(war, nation_name)
+    if outcome == "waiting":
+        await interaction.response.send_message(f"📜 You already proposed a ceasefire. **{target_nation}** must use `/nationceasefire` to accept.", ephemeral=True)
+    elif outcome == "ended":
         await interaction.response.send_message(f"🏳️ **PEACE DECLARED!** Both **{nation_name}** and **{target_nation}** have agreed to a ceasefire.")
-        
         # Notify the other leader
-        other_leader = await bot.fetch_user(nations[target_nation]["leader_id"])
-        if other_leader:
-            await other_leader.send(f"🏳️ The war between **{nation_name}** and **{target_nation}** has ended by mutual agreement.")
+        await notify_war_side("nation", target_nation, f"🏳️ The war between **{nation_name}** and **{target_nation}** has ended by mutual agreement.")
     else:
-        # First person to propose it
-        nations[nation_name]["war_status"] = "ceasefire_requested"
-        save_nations(nations)
-        
         await interaction.response.send_message(f"📜 Ceasefire proposed to **{target_nation}**. They must also use `/nationceasefire` to accept.")
-        
-        other_leader = await bot.fetch_user(nations[target_nation]["leader_id"])
-        if other_leader:
-            await other_leader.send(f"🏳️ **{nation_name}** has proposed a ceasefire! Type `/nationceasefire` in the server to accept and end the war.")
+        await notify_war_side("nation", target_nation, f"🏳️ **{nation_name}** has proposed a ceasefire! Type `/nationceasefire` in the server to accept and end the war.")
 
 @bot.tree.command(name="nationactivewars", description="Show all ongoing nation wars")
 async def nationactivewars(interaction: discord.Interaction):
-    nations = load_nations()
+    nations = bot.state.nations
     embed = discord.Embed(title="⚔️ Active Nation Conflicts", color=discord.Color.red())
-    
+
+    # Straight from the registry: only wars that are on, each listed once
+    wars = itertools.islice(bot.state.wars_in("nation", "active", "ceasefire_requested"), WAR_LIST_SIZE)
     active_wars = []
-    processed_pairs = set()
-
-    for nation_name, data in nations.items():
-        if data.get("war_status") == "active":
-            target = data.get("war_target")
-            # Sort the pair so we don't list (A vs B) and (B vs A) separately
-            pair = tuple(sorted([nation_name, target]))
-            
-            if pair not in processed_pairs:
-                member_count = len(data.get("member_towns", []))
-                target_member_count = len(nations[target].get("member_towns", []))
-                active_wars.append(f"🚩 **{nation_name}** ({member_count} towns) vs **{target}** ({target_member_count} towns)")
-                processed_pairs.add(pair)
+    for war in wars:
+        sides = []
+        for name in (war["attacker"], war["defender"]):
+            member_count = len(nations[name]["member_towns"]) if name in nations else 0
+            sides.append(f"**{name}** ({member_count} towns)")
+        since = int(next((entry["at"] for entry in war["history"] if entry["status"] == "active"), war["history"][0]["at"]))
+        truce = " 🏳️ ceasefire proposed" if war["status"] == "ceasefire_requested" else ""
+        active_wars.append(f"🚩 {sides[0]} vs {sides[1]}, since <t:{since}:R>{truce}")
+
+    total = sum(len(bot.state.live_wars.get(("nation", status), ())) for status in ("active", "ceasefire_requested"))
+    if total > len(active_wars):
+        active_wars.append(f"…and {total - len(active_wars)} more")
 
     if active_wars:
         embed.description = "\n".join(active_wars)
@@ -781,43 +4107,46 @@ async def nationactivewars(interaction: discord.Interaction):
 ##NATION OWNERSHIP CONTROL ###
 @bot.tree.command(name="nationleave", description="Make your town leave its current nation")
 async def nationleave(interaction: discord.Interaction):
-    towns = load_towns()
-    nations = load_nations()
+    nations = bot.state.nations
     
-    town_name = next((name for name, t in towns.items() if interaction.user.id == t["owner_id"]), None)
+    town_name = bot.state.owner_town.get(interaction.user.id)
     if not town_name:
         return await interaction.response.send_message("❌ Only town owners can leave nations!", ephemeral=True)
 
-    nation_name = next((name for name, n in nations.items() if town_name in n["member_towns"]), None)
+    nation_name = bot.state.town_nation.get(town_name)
     if not nation_name:
         return await interaction.response.send_message("❌ Your town isn't in a nation!", ephemeral=True)
 
     if nations[nation_name]["capital_town"] == town_name:
         return await interaction.response.send_message("❌ The capital town cannot leave! Disband the nation or transfer leadership first.", ephemeral=True)
 
-    nations[nation_name]["member_towns"].remove(town_name)
-    save_nations(nations)
+    async with bot.locks.hold(towns=[town_name], nations=[nation_name]):
+        left = bot.state.town_nation.get(town_name) == nation_name
+        if left:
+            bot.state.remove_nation_town(nation_name, town_name)
+    if not left:
+        return await interaction.response.send_message(f"❌ **{town_name}** has already left **{nation_name}**.", ephemeral=True)
     await interaction.response.send_message(f"🚪 **{town_name}** has left the nation of **{nation_name}**.")
 
 @bot.tree.command(name="nationexile", description="Exile a player from a town within your nation")
 @app_commands.describe(player="The player to exile")
 async def nationexile(interaction: discord.Interaction, player: discord.Member):
-    nations = load_nations()
-    towns = load_towns()
+    nations = bot.state.nations
+    towns = bot.state.towns
     
     # 1. Find the nation the command user leads
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
     if not nation_name:
         return await interaction.response.send_message("❌ Only nation leaders can use this command!", ephemeral=True)
 
     # 2. Find which town the target player belongs to
-    target_town_name = next((name for name, t in towns.items() if player.id in t["members"]), None)
+    target_town_name = bot.state.member_town.get(player.id)
     
     if not target_town_name:
         return await interaction.response.send_message("❌ That player is not in any town.", ephemeral=True)
 
     # 3. Check if that town is actually in the leader's nation
-    if target_town_name not in nations[nation_name]["member_towns"]:
+    if bot.state.town_nation.get(target_town_name) != nation_name:
         return await interaction.response.send_message(f"❌ **{target_town_name}** is not part of your nation!", ephemeral=True)
 
     # 4. Prevent exiling the Nation Leader or the Town Owner (Safety check)
@@ -828,8 +4157,12 @@ async def nationexile(interaction: discord.Interaction, player: discord.Member):
         return await interaction.response.send_message("❌ You cannot exile a Town Owner. You must exile their entire town instead using a different method.", ephemeral=True)
 
     # 5. Remove the player from the town and role
-    towns[target_town_name]["members"].remove(player.id)
-    save_towns(towns)
+    async with bot.locks.hold(towns=[target_town_name], nations=[nation_name]):
+        exiled = bot.state.member_town.get(player.id) == target_town_name and bot.state.town_nation.get(target_town_name) == nation_name
+        if exiled:
+            bot.state.remove_member(target_town_name, player.id)
+    if not exiled:
+        return await interaction.response.send_message(f"❌ {player.display_name} is no longer a member of **{target_town_name}**.", ephemeral=True)
 
     role = interaction.guild.get_role(towns[target_town_name]["role_id"])
     if role:
@@ -845,64 +4178,223 @@ async def nationexile(interaction: discord.Interaction, player: discord.Member):
         pass
 @bot.tree.command(name="nationannounce", description="Send an announcement to all towns in your nation")
 async def nationannounce(interaction: discord.Interaction, message: str):
-    nations = load_nations()
-    towns = load_towns()
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nations = bot.state.nations
+    towns = bot.state.towns
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
 
     if not nation_name:
         return await interaction.response.send_message("❌ Only nation leaders can announce!", ephemeral=True)
 
-    for t_name in nations[nation_name]["member_towns"]:
-        owner_id = towns[t_name]["owner_id"]
-        owner = interaction.guild.get_member(owner_id)
-        if owner:
-            try:
-                await owner.send(f"🚩 **{nation_name} Nation Announcement**: {message}")
-            except: continue
-
-    await interaction.response.send_message("Announcement sent to all town owners.", ephemeral=True)
+    # Reply right away; the DMs go out to the town owners in the background
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    owner_ids = [towns[t_name]["owner_id"] for t_name in nations[nation_name]["member_towns"] if t_name in towns]
+    bot.announcer.start(
+        interaction.user.id, interaction.guild.id, f"{nation_name} nation announcement",
+        f"🚩 **{nation_name} Nation Announcement**: {message}",
+        owner_ids, interaction,
+    )
 
 @bot.tree.command(name="nationtransfer", description="Transfer leadership of the nation to another town owner")
 async def nationtransfer(interaction: discord.Interaction, new_leader: discord.Member):
-    nations = load_nations()
-    towns = load_towns()
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nations = bot.state.nations
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
 
     if not nation_name:
         return await interaction.response.send_message("❌ You are not the nation leader!", ephemeral=True)
 
     # Check if new leader owns a town in the nation
-    target_town = next((name for name, t in towns.items() if new_leader.id == t["owner_id"]), None)
-    if not target_town or target_town not in nations[nation_name]["member_towns"]:
+    target_town = bot.state.owner_town.get(new_leader.id)
+    if not target_town or bot.state.town_nation.get(target_town) != nation_name:
         return await interaction.response.send_message("❌ The new leader must be a town owner within your nation!", ephemeral=True)
 
-    nations[nation_name]["leader_id"] = new_leader.id
+    async with bot.locks.hold(towns=[target_town], nations=[nation_name]):
+        transferred = (
+            bot.state.leader_nation.get(interaction.user.id) == nation_name
+            and bot.state.owner_town.get(new_leader.id) == target_town
+            and bot.state.town_nation.get(target_town) == nation_name
+        )
+        if transferred:
+            bot.state.set_nation_leader(nation_name, new_leader.id)
+    if not transferred:
+        return await interaction.response.send_message(f"❌ **{nation_name}** changed while transferring. Check the nation and try again.", ephemeral=True)
     # Note: Capital stays the same as per your request
-    save_nations(nations)
 
     await interaction.response.send_message(f"👑 **{new_leader.display_name}** is now the leader of **{nation_name}**! The capital remains **{nations[nation_name]['capital_town']}**.")
 
 @bot.tree.command(name="nationsetcapital", description="Change the capital town of your nation")
 async def nationsetcapital(interaction: discord.Interaction, new_capital: str):
-    nations = load_nations()
-    nation_name = next((name for name, n in nations.items() if interaction.user.id == n["leader_id"]), None)
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
 
     if not nation_name:
         return await interaction.response.send_message("❌ Only the nation leader can change the capital!", ephemeral=True)
 
-    if new_capital not in nations[nation_name]["member_towns"]:
+    if bot.state.town_nation.get(new_capital) != nation_name:
         return await interaction.response.send_message("❌ That town is not in your nation!", ephemeral=True)
 
-    nations[nation_name]["capital_town"] = new_capital
-    save_nations(nations)
+    async with bot.locks.hold(towns=[new_capital], nations=[nation_name]):
+        moved = bot.state.leader_nation.get(interaction.user.id) == nation_name and bot.state.town_nation.get(new_capital) == nation_name
+        if moved:
+            bot.state.set_nation_capital(nation_name, new_capital)
+    if not moved:
+        return await interaction.response.send_message("❌ That town is no longer in your nation!", ephemeral=True)
     await interaction.response.send_message(f"🏛️ The capital of **{nation_name}** has been moved to **{new_capital}**!")
 
+@nationsetcapital.autocomplete("new_capital")
+async def nationsetcapital_autocomplete(interaction: discord.Interaction, current: str):
+    # Only towns in the caller's own nation; that list is short, so just filter it
+    nation_name = bot.state.leader_nation.get(interaction.user.id)
+    if nation_name is None:
+        return []
+    folded = current.casefold()
+    member_towns = bot.state.nations[nation_name]["member_towns"]
+    matches = sorted((name for name in member_towns if folded in name.casefold()), key=lambda name: (not name.casefold().startswith(folded), name.casefold()))
+    return name_choices(matches[:25])
+
+### LEADERBOARDS & INFO ###
+LEADERBOARD_SIZE = 10
+# board -> (ranking attribute on the state, title, what the score counts)
+LEADERBOARDS = {
+    "towns": ("town_sizes", "🏘️ Largest Towns", "members"),
+    "nations_towns": ("nation_town_counts", "🚩 Largest Nations by Towns", "towns"),
+    "nations_members": ("nation_member_totals", "👥 Largest Nations by Members", "members"),
+}
+leaderboard_cache = {}  # board -> (ranking version, embed)
+
+def leaderboard_embed(board):
+    attr, title, unit = LEADERBOARDS[board]
+    ranking = getattr(bot.state, attr)
+    cached = leaderboard_cache.get(board)
+    if cached is not None and cached[0] == ranking.version:
+        return cached[1]
+    embed = discord.Embed(title=title, color=discord.Color.gold())
+    lines = [f"**{rank}.** {name} — {score} {unit}" for rank, (name, score) in enumerate(ranking.top(LEADERBOARD_SIZE), 1)]
+    embed.description = "\n".join(lines) or "Nothing to rank yet."
+    embed.set_footer(text=f"{len(ranking)} ranked")
+    leaderboard_cache[board] = (ranking.version, embed)
+    return embed
+
+@bot.tree.command(name="leaderboard", description="Show the largest towns or nations")
+@app_commands.describe(board="Which ranking to show")
+@app_commands.choices(board=[
+    app_commands.Choice(name="Largest towns", value="towns"),
+    app_commands.Choice(name="Nations by towns", value="nations_towns"),
+    app_commands.Choice(name="Nations by members", value="nations_members"),
+])
+async def leaderboard(interaction: discord.Interaction, board: str = "towns"):
+    await interaction.response.send_message(embed=leaderboard_embed(board))
+
+@bot.tree.command(name="towninfo", description="Show details about a town")
+async def towninfo(interaction: discord.Interaction, town_name: str):
+    state = bot.state
+    town = state.towns.get(town_name)
+    if town is None:
+        return await interaction.response.send_message("Town not found!", ephemeral=True)
+
+    embed = discord.Embed(title=f"🏘️ {town_name}", color=discord.Color.green())
+    embed.add_field(name="Owner", value=f"<@{town['owner_id']}>")
+    embed.add_field(name="Members", value=f"{len(town['members'])} (#{state.town_sizes.rank(town_name)} of {len(state.town_sizes)})")
+    embed.add_field(name="Nation", value=state.town_nation.get(town_name) or "None")
+    embed.add_field(name="Pending requests", value=str(len(town["pending"])))
+    war = state.war_of("town", town_name)
+    if war is not None:
+        embed.add_field(name="War", value=f"{war['status']} vs {war_opponent(war, town_name)}")
+    await interaction.response.send_message(embed=embed)
+
+@towninfo.autocomplete("town_name")
+async def towninfo_autocomplete(interaction: discord.Interaction, current: str):
+    return name_choices(bot.state.town_names.search(current))
+
+@bot.tree.command(name="nationinfo", description="Show details about a nation")
+async def nationinfo(interaction: discord.Interaction, nation_name: str):
+    state = bot.state
+    nation = state.nations.get(nation_name)
+    if nation is None:
+        return await interaction.response.send_message("❌ Nation not found!", ephemeral=True)
+
+    towns_rank = state.nation_town_counts.rank(nation_name)
+    members_rank = state.nation_member_totals.rank(nation_name)
+    embed = discord.Embed(title=f"🚩 {nation_name}", color=discord.Color.blue())
+    embed.add_field(name="Leader", value=f"<@{nation['leader_id']}>")
+    embed.add_field(name="Capital", value=nation["capital_town"])
+    embed.add_field(name="Towns", value=f"{len(nation['member_towns'])} (#{towns_rank})")
+    embed.add_field(name="Members", value=f"{state.nation_member_totals.scores.get(nation_name, 0)} (#{members_rank})")
+    war = state.war_of("nation", nation_name)
+    if war is not None:
+        embed.add_field(name="War", value=f"{war['status']} vs {war_opponent(war, nation_name)}")
+    await interaction.response.send_message(embed=embed)
+
+@nationinfo.autocomplete("nation_name")
+async def nationinfo_autocomplete(interaction: discord.Interaction, current: str):
+    return name_choices(bot.state.nation_names.search(current))
+
+### TOWN & NATION LISTS ###
+LIST_PAGE_SIZE = 15
+LIST_CACHE_SIZE = 256  # rendered pages kept, least recently shown dropped first
+
+def town_list_line(state, name):
+    town = state.towns[name]
+    nation = state.town_nation.get(name)
+    return f"**{name}** — {len(town['members'])} members" + (f" · 🚩 {nation}" if nation else "")
+
+def nation_list_line(state, name):
+    nation = state.nations[name]
+    return f"**{name}** — {len(nation['member_towns'])} towns · capital {nation['capital_town']}"
+
+# list -> (name index on the state, collection, title, button action code, line renderer)
+LISTS = {
+    "townlist": ("town_names", "towns", "🏘️ Towns", "tl", town_list_line),
+    "nationlist": ("nation_names", "nations", "🚩 Nations", "nl", nation_list_line),
+}
+list_cache = collections.OrderedDict()  # (list, page) -> (fingerprint, embed)
+
+def list_page(list_name, page):
+    # Only the requested page is looked at. It is rendered again only if a
+    # name on it, or the version of one of those records, has changed.
+    index_attr, collection, title, action, line = LISTS[list_name]
+    state = bot.state
+    names_index = getattr(state, index_attr)
+    pages = max(1, -(-len(names_index) // LIST_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    names = names_index.page(page * LIST_PAGE_SIZE, LIST_PAGE_SIZE)
+    fingerprint = (len(names_index), tuple(names), tuple(state.version(collection, name) for name in names))
+
+    key = (list_name, page)
+    cached = list_cache.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        list_cache.move_to_end(key)
+        embed = cached[1]
+    else:
+        embed = discord.Embed(title=title, color=discord.Color.green())
+        embed.description = "\n".join(line(state, name) for name in names) or "Nothing here yet."
+        embed.set_footer(text=f"Page {page + 1}/{pages} · {len(names_index)} total")
+        list_cache[key] = (fingerprint, embed)
+        list_cache.move_to_end(key)
+        while len(list_cache) > LIST_CACHE_SIZE:
+            list_cache.popitem(last=False)
+
+    view = View(timeout=None)
+    view.add_item(TownyButton(action, max(page - 1, 0), 0, label="◀ Prev", disabled=page == 0))
+    view.add_item(TownyButton(action, page + 1, 0, label="Next ▶", disabled=page + 1 >= pages))
+    return embed, view
+
+@bot.tree.command(name="townlist", description="Browse all towns")
+@app_commands.describe(page="Page to start on")
+async def townlist(interaction: discord.Interaction, page: int = 1):
+    embed, view = list_page("townlist", page - 1)
+    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
+@bot.tree.command(name="nationlist", description="Browse all nations")
+@app_commands.describe(page="Page to start on")
+async def nationlist(interaction: discord.Interaction, page: int = 1):
+    embed, view = list_page("nationlist", page - 1)
+    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
 #BUG SQUASH COMMAND#
 @bot.tree.command(name="bug", description="Report a bug to the developer")
 @app_commands.describe(report="Describe the bug in detail")
 async def bug(interaction: discord.Interaction, report: str):
     developer_id = 1357096626509975582 # <--- CHANGE THIS TO YOUR ID
-    developer = await bot.fetch_user(developer_id)
+    developer = await bot.user_cache.get(developer_id)
     
     if developer:
         embed = discord.Embed(title="🐛 New Bug Report", color=discord.Color.orange())
@@ -919,4 +4411,22 @@ async def bug(interaction: discord.Interaction, report: str):
         await interaction.response.send_message("❌ Developer not found in cache.", ephemeral=True)
     
 
-bot.run("nice try bucko")
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["import-json"]:
+        # python towny_bot.py import-json
+        town_count, nation_count = import_json_to_sqlite()
+        print(f"Imported {town_count} towns and {nation_count} nations into {SQLITE_PATH}")
+    elif sys.argv[1:2] == ["export-ndjson"] and len(sys.argv) == 3:
+        # python towny_bot.py export-ndjson backup.ndjson
+        state = WorldState(make_storage(STORAGE_MODE))
+        state.load()
+        result = asyncio.run(export_ndjson(state, sys.argv[2]))
+        state.storage.close()
+        print(f"Wrote {result['records']} records to {result['path']}")
+    elif sys.argv[1:2] == ["import-ndjson"] and len(sys.argv) > 2:
+        # python towny_bot.py import-ndjson full.ndjson [incremental.ndjson ...]
+        # Stop the bot first; it would overwrite the restored state.
+        print(f"Restored {import_ndjson(sys.argv[2:])} records")
+    else:
+        bot.run("nice try bucko")
\ No newline at end of file